@@ -0,0 +1,104 @@
+"""
+Attachment preparation off the event loop.
+
+A turn used to prepare its attachments one after the other, reading inline
+files with a blocking ``open().read()`` (and parsing DOCX) inside the
+coroutine, so five attachments cost the sum of five reads and stalled every
+other stream on the worker meanwhile. ``AttachmentIO.run`` runs that work on a
+dedicated pool of ``ATTACHMENT_IO_WORKERS`` threads (a burst of large files
+cannot starve the default executor used by DB writes), and ``gather``
+prepares a turn's attachments concurrently, at most
+``ATTACHMENT_PREPARE_CONCURRENCY`` at a time, so the turn takes about as long
+as its slowest file.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class AttachmentIO:
+    def __init__(self, workers: Optional[int] = None, concurrency: Optional[int] = None):
+        self._workers = workers
+        self._concurrency = concurrency
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.busy = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    @property
+    def workers(self) -> int:
+        return max(1, self._workers if self._workers is not None else get_settings().attachment_io_workers)
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, self._concurrency if self._concurrency is not None else get_settings().attachment_prepare_concurrency)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="attachment-io")
+        return self._executor
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """``fn(*args)`` on the attachment thread pool (disk reads, text extraction)."""
+        self.busy += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+        finally:
+            elapsed = time.perf_counter() - started
+            self.busy -= 1
+            self.jobs += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    async def gather(self, items: Iterable[Any], prepare: Callable[[Any], Awaitable[T]]) -> List[T]:
+        """``prepare(item)`` for every item, ``concurrency`` at a time; results in the order of ``items``."""
+        items = list(items)
+        if len(items) <= 1:
+            return [await prepare(item) for item in items]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                return await prepare(item)
+
+        return list(await asyncio.gather(*(bounded(item) for item in items)))
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "concurrency": self.concurrency,
+            "busy": self.busy,
+            "jobs": self.jobs,
+            "avg_ms": self.total_seconds * 1000 / self.jobs if self.jobs else 0.0,
+            "max_ms": self.max_seconds * 1000,
+        }
+
+
+attachment_io = AttachmentIO()
@@ -0,0 +1,209 @@
+"""
+Transport of binary attachments (PDFs, images) to Gemini.
+
+Small attachments (``processing_method == 'inline'``) are sent as
+``inline_data`` bytes, which means a 15 MB PDF is uploaded again on every turn
+of its chat. ``AttachmentTransportManager`` counts how many turns send a file
+inline; once a file reaches ``ATTACHMENT_PROMOTE_AFTER_USES`` it is uploaded to
+the Gemini Files API in the background and the handle is recorded on
+``FileMetadata`` (the same ``gemini_api_*`` columns as large ``files_api``
+uploads). Later turns send only a ``file_data`` reference while the handle is
+valid, and handles close to expiry are re-uploaded in the background, so no
+turn ever waits for an upload.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from google.genai import types
+
+from .config import get_settings
+from .context import prompt_context_cache
+from .crud.aio import file_crud
+from .database import AsyncSessionLocal
+from .llm.resilience import GEMINI_FILES, resilience
+from .models import FileMetadata
+
+logger = logging.getLogger(__name__)
+
+# A reference is not used in its last hour; the request could outlive the file
+REFERENCE_SAFETY_MARGIN = timedelta(hours=1)
+# Files whose use count is tracked (per worker process)
+MAX_TRACKED_FILES = 4096
+
+
+class FileHandle:
+    """A Files API upload usable as a prompt reference."""
+
+    __slots__ = ("name", "uri", "mime_type", "expires_at")
+
+    def __init__(self, name: str, uri: str, mime_type: str, expires_at: Optional[datetime]):
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+        self.expires_at = expires_at
+
+    def usable(self, now: datetime) -> bool:
+        return self.expires_at is None or now < self.expires_at - REFERENCE_SAFETY_MARGIN
+
+    def needs_refresh(self, now: datetime, refresh_before: timedelta) -> bool:
+        return self.expires_at is not None and now >= self.expires_at - refresh_before
+
+
+class AttachmentTransportManager:
+    """Decides per attachment between inline bytes and a Files API reference."""
+
+    def __init__(self, promote_after_uses: Optional[int] = None, refresh_before: Optional[timedelta] = None):
+        self._promote_after_uses = promote_after_uses
+        self._refresh_before = refresh_before
+        self._uses: "OrderedDict[str, int]" = OrderedDict()
+        self._handles: Dict[str, FileHandle] = {}
+        self._uploads: Dict[str, asyncio.Task] = {}
+        self.promoted = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.reference_hits = 0
+        self.inline_bytes_avoided = 0
+
+    @property
+    def promote_after_uses(self) -> int:
+        if self._promote_after_uses is not None:
+            return self._promote_after_uses
+        return get_settings().attachment_promote_after_uses
+
+    @property
+    def refresh_before(self) -> timedelta:
+        if self._refresh_before is not None:
+            return self._refresh_before
+        return timedelta(minutes=get_settings().attachment_refresh_before_minutes)
+
+    # --- Prompt parts ---
+
+    async def reference_part(self, fm: FileMetadata, client) -> Optional[types.Part]:
+        """
+        A ``file_data`` part for ``fm`` when it has a usable Files API handle, else None.
+
+        Schedules a background refresh when the handle is close to expiry, or a
+        re-upload of an inline file whose handle can no longer be used.
+        """
+        if client is None:
+            return None
+        now = datetime.utcnow()
+        handle = await self._handle_for(fm, client)
+        if handle is None or not handle.usable(now):
+            if handle is not None and fm.processing_method == 'inline':
+                self._schedule_upload(fm.id, client, refresh=True)
+            return None
+        if handle.needs_refresh(now, self.refresh_before):
+            self._schedule_upload(fm.id, client, refresh=True)
+        self.reference_hits += 1
+        if fm.processing_method == 'inline':
+            self.inline_bytes_avoided += fm.size or 0
+        return types.Part.from_uri(file_uri=handle.uri, mime_type=handle.mime_type)
+
+    def expires_at(self, file_id: str) -> Optional[datetime]:
+        """Last moment a prepared reference to ``file_id`` may be sent."""
+        handle = self._handles.get(file_id)
+        if handle is None or handle.expires_at is None:
+            return None
+        return handle.expires_at - REFERENCE_SAFETY_MARGIN
+
+    async def _handle_for(self, fm: FileMetadata, client) -> Optional[FileHandle]:
+        handle = self._handles.get(fm.id)
+        if handle is not None and (
+            not fm.gemini_api_expiry_timestamp
+            or (handle.expires_at and handle.expires_at >= fm.gemini_api_expiry_timestamp)
+        ):
+            return handle
+        if not fm.gemini_api_file_id:
+            return handle
+        # Uploaded by another worker (or before a restart): the row only keeps the
+        # file name, resolve its URI once
+        try:
+            uploaded = await client.aio.files.get(name=fm.gemini_api_file_id)
+        except Exception as e:
+            logger.warning(f"Could not resolve Gemini file {fm.gemini_api_file_id} of file {fm.id}: {e}")
+            return None
+        handle = FileHandle(
+            fm.gemini_api_file_id,
+            uploaded.uri or fm.gemini_api_file_id,
+            fm.content_type,
+            fm.gemini_api_expiry_timestamp,
+        )
+        self._handles[fm.id] = handle
+        return handle
+
+    # --- Reuse tracking ---
+
+    def record_uses(self, file_ids: Iterable[str], client) -> None:
+        """Count one more turn sending each file inline; promote files past the threshold."""
+        threshold = self.promote_after_uses
+        for file_id in file_ids:
+            uses = self._uses.pop(file_id, 0) + 1
+            self._uses[file_id] = uses
+            if threshold > 0 and uses >= threshold and client is not None:
+                self._schedule_upload(file_id, client)
+        while len(self._uses) > MAX_TRACKED_FILES:
+            self._uses.popitem(last=False)
+
+    def _schedule_upload(self, file_id: str, client, refresh: bool = False) -> None:
+        if file_id in self._uploads:
+            return
+        task = asyncio.create_task(self._upload(file_id, client, refresh))
+        self._uploads[file_id] = task
+        task.add_done_callback(lambda _: self._uploads.pop(file_id, None))
+
+    async def _upload(self, file_id: str, client, refresh: bool) -> None:
+        # Own session: the turn that scheduled the upload has finished with its own
+        async with AsyncSessionLocal() as db:
+            fm = await file_crud.get_file_metadata_by_id(db, file_id=file_id)
+            if fm is None or not fm.local_disk_path:
+                self._uses.pop(file_id, None)
+                return
+            try:
+                uploaded = await resilience.call(GEMINI_FILES, lambda: client.aio.files.upload(
+                    file=fm.local_disk_path,
+                    config=types.UploadFileConfig(
+                        display_name=fm.original_filename,
+                        mime_type=fm.content_type,
+                    ),
+                ))
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to upload attachment {file_id} to the Gemini Files API: {e}", exc_info=True)
+                return
+            fm = await file_crud.update_file_metadata_gemini_info(
+                db=db, file_id=file_id, gemini_api_file_id=uploaded.name
+            )
+            if fm is None:
+                return
+            self._handles[file_id] = FileHandle(
+                uploaded.name, uploaded.uri or uploaded.name, fm.content_type, fm.gemini_api_expiry_timestamp
+            )
+        self._uses.pop(file_id, None)
+        if refresh:
+            self.refreshed += 1
+        else:
+            self.promoted += 1
+        logger.info(f"Attachment {file_id} is now sent as Gemini file {uploaded.name}")
+        # Cached contexts still hold the inline bytes; rebuild them with the reference
+        prompt_context_cache.invalidate_file(file_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "tracked_files": len(self._uses),
+            "handles": len(self._handles),
+            "uploads_in_flight": len(self._uploads),
+            "promoted": self.promoted,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "reference_hits": self.reference_hits,
+            "inline_bytes_avoided": self.inline_bytes_avoided,
+            "promote_after_uses": self.promote_after_uses,
+        }
+
+
+attachment_transport = AttachmentTransportManager()
@@ -5,6 +5,8 @@ from sqlalchemy.orm import Session
 from app.crud import auth_crud
 from app.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
 from fastapi import Depends, HTTPException, status
+from starlette.requests import HTTPConnection
+from typing import Optional
 from fastapi.security import OAuth2PasswordBearer
 from app.database import get_db
 from app.schemas import TokenData
@@ -47,4 +49,28 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     user = auth_crud.get_user_by_email(db, email=token_data.email)
     if user is None:
         raise credentials_exception
-    return user 
\ No newline at end of file
+    return user 
+
+def token_subject(token: Optional[str]) -> Optional[str]:
+    """Subject of a valid access token, without a DB lookup; None if missing or invalid."""
+    if not token:
+        return None
+    try:
+        subject = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+    return subject if isinstance(subject, str) and subject else None
+
+def quota_user_key(connection: HTTPConnection) -> str:
+    """
+    Key of the per-user LLM quotas: the JWT subject (Authorization header, or the
+    `token` query parameter for WebSockets), else the client IP.
+    """
+    authorization = connection.headers.get("Authorization") or ""
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else connection.query_params.get("token")
+    subject = token_subject(token)
+    if subject is not None:
+        return f"user:{subject}"
+    forwarded_for = connection.headers.get("X-Forwarded-For")
+    client_ip = forwarded_for.split(",")[0].strip() if forwarded_for else (connection.client.host if connection.client else "unknown")
+    return f"ip:{client_ip}"
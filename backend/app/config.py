@@ -25,10 +25,79 @@ class Settings(BaseSettings):
     # File Upload Settings
     upload_dir: str = os.getenv("UPLOAD_DIR", "/tmp/ai-math-chatbot-uploads")
     max_file_size: int = parse_int_env("MAX_FILE_SIZE", 20 * 1024 * 1024)  # 20MB default
+    # Inline attachments sent this many turns are moved to the Gemini Files API (0 disables)
+    attachment_promote_after_uses: int = parse_int_env("ATTACHMENT_PROMOTE_AFTER_USES", 2)
+    attachment_refresh_before_minutes: int = parse_int_env("ATTACHMENT_REFRESH_BEFORE_MINUTES", 360)  # Re-upload in the background this long before expiry
 
     # Server Settings
     allowed_origins: str = os.getenv("ALLOWED_ORIGINS", "*")
 
+    # Streaming Settings
+    stream_buffer_size: int = parse_int_env("STREAM_BUFFER_SIZE", 64)  # Max queued events per generation
+    stream_flush_interval_ms: int = parse_int_env("STREAM_FLUSH_INTERVAL_MS", 50)  # Coalescing window
+    stream_max_frame_chars: int = parse_int_env("STREAM_MAX_FRAME_CHARS", 4096)
+    stream_replay_buffer_size: int = parse_int_env("STREAM_REPLAY_BUFFER_SIZE", 2048)  # Frames kept for Last-Event-ID replay
+    stream_detach_grace_seconds: int = parse_int_env("STREAM_DETACH_GRACE_SECONDS", 60)  # Detached generations are cancelled after this
+
+    # Prompt Context Cache (prepared chat history per chat, per worker process)
+    prompt_context_cache_mb: int = parse_int_env("PROMPT_CONTEXT_CACHE_MB", 64)
+
+    # Prompt Token Budget (Gemini pipeline): recent messages are sent verbatim, older ones as a rolling summary
+    context_token_budget: int = parse_int_env("CONTEXT_TOKEN_BUDGET", 32000)  # 0 sends the whole history
+    context_recent_messages: int = parse_int_env("CONTEXT_RECENT_MESSAGES", 6)  # Always sent verbatim
+    context_summary_max_tokens: int = parse_int_env("CONTEXT_SUMMARY_MAX_TOKENS", 1024)
+    # Attachments are re-sent with the last N user turns (or when mentioned); older ones as a text digest
+    attachment_retention_turns: int = parse_int_env("ATTACHMENT_RETENTION_TURNS", 3)  # 0 re-sends every attachment
+    # Attachment disk reads and DOCX parsing run on a dedicated thread pool; a turn prepares up to N files at once
+    attachment_io_workers: int = parse_int_env("ATTACHMENT_IO_WORKERS", 8)
+    attachment_prepare_concurrency: int = parse_int_env("ATTACHMENT_PREPARE_CONCURRENCY", 5)
+
+    # Semantic Answer Cache (standalone questions, per worker process)
+    answer_cache_max_entries: int = parse_int_env("ANSWER_CACHE_MAX_ENTRIES", 2000)  # 0 disables the cache
+    answer_cache_ttl_seconds: int = parse_int_env("ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+    answer_cache_similarity: float = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95").split('#')[0].strip())  # Cosine
+    answer_cache_embedding_model: str = os.getenv("ANSWER_CACHE_EMBEDDING_MODEL", "text-embedding-004")
+
+    # Retries (full-jitter exponential backoff) and circuit breakers around model and vector-store calls
+    llm_retry_attempts: int = parse_int_env("LLM_RETRY_ATTEMPTS", 3)  # Attempts per call, 1 = no retry
+    llm_retry_base_ms: int = parse_int_env("LLM_RETRY_BASE_MS", 500)
+    llm_retry_max_ms: int = parse_int_env("LLM_RETRY_MAX_MS", 8000)
+    breaker_failure_threshold: int = parse_int_env("BREAKER_FAILURE_THRESHOLD", 5)  # Consecutive transient failures
+    breaker_reset_seconds: int = parse_int_env("BREAKER_RESET_SECONDS", 30)  # Open time before a probe call
+
+    # Gemini project quota; calls are paced to stay under it instead of failing with RESOURCE_EXHAUSTED
+    gemini_rpm_limit: int = parse_int_env("GEMINI_RPM_LIMIT", 0)  # Requests per minute, 0 = not paced
+    gemini_tpm_limit: int = parse_int_env("GEMINI_TPM_LIMIT", 0)  # Tokens per minute, 0 = not paced
+
+    # Hedged Gemini requests: race chat_model_config (config.yaml) when the first chunk is late
+    llm_hedge_enabled: bool = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+    llm_hedge_after_ms: int = parse_int_env("LLM_HEDGE_AFTER_MS", 0)  # 0 = rolling p95 of Gemini first-chunk latency
+
+    # Identical concurrent first questions share one upstream generation (per worker process)
+    single_flight_enabled: bool = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+    # Chat messages are written behind the request, in batches of up to this many per transaction
+    message_writer_batch_size: int = parse_int_env("MESSAGE_WRITER_BATCH_SIZE", 100)
+    message_writer_flush_ms: int = parse_int_env("MESSAGE_WRITER_FLUSH_MS", 20)  # Wait to gather a batch
+    # A streamed answer is saved as a "partial" message every N tokens or every N ms, whichever comes first
+    message_checkpoint_tokens: int = parse_int_env("MESSAGE_CHECKPOINT_TOKENS", 200)
+    message_checkpoint_interval_ms: int = parse_int_env("MESSAGE_CHECKPOINT_INTERVAL_MS", 2000)
+
+    # Pipelines built at startup (comma-separated); the others are built on first use
+    pipeline_warmup: str = os.getenv("PIPELINE_WARMUP", "gemini,rag")
+
+    # Generation Limits (per worker process)
+    max_active_generations: int = parse_int_env("MAX_ACTIVE_GENERATIONS", 200)
+    max_generations_per_chat: int = parse_int_env("MAX_GENERATIONS_PER_CHAT", 2)
+    # Per-user LLM quotas (JWT subject, else client IP): estimated tokens per minute and concurrent generations
+    user_token_quota_per_minute: int = parse_int_env("USER_TOKEN_QUOTA_PER_MINUTE", 200000)  # 0 disables the token quota
+    user_quota_completion_tokens: int = parse_int_env("USER_QUOTA_COMPLETION_TOKENS", 2048)  # Reserved per answer
+    user_max_active_generations: int = parse_int_env("USER_MAX_ACTIVE_GENERATIONS", 3)  # 0 = no per-user cap
+    user_quota_max_wait_seconds: int = parse_int_env("USER_QUOTA_MAX_WAIT_SECONDS", 10)  # Longer waits fail fast with 429
+    # Concurrent upstream LLM calls; further requests wait in a bounded priority queue
+    generation_slots: int = parse_int_env("GENERATION_SLOTS", 16)
+    generation_queue_size: int = parse_int_env("GENERATION_QUEUE_SIZE", 100)
+
     # === AUTHENTICATION SETTINGS ===
     SECRET_KEY: str = os.getenv("SECRET_KEY", "change-me")
     ALGORITHM: str = os.getenv("ALGORITHM", "HS256")
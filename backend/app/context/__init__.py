@@ -0,0 +1,34 @@
+# Cache ngữ cảnh prompt (lịch sử chat đã chuẩn bị), ngân sách token và chính sách giữ file đính kèm
+from .cache import (
+    AttachmentRef,
+    ChatContext,
+    PreparedMessage,
+    PromptContextCache,
+    prompt_context_cache
+)
+from .budget import (
+    HistoryPlan,
+    estimate_contents_tokens,
+    estimate_message_tokens,
+    estimate_text_tokens,
+    plan_history
+)
+from .retention import (
+    attachment_digest,
+    retained_attachments
+)
+
+__all__ = [
+    'AttachmentRef',
+    'ChatContext',
+    'PreparedMessage',
+    'PromptContextCache',
+    'prompt_context_cache',
+    'HistoryPlan',
+    'estimate_contents_tokens',
+    'estimate_message_tokens',
+    'estimate_text_tokens',
+    'plan_history',
+    'attachment_digest',
+    'retained_attachments'
+]
@@ -0,0 +1,114 @@
+"""
+Token budget for the chat history sent to Gemini.
+
+Each prepared message carries an estimated token count (computed once, kept in
+the prompt context cache). ``plan_history`` keeps the newest messages verbatim
+within the budget and reports how far the rolling chat summary should reach
+so that the next turns fit; the summary itself is written in the background
+by ``app/summaries.py``.
+"""
+
+import logging
+from typing import List, NamedTuple, Optional
+
+from ..utils import str_token_counter
+
+logger = logging.getLogger(__name__)
+
+# Gemini bills an image, and each PDF page, at about 258 tokens
+ATTACHMENT_PAGE_TOKENS = 258
+# Rough size of one PDF page, to estimate the page count from the file size
+PDF_BYTES_PER_PAGE = 100 * 1024
+# Summarize once the history uses this share of the budget, before messages must be dropped
+SUMMARY_TRIGGER_RATIO = 0.75
+
+
+def estimate_text_tokens(text: Optional[str]) -> int:
+    if not text:
+        return 0
+    try:
+        return str_token_counter(text)
+    except Exception:
+        # Tokenizer unavailable: about 4 characters per token
+        return len(text) // 4 + 1
+
+
+def estimate_attachment_tokens(fm) -> int:
+    if fm.extracted_token_count is not None:
+        return fm.extracted_token_count
+    if (fm.content_type or "").startswith("image/"):
+        return ATTACHMENT_PAGE_TOKENS
+    return ATTACHMENT_PAGE_TOKENS * max(1, (fm.size or 0) // PDF_BYTES_PER_PAGE)
+
+
+def estimate_message_tokens(msg_model) -> int:
+    """Estimated prompt tokens of a message and its attachments."""
+    tokens = estimate_text_tokens(msg_model.content)
+    for fm in getattr(msg_model, "files", None) or []:
+        tokens += estimate_attachment_tokens(fm)
+    return tokens
+
+
+def estimate_contents_tokens(contents) -> int:
+    """Estimated prompt tokens of the Gemini ``contents`` about to be sent."""
+    tokens = 0
+    for content in contents or []:
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "text", None):
+                tokens += estimate_text_tokens(part.text)
+            elif getattr(part, "inline_data", None) is not None:
+                inline = part.inline_data
+                if (inline.mime_type or "").startswith("image/"):
+                    tokens += ATTACHMENT_PAGE_TOKENS
+                else:
+                    tokens += ATTACHMENT_PAGE_TOKENS * max(1, len(inline.data or b"") // PDF_BYTES_PER_PAGE)
+            elif getattr(part, "file_data", None) is not None:
+                # Size unknown here; the real count is settled from the response's usage metadata
+                tokens += ATTACHMENT_PAGE_TOKENS
+    return tokens
+
+
+class HistoryPlan(NamedTuple):
+    start: int  # Index of the first message sent verbatim
+    dropped: int  # Messages neither summarized nor sent (the summary has not caught up yet)
+    summarize_upto: Optional[int]  # Message id the summary should be extended to, if any
+
+
+def plan_history(
+    message_ids: List[int],
+    tokens: List[int],
+    summary_upto: int,
+    summary_tokens: int,
+    budget: int,
+    recent_messages: int,
+) -> HistoryPlan:
+    """
+    Choose the verbatim tail of a chat history.
+
+    Messages up to ``summary_upto`` are covered by the summary and never sent.
+    The newest ``recent_messages`` are always sent; older ones are added while
+    they fit in ``budget``.
+    """
+    first = 0
+    while first < len(message_ids) and message_ids[first] <= summary_upto:
+        first += 1
+    if budget <= 0:
+        return HistoryPlan(first, 0, None)
+
+    available = budget - summary_tokens
+    total = 0
+    start = len(message_ids)
+    while start > first:
+        cost = tokens[start - 1]
+        kept = len(message_ids) - start
+        if kept >= recent_messages and total + cost > available:
+            break
+        total += cost
+        start -= 1
+
+    uncovered = sum(tokens[first:])
+    summarize_upto = None
+    recent_start = max(first, len(message_ids) - recent_messages)
+    if summary_tokens + uncovered > budget * SUMMARY_TRIGGER_RATIO and recent_start > first:
+        summarize_upto = message_ids[recent_start - 1]
+    return HistoryPlan(start, start - first, summarize_upto)
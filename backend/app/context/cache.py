@@ -0,0 +1,183 @@
+"""
+In-memory LRU cache of prepared prompt messages per chat.
+
+``GeminiPipeline`` used to rebuild every ``types.Content`` (and re-read every
+attachment) from the full chat history on each turn. With this cache a turn
+only prepares the messages created after the cached ``last_message_id`` and
+appends them. Entries are bounded by a total memory budget (approximate
+bytes of text and inline attachment data), evicted least-recently-used, and
+dropped when the chat is deleted, its messages are removed, an uploaded
+Gemini file they reference is about to expire, or an attachment they carry
+inline has been moved to the Files API (see app/attachments.py).
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from ..config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class AttachmentRef(NamedTuple):
+    file_id: str
+    name: str
+    inline: bool  # Sent as inline_data bytes (rather than text or a Files API reference)
+
+
+class PreparedMessage(NamedTuple):
+    """One message ready for the prompt, with an attachment-free variant for older turns."""
+    content: Any
+    size: int
+    tokens: int
+    expires_at: Optional[datetime] = None
+    attachments: Tuple[AttachmentRef, ...] = ()
+    # Same message with attachments replaced by short text digests; None without attachments
+    digest: Any = None
+    digest_tokens: int = 0
+
+
+class ChatContext:
+    """Prepared messages of one chat, up to and including ``last_message_id``."""
+
+    __slots__ = ("messages", "message_ids", "last_message_id", "message_count", "size", "expires_at", "inline_file_ids")
+
+    def __init__(
+        self,
+        messages: Optional[List[PreparedMessage]] = None,
+        message_ids: Optional[List[int]] = None,
+        last_message_id: int = 0,
+        message_count: int = 0,
+        size: int = 0,
+        expires_at: Optional[datetime] = None,
+        inline_file_ids: Optional[Set[str]] = None,
+    ):
+        self.messages = messages if messages is not None else []
+        self.message_ids = message_ids if message_ids is not None else []
+        self.last_message_id = last_message_id
+        self.message_count = message_count
+        self.size = size
+        self.expires_at = expires_at
+        # Attachments whose bytes are held in ``messages`` as inline_data
+        self.inline_file_ids = inline_file_ids if inline_file_ids is not None else set()
+
+    def append(self, message_id: int, message: PreparedMessage) -> None:
+        self.messages.append(message)
+        self.message_ids.append(message_id)
+        self.last_message_id = max(self.last_message_id, message_id)
+        self.message_count += 1
+        self.size += message.size
+        if message.expires_at is not None and (self.expires_at is None or message.expires_at < self.expires_at):
+            self.expires_at = message.expires_at
+        self.inline_file_ids.update(ref.file_id for ref in message.attachments if ref.inline)
+
+    def copy(self) -> "ChatContext":
+        """Entries are shared between concurrent turns; extend a copy, never the cached one."""
+        return ChatContext(
+            list(self.messages), list(self.message_ids), self.last_message_id, self.message_count,
+            self.size, self.expires_at, set(self.inline_file_ids),
+        )
+
+    def expired(self, now: Optional[datetime] = None) -> bool:
+        return self.expires_at is not None and (now or datetime.utcnow()) >= self.expires_at
+
+
+class PromptContextCache:
+    """LRU of ``ChatContext`` entries keyed by chat id, bounded by ``budget_bytes``."""
+
+    def __init__(self, budget_bytes: Optional[int] = None):
+        self._budget_bytes = budget_bytes
+        self._entries: "OrderedDict[int, ChatContext]" = OrderedDict()
+        self._size = 0
+        # Turns read and fill the cache on the event loop, but sync endpoints (threadpool),
+        # write-behind batches and background tasks invalidate it from worker threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def budget_bytes(self) -> int:
+        if self._budget_bytes is not None:
+            return self._budget_bytes
+        return get_settings().prompt_context_cache_mb * 1024 * 1024
+
+    def get(self, chat_id: int) -> Optional[ChatContext]:
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expired():
+                self._discard(chat_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry
+
+    def put(self, chat_id: int, entry: ChatContext) -> None:
+        budget_bytes = self.budget_bytes
+        with self._lock:
+            current = self._entries.get(chat_id)
+            if current is not None and current.last_message_id > entry.last_message_id:
+                # A concurrent turn of the same chat already stored a newer context
+                return
+            self._discard(chat_id)
+            if entry.size > budget_bytes:
+                # A single huge chat would flush everybody else; rebuild it every turn instead
+                logger.debug(f"Context of chat {chat_id} ({entry.size} bytes) exceeds the cache budget")
+                return
+            self._entries[chat_id] = entry
+            self._size += entry.size
+            while self._size > budget_bytes and self._entries:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self.evictions += 1
+                logger.debug(f"Evicted prompt context of chat {evicted_id}")
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._discard(chat_id)
+
+    def invalidate_message(self, chat_id: int, message_id: int) -> None:
+        """Drop the chat's context if it holds ``message_id`` (the message was rewritten)."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and message_id in entry.message_ids:
+                self._discard(chat_id)
+
+    def invalidate_file(self, file_id: str) -> None:
+        """Drop every context carrying ``file_id`` inline."""
+        with self._lock:
+            for chat_id in [chat_id for chat_id, entry in self._entries.items() if file_id in entry.inline_file_ids]:
+                self._discard(chat_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, chat_id: int) -> None:
+        # Caller holds ``_lock``
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            chats, size_bytes = len(self._entries), self._size
+        return {
+            "chats": chats,
+            "size_bytes": size_bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+prompt_context_cache = PromptContextCache()
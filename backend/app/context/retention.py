@@ -0,0 +1,76 @@
+"""
+Attachment retention for the chat history sent to Gemini.
+
+Attachments are sent with the messages of the last ``ATTACHMENT_RETENTION_TURNS``
+user turns, and with older messages only when the current message refers to
+them (by file name, or generically to "the file" / "the picture" for the most
+recent attachments). Every other message is sent in its digest form: its text
+plus a short description of each attachment, prepared once and kept in the
+prompt context cache.
+"""
+
+import re
+from typing import List, Optional
+
+from .cache import AttachmentRef, PreparedMessage
+
+# Digest excerpt of text attachments
+DIGEST_EXCERPT_CHARS = 300
+# Words meaning "the attached file" without naming it
+GENERIC_FILE_REFERENCE = re.compile(
+    r"\b(file|tệp|tep|tài liệu|tai lieu|ảnh|hình|hinh|pdf|đính kèm|dinh kem|attachment|attached|image|document)\b",
+    re.IGNORECASE,
+)
+# File name stems shorter than this are too ambiguous to match
+MIN_STEM_CHARS = 4
+
+
+def attachment_digest(fm, text: Optional[str] = None) -> str:
+    """Short text standing in for an attachment that is not re-sent."""
+    size_kb = max(1, (fm.size or 0) // 1024)
+    digest = (
+        f"[File đính kèm ở lượt trước: {fm.original_filename} ({fm.content_type}, {size_kb} KB); "
+        f"nội dung không được gửi lại, nhắc tên file để xem lại]"
+    )
+    if text:
+        excerpt = " ".join(text.split())[:DIGEST_EXCERPT_CHARS]
+        digest += f"\nTrích đoạn: {excerpt}…"
+    return digest
+
+
+def refers_to(text: str, ref: AttachmentRef) -> bool:
+    name = (ref.name or "").lower()
+    if not name:
+        return False
+    stem = name.rsplit(".", 1)[0]
+    return name in text or (len(stem) >= MIN_STEM_CHARS and stem in text)
+
+
+def retained_attachments(messages: List[PreparedMessage], current_text: str, retention_turns: int) -> List[bool]:
+    """For each message, whether it is sent with its attachments (True) or as its digest."""
+    if retention_turns <= 0:
+        return [True] * len(messages)
+
+    keep_from = 0
+    user_turns = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if getattr(messages[i].content, "role", None) == "user":
+            user_turns += 1
+            if user_turns == retention_turns:
+                keep_from = i
+                break
+
+    text = (current_text or "").lower()
+    retained = [
+        message.digest is None or i >= keep_from or any(refers_to(text, ref) for ref in message.attachments)
+        for i, message in enumerate(messages)
+    ]
+    if GENERIC_FILE_REFERENCE.search(text) and not any(
+        message.attachments and retained[i] for i, message in enumerate(messages)
+    ):
+        # "Giải bài trong file" with no file in the recent turns: the latest attachments are meant
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].attachments:
+                retained[i] = True
+                break
+    return retained
@@ -1,6 +1,8 @@
 # Import CRUD modules to expose as part of the crud package
 from . import file_crud
 from . import chat_crud
+# Async versions of the same functions (AsyncSession): crud.aio
+from . import aio
 
 # Re-export common functions from chat_crud for backward compatibility
 from .chat_crud import (
@@ -9,8 +11,18 @@ from .chat_crud import (
     create_chat,
     update_chat,
     delete_chat,
+    update_chat_summary,
     get_messages_for_chat,
+    get_messages_for_chat_after,
+    count_messages_up_to,
+    count_messages_for_chat,
+    get_message,
+    get_last_message,
+    get_last_user_message,
+    delete_messages_after,
     create_chat_message,
+    add_chat_messages,
+    update_message_content,
     create_chat_message_with_files,
     get_expired_gemini_files_from_metadata
 )
@@ -0,0 +1,34 @@
+# Async CRUD (AsyncSession) with the same functions as app.crud, for code on the event loop.
+# Relationships are not lazy-loaded under asyncio: message queries load their files;
+# load anything else explicitly.
+from . import file_crud
+from . import chat_crud
+from . import auth_crud
+
+from .chat_crud import (
+    get_chat,
+    get_chats,
+    create_chat,
+    update_chat,
+    delete_chat,
+    update_chat_summary,
+    get_messages_for_chat,
+    get_messages_for_chat_after,
+    count_messages_up_to,
+    count_messages_for_chat,
+    get_message,
+    get_last_message,
+    get_last_user_message,
+    delete_messages_after,
+    create_chat_message,
+    add_chat_messages,
+    update_message_content,
+    create_chat_message_with_files,
+    get_expired_gemini_files_from_metadata
+)
+
+from .file_crud import (
+    get_file_metadata_by_id,
+    create_file_metadata,
+    delete_file_metadata
+)
@@ -0,0 +1,16 @@
+"""Async versions of ``app.crud.auth_crud`` for ``AsyncSession``."""
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import User
+from app.schemas import UserRegister
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
+
+async def create_user(db: AsyncSession, user: UserRegister, hashed_password: str):
+    db_user = User(email=user.email, hashed_password=hashed_password)
+    db.add(db_user)
+    await db.commit()
+    return db_user
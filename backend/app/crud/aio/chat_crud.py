@@ -0,0 +1,266 @@
+"""Async versions of ``app.crud.chat_crud`` for ``AsyncSession``."""
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import Any, List, Optional, Sequence
+from datetime import datetime
+import logging
+
+from ... import models, schemas
+from . import file_crud
+from ...context import prompt_context_cache
+
+logger = logging.getLogger(__name__)
+
+# Relationships are not lazy-loaded under asyncio: every message query loads its files
+_with_files = selectinload(models.Message.files)
+
+# CRUD operations for Chat
+
+async def get_chat(db: AsyncSession, chat_id: int) -> Optional[models.Chat]:
+    """Lấy một cuộc trò chuyện duy nhất bằng ID của nó (không kèm tin nhắn)."""
+    return await db.get(models.Chat, chat_id)
+
+async def get_chats(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100) -> List[models.Chat]:
+    """Lấy danh sách các cuộc trò chuyện của một user, được sắp xếp theo thời gian gần nhất."""
+    result = await db.execute(
+        select(models.Chat)
+        .where(models.Chat.user_id == user_id)
+        .order_by(models.Chat.create_time.desc())
+        .offset(skip)
+        .limit(limit)
+    )
+    return list(result.scalars().all())
+
+async def create_chat(db: AsyncSession, chat: schemas.ChatCreate, user_id: int) -> models.Chat:
+    """Tạo một cuộc trò chuyện mới."""
+    try:
+        db_chat = models.Chat(title=chat.title, user_id=user_id)
+        db.add(db_chat)
+        await db.commit()
+        if not db_chat.id:
+            raise ValueError("Database did not generate a valid ID for the chat")
+        logger.info(f"Successfully created chat with ID: {db_chat.id}")
+        return db_chat
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error creating chat: {str(e)}")
+        raise
+
+async def update_chat(db: AsyncSession, chat_id: int, chat_update: schemas.ChatUpdate, user_id: int = None) -> Optional[models.Chat]:
+    """Update a chat's title, chỉ cho phép nếu đúng user_id."""
+    db_chat = await get_chat(db, chat_id)
+    if db_chat:
+        if user_id is not None and db_chat.user_id != user_id:
+            return None
+        if chat_update.title is not None:
+            db_chat.title = chat_update.title
+            await db.commit()
+    return db_chat
+
+async def delete_chat(db: AsyncSession, chat_id: int, user_id: int = None) -> Optional[models.Chat]:
+    """Delete a chat by its ID, chỉ cho phép nếu đúng user_id."""
+    db_chat = await get_chat(db, chat_id)
+    if db_chat:
+        if user_id is not None and db_chat.user_id != user_id:
+            return None
+        await db.delete(db_chat) # Cascade will delete messages, and relationship to message_file_link_table
+        await db.commit()
+        prompt_context_cache.invalidate(chat_id)
+        logger.info(f"Deleted chat ID {chat_id} and all its messages and file links")
+    return db_chat
+
+async def update_chat_summary(db: AsyncSession, chat_id: int, summary: str, upto_message_id: int) -> Optional[models.Chat]:
+    """Store the rolling summary of a chat, unless a summary covering more messages is already stored."""
+    db_chat = await get_chat(db, chat_id)
+    if db_chat is None:
+        return None
+    # Another summary may have been stored since this session loaded the chat
+    await db.refresh(db_chat, attribute_names=["summary", "summary_upto_message_id"])
+    if (db_chat.summary_upto_message_id or 0) >= upto_message_id:
+        return db_chat
+    db_chat.summary = summary
+    db_chat.summary_upto_message_id = upto_message_id
+    await db.commit()
+    return db_chat
+
+# CRUD operations for Message
+
+async def get_messages_for_chat(db: AsyncSession, chat_id: int, skip: int = 0, limit: int = 1000, exclude_message_id: Optional[int] = None) -> List[models.Message]:
+    """Retrieve messages for a specific chat, ordered by timestamp.
+    Can optionally exclude a specific message ID (e.g., the current user message being processed).
+    """
+    query = select(models.Message).options(_with_files).where(models.Message.chat_id == chat_id)
+    if exclude_message_id is not None:
+        query = query.where(models.Message.id != exclude_message_id)
+    result = await db.execute(query.order_by(models.Message.timestamp).offset(skip).limit(limit))
+    return list(result.scalars().all())
+
+async def get_messages_for_chat_after(db: AsyncSession, chat_id: int, after_message_id: int) -> List[models.Message]:
+    """Retrieve the messages of a chat created after ``after_message_id`` (incremental context loading)."""
+    result = await db.execute(
+        select(models.Message)
+        .options(_with_files)
+        .where(models.Message.chat_id == chat_id, models.Message.id > after_message_id)
+        .order_by(models.Message.id)
+    )
+    return list(result.scalars().all())
+
+async def count_messages_up_to(db: AsyncSession, chat_id: int, message_id: int) -> int:
+    """Number of messages of a chat with an id up to ``message_id``; detects deletions behind a cached context."""
+    return await db.scalar(
+        select(func.count(models.Message.id))
+        .where(models.Message.chat_id == chat_id, models.Message.id <= message_id)
+    )
+
+async def count_messages_for_chat(db: AsyncSession, chat_id: int, exclude_message_id: Optional[int] = None) -> int:
+    """Number of messages in a chat, optionally not counting one of them (e.g. the message being answered)."""
+    query = select(func.count(models.Message.id)).where(models.Message.chat_id == chat_id)
+    if exclude_message_id is not None:
+        query = query.where(models.Message.id != exclude_message_id)
+    return await db.scalar(query)
+
+async def get_message(db: AsyncSession, message_id: int) -> Optional[models.Message]:
+    """Retrieve a single message by its ID."""
+    result = await db.execute(select(models.Message).options(_with_files).where(models.Message.id == message_id))
+    return result.scalars().first()
+
+async def get_last_message(db: AsyncSession, chat_id: int) -> Optional[models.Message]:
+    """Retrieve the most recent message of a chat."""
+    result = await db.execute(
+        select(models.Message)
+        .options(_with_files)
+        .where(models.Message.chat_id == chat_id)
+        .order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+async def get_last_user_message(db: AsyncSession, chat_id: int) -> Optional[models.Message]:
+    """Retrieve the most recent user message of a chat."""
+    result = await db.execute(
+        select(models.Message)
+        .options(_with_files)
+        .where(models.Message.chat_id == chat_id, models.Message.role == "user")
+        .order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+async def delete_messages_after(db: AsyncSession, chat_id: int, message_id: int) -> int:
+    """Delete every message of a chat that was created after ``message_id`` (used to regenerate an answer)."""
+    result = await db.execute(
+        select(models.Message.id)
+        .where(models.Message.chat_id == chat_id, models.Message.id > message_id)
+    )
+    message_ids = list(result.scalars().all())
+    if message_ids:
+        # Links in message_file_link first: the ORM cascade is not used for a bulk delete
+        await db.execute(
+            delete(models.message_file_link_table)
+            .where(models.message_file_link_table.c.message_id.in_(message_ids))
+        )
+        await db.execute(
+            delete(models.Message)
+            .where(models.Message.id.in_(message_ids))
+            .execution_options(synchronize_session=False)
+        )
+    db_chat = await get_chat(db, chat_id)
+    if db_chat is not None and (db_chat.summary_upto_message_id or 0) > message_id:
+        # The summary covers deleted messages; it is rebuilt on a later turn
+        db_chat.summary = None
+        db_chat.summary_upto_message_id = None
+    await db.commit()
+    prompt_context_cache.invalidate(chat_id)
+    deleted = len(message_ids)
+    logger.info(f"Deleted {deleted} messages after message ID {message_id} in chat ID {chat_id}")
+    return deleted
+
+async def _files_by_id(db: AsyncSession, file_ids) -> dict:
+    if not file_ids:
+        return {}
+    result = await db.execute(select(models.FileMetadata).where(models.FileMetadata.id.in_(set(file_ids))))
+    return {fm.id: fm for fm in result.scalars().all()}
+
+def _new_message(chat_id: int, role: str, content: str, file_ids, files: dict, **fields) -> models.Message:
+    # A new object starts with an empty, loaded ``files`` collection: no lazy load
+    db_message = models.Message(chat_id=chat_id, role=role, content=content, files=[], **fields)
+    for file_id in file_ids or []:
+        if file_id in files:
+            db_message.files.append(files[file_id])
+        else:
+            logger.warning(f"FileMetadata with id {file_id} not found. Cannot link to message.")
+    return db_message
+
+async def create_chat_message(
+    db: AsyncSession,
+    chat_id: int,
+    role: str,
+    content: str,
+    file_ids: Optional[List[str]] = None
+) -> models.Message:
+    """Create a new message, and if file_ids are provided, link them.
+       Assumes file_ids refer to existing FileMetadata entries.
+    """
+    db_message = _new_message(chat_id, role, content, file_ids, await _files_by_id(db, file_ids))
+    db.add(db_message)
+    await db.commit()
+    return db_message
+
+async def add_chat_messages(db: AsyncSession, messages: Sequence[Any]) -> List[models.Message]:
+    """
+    Add several messages (objects with chat_id, role, content, file_ids, timestamp, status) and
+    their file links in the current transaction, with one lookup for all files.
+    The rows are flushed, so they have ids, but not committed.
+    """
+    files = await _files_by_id(db, [file_id for message in messages for file_id in message.file_ids])
+    rows = [
+        _new_message(
+            message.chat_id, message.role, message.content, message.file_ids, files,
+            timestamp=message.timestamp, status=message.status,
+        )
+        for message in messages
+    ]
+    db.add_all(rows)
+    await db.flush()
+    return rows
+
+async def update_message_content(db: AsyncSession, message_id: int, content: str, status: str) -> Optional[models.Message]:
+    """Rewrite a message's content and status in the current transaction (partial answers being saved)."""
+    db_message = await db.get(models.Message, message_id)
+    if db_message is None:
+        # Deleted meanwhile (chat removed, answer regenerated)
+        return None
+    db_message.content = content
+    db_message.status = status
+    await db.flush()
+    return db_message
+
+async def create_chat_message_with_files(
+    db: AsyncSession,
+    message_data: schemas.MessageCreate,
+    chat_id: int,
+    file_metadatas: Optional[List[Any]] = None
+) -> models.Message:
+    """
+    Create a new message and link it to file metadata entries
+    (dicts with an 'id' key, or FileMetadata objects).
+    """
+    file_ids = [
+        file_meta.get('id') if isinstance(file_meta, dict) else file_meta.id
+        for file_meta in file_metadatas or []
+    ]
+    file_ids = [file_id for file_id in file_ids if file_id]
+    db_message = _new_message(
+        chat_id, message_data.role, message_data.content, file_ids, await _files_by_id(db, file_ids)
+    )
+    db.add(db_message)
+    await db.commit()
+    return db_message
+
+# CRUD operations for GeminiFile
+
+async def get_expired_gemini_files_from_metadata(db: AsyncSession) -> List[models.FileMetadata]:
+    """Retrieve all FileMetadata records where the Gemini file has expired."""
+    return await file_crud.get_expired_gemini_files(db)
@@ -1,10 +1,12 @@
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Any, List, Optional, Sequence
 from datetime import datetime
 import logging
 
 from .. import models, schemas
 from . import file_crud
+from ..context import prompt_context_cache
 
 logger = logging.getLogger(__name__)
 
@@ -64,9 +66,23 @@ def delete_chat(db: Session, chat_id: int, user_id: int = None) -> Optional[mode
         # (handled by background tasks in file_router or a dedicated service)
         db.delete(db_chat) # Cascade will delete messages, and relationship to message_file_link_table
         db.commit()
+        prompt_context_cache.invalidate(chat_id)
         logger.info(f"Deleted chat ID {chat_id} and all its messages and file links")
     return db_chat
 
+def update_chat_summary(db: Session, chat_id: int, summary: str, upto_message_id: int) -> Optional[models.Chat]:
+    """Store the rolling summary of a chat, unless a summary covering more messages is already stored."""
+    db_chat = get_chat(db, chat_id)
+    if db_chat is None:
+        return None
+    if (db_chat.summary_upto_message_id or 0) >= upto_message_id:
+        return db_chat
+    db_chat.summary = summary
+    db_chat.summary_upto_message_id = upto_message_id
+    db.commit()
+    db.refresh(db_chat)
+    return db_chat
+
 # CRUD operations for Message
 
 def get_messages_for_chat(db: Session, chat_id: int, skip: int = 0, limit: int = 1000, exclude_message_id: Optional[int] = None) -> List[models.Message]:
@@ -84,6 +100,64 @@ def get_messages_for_chat(db: Session, chat_id: int, skip: int = 0, limit: int =
               .limit(limit)\
               .all()
 
+def get_messages_for_chat_after(db: Session, chat_id: int, after_message_id: int) -> List[models.Message]:
+    """Retrieve the messages of a chat created after ``after_message_id`` (incremental context loading)."""
+    return db.query(models.Message)\
+             .filter(models.Message.chat_id == chat_id, models.Message.id > after_message_id)\
+             .order_by(models.Message.id)\
+             .all()
+
+def count_messages_up_to(db: Session, chat_id: int, message_id: int) -> int:
+    """Number of messages of a chat with an id up to ``message_id``; detects deletions behind a cached context."""
+    return db.query(func.count(models.Message.id))\
+             .filter(models.Message.chat_id == chat_id, models.Message.id <= message_id)\
+             .scalar()
+
+def count_messages_for_chat(db: Session, chat_id: int, exclude_message_id: Optional[int] = None) -> int:
+    """Number of messages in a chat, optionally not counting one of them (e.g. the message being answered)."""
+    query = db.query(func.count(models.Message.id))\
+              .filter(models.Message.chat_id == chat_id)
+    if exclude_message_id is not None:
+        query = query.filter(models.Message.id != exclude_message_id)
+    return query.scalar()
+
+def get_message(db: Session, message_id: int) -> Optional[models.Message]:
+    """Retrieve a single message by its ID."""
+    return db.query(models.Message).filter(models.Message.id == message_id).first()
+
+def get_last_message(db: Session, chat_id: int) -> Optional[models.Message]:
+    """Retrieve the most recent message of a chat."""
+    return db.query(models.Message)\
+             .filter(models.Message.chat_id == chat_id)\
+             .order_by(models.Message.timestamp.desc(), models.Message.id.desc())\
+             .first()
+
+def get_last_user_message(db: Session, chat_id: int) -> Optional[models.Message]:
+    """Retrieve the most recent user message of a chat."""
+    return db.query(models.Message)\
+             .filter(models.Message.chat_id == chat_id, models.Message.role == "user")\
+             .order_by(models.Message.timestamp.desc(), models.Message.id.desc())\
+             .first()
+
+def delete_messages_after(db: Session, chat_id: int, message_id: int) -> int:
+    """Delete every message of a chat that was created after ``message_id`` (used to regenerate an answer)."""
+    messages = db.query(models.Message)\
+                 .filter(models.Message.chat_id == chat_id, models.Message.id > message_id)\
+                 .all()
+    # Delete through the ORM so links in message_file_link are removed as well
+    for message in messages:
+        db.delete(message)
+    db_chat = get_chat(db, chat_id)
+    if db_chat is not None and (db_chat.summary_upto_message_id or 0) > message_id:
+        # The summary covers deleted messages; it is rebuilt on a later turn
+        db_chat.summary = None
+        db_chat.summary_upto_message_id = None
+    db.commit()
+    prompt_context_cache.invalidate(chat_id)
+    deleted = len(messages)
+    logger.info(f"Deleted {deleted} messages after message ID {message_id} in chat ID {chat_id}")
+    return deleted
+
 # This will be the primary way to create messages, including those with files.
 def create_chat_message(
     db: Session, 
@@ -111,6 +185,45 @@ def create_chat_message(
     db.refresh(db_message)
     return db_message
 
+def add_chat_messages(db: Session, messages: Sequence[Any]) -> List[models.Message]:
+    """
+    Add several messages (objects with chat_id, role, content, file_ids, timestamp, status) and
+    their file links in the current transaction, with one lookup for all files.
+    The rows are flushed, so they have ids, but not committed.
+    """
+    file_ids = {file_id for message in messages for file_id in message.file_ids}
+    files = {}
+    if file_ids:
+        files = {
+            fm.id: fm for fm in db.query(models.FileMetadata).filter(models.FileMetadata.id.in_(file_ids)).all()
+        }
+    rows = []
+    for message in messages:
+        row = models.Message(
+            chat_id=message.chat_id, role=message.role, content=message.content,
+            timestamp=message.timestamp, status=message.status
+        )
+        for file_id in message.file_ids:
+            if file_id in files:
+                row.files.append(files[file_id])
+            else:
+                logger.warning(f"FileMetadata with id {file_id} not found. Cannot link to message.")
+        db.add(row)
+        rows.append(row)
+    db.flush()
+    return rows
+
+def update_message_content(db: Session, message_id: int, content: str, status: str) -> Optional[models.Message]:
+    """Rewrite a message's content and status in the current transaction (partial answers being saved)."""
+    db_message = db.query(models.Message).filter(models.Message.id == message_id).first()
+    if db_message is None:
+        # Deleted meanwhile (chat removed, answer regenerated)
+        return None
+    db_message.content = content
+    db_message.status = status
+    db.flush()
+    return db_message
+
 def create_chat_message_with_files(
     db: Session, 
     message_data: schemas.MessageCreate, 
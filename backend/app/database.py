@@ -1,7 +1,11 @@
 from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -30,15 +34,112 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine on the same database, for code running on the event loop
+# (async endpoints, pipelines). The sync engine stays for db_manager.py,
+# migrations, sync endpoints and worker threads.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+def async_database_url(url: str) -> str:
+    """The same database URL with its asyncio driver (aiosqlite / asyncpg)."""
+    scheme, separator, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + separator + rest
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_database_url(DATABASE_URL)
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_pre_ping=True,
+    pool_recycle=1800
+)
+
+# expire_on_commit=False: attributes read after a commit must not trigger IO.
+# Long-running work (generations) opens one of these around each DB touch
+# (`async with AsyncSessionLocal() as db:`) instead of holding a session:
+# the connection goes back to the pool as soon as the block ends, and the
+# loaded objects stay readable after it.
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 # Add SQLite specific configurations to ensure proper auto-increment behavior
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
 if DATABASE_URL.startswith("sqlite"):
-    @event.listens_for(engine, "connect")
-    def set_sqlite_pragma(dbapi_connection, connection_record):
-        cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
+    event.listen(engine, "connect", set_sqlite_pragma)
+
+if ASYNC_DATABASE_URL.startswith("sqlite"):
+    # Async engines emit connection events on their sync facade
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragma)
+
+class PoolMonitor:
+    """Connection checkouts of an engine's pool and how long they were held, for /ops/db-pool."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.total_hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is None:
+            return
+        held = time.monotonic() - checked_out_at
+        with self._lock:
+            self.checked_out -= 1
+            self.total_hold_seconds += held
+            self.max_hold_seconds = max(self.max_hold_seconds, held)
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        size = overflow = capacity = None
+        if isinstance(pool, QueuePool):
+            size = pool.size()
+            overflow = pool.overflow()
+            # max_overflow -1: no limit
+            if pool._max_overflow >= 0:
+                capacity = size + pool._max_overflow
+        released = self.checkouts - self.checked_out
+        return {
+            "pool": type(pool).__name__,
+            "size": size,
+            "overflow": overflow,
+            "checked_out": self.checked_out,
+            "utilization": self.checked_out / capacity if capacity else None,
+            "peak_checked_out": self.peak_checked_out,
+            "checkouts": self.checkouts,
+            "avg_hold_ms": self.total_hold_seconds * 1000 / released if released else 0.0,
+            "max_hold_seconds": self.max_hold_seconds,
+        }
+
+pool_monitors = {
+    "sync": PoolMonitor(engine),
+    # Pool events of an async engine are emitted on its sync facade
+    "async": PoolMonitor(async_engine.sync_engine),
+}
+
+def pool_stats() -> dict:
+    return {name: monitor.stats() for name, monitor in pool_monitors.items()}
 
 # Dependency to get DB session
 def get_db():
@@ -49,4 +150,13 @@ def get_db():
         db.rollback()
         raise # Re-raise the exception to be handled by FastAPI
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Dependency to get an async DB session (async endpoints)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
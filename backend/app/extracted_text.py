@@ -0,0 +1,140 @@
+"""
+Extracted-text store for text attachments (.txt, .docx).
+
+The text of an attachment is extracted once (at upload, or lazily the first
+time an older file is used) and written content-addressed to
+``{upload_dir}/extracted/{sha256}.txt``. ``FileMetadata`` keeps the hash and
+the character/token counts, so the pipelines and ``/files/process-file``
+read plain text instead of re-parsing the DOCX on every turn.
+"""
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .attachment_io import attachment_io
+from .config import get_settings
+from .database import AsyncSessionLocal
+from .models import FileMetadata
+from .utils import str_token_counter
+
+logger = logging.getLogger(__name__)
+
+TEXT_CONTENT_TYPE = 'text/plain'
+DOCX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+TEXT_CONTENT_TYPES = (TEXT_CONTENT_TYPE, DOCX_CONTENT_TYPE)
+
+
+def is_text_attachment(content_type: Optional[str]) -> bool:
+    return content_type in TEXT_CONTENT_TYPES
+
+
+def _store_dir() -> Path:
+    path = Path(get_settings().upload_dir) / "extracted"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _store_path(sha256: str) -> Path:
+    return _store_dir() / f"{sha256}.txt"
+
+
+def extract_text(local_disk_path: str, content_type: str) -> str:
+    """Extract the text of a .txt or .docx file (the slow path this store avoids)."""
+    if content_type == DOCX_CONTENT_TYPE:
+        # Imported here: services imports this module
+        from .services import extract_text_from_docx
+        return extract_text_from_docx(local_disk_path)
+    with open(local_disk_path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def _write_store(text: str) -> Tuple[str, int, Optional[int]]:
+    """Write ``text`` to the store; returns its hash, character count and token count."""
+    data = text.encode('utf-8')
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = _store_path(sha256)
+    if not path.exists():
+        # Write-then-rename so a concurrent reader never sees a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    try:
+        token_count = str_token_counter(text)
+    except Exception as e:
+        logger.warning(f"Could not count tokens of {sha256}: {e}")
+        token_count = None
+    return sha256, len(text), token_count
+
+
+def _record(fm: FileMetadata, stored: Tuple[str, int, Optional[int]]) -> None:
+    fm.extracted_text_sha256, fm.extracted_char_count, fm.extracted_token_count = stored
+
+
+def _read_or_extract(fm: FileMetadata) -> Tuple[Optional[str], bool]:
+    """(text, True if it was just extracted and must be stored); (None, False) when unavailable."""
+    if fm.extracted_text_sha256:
+        path = _store_path(fm.extracted_text_sha256)
+        if path.exists():
+            return path.read_text(encoding='utf-8'), False
+        logger.warning(f"Extracted text {fm.extracted_text_sha256} of file {fm.id} is missing, re-extracting")
+    if not fm.local_disk_path or not os.path.exists(fm.local_disk_path):
+        return None, False
+    # Files uploaded before the store existed are backfilled here
+    text = extract_text(fm.local_disk_path, fm.content_type)
+    # Do not persist extraction failures; the next turn retries
+    return text, not text.startswith('[Error')
+
+
+def save_extracted_text(db: Session, fm: FileMetadata, text: str) -> str:
+    """Store ``text`` for ``fm`` and record its hash and counts on the metadata row."""
+    _record(fm, _write_store(text))
+    db.commit()
+    return text
+
+
+def get_extracted_text(db: Session, fm: FileMetadata) -> Optional[str]:
+    """
+    Text of a text attachment, extracting and storing it on first use.
+
+    Returns None for non-text attachments or when the source file is gone.
+    """
+    if not is_text_attachment(fm.content_type):
+        return None
+    text, extracted = _read_or_extract(fm)
+    if extracted:
+        return save_extracted_text(db, fm, text)
+    return text
+
+
+async def save_extracted_text_async(db: AsyncSession, fm: FileMetadata, text: str) -> str:
+    """``save_extracted_text`` for an ``AsyncSession``; the file is written on the attachment thread pool."""
+    _record(fm, await attachment_io.run(_write_store, text))
+    await db.commit()
+    return text
+
+
+async def get_extracted_text_async(fm: FileMetadata, db: Optional[AsyncSession] = None) -> Optional[str]:
+    """
+    ``get_extracted_text`` for an ``AsyncSession``; reading and extraction run on the attachment thread pool.
+
+    Without ``db`` (``fm`` loaded by a session that is already closed), a
+    backfilled text is recorded in a short session of its own.
+    """
+    if not is_text_attachment(fm.content_type):
+        return None
+    text, extracted = await attachment_io.run(_read_or_extract, fm)
+    if not extracted:
+        return text
+    if db is not None:
+        return await save_extracted_text_async(db, fm, text)
+    _record(fm, await attachment_io.run(_write_store, text))
+    async with AsyncSessionLocal() as own_db:
+        await own_db.merge(fm)
+        await own_db.commit()
+    return text
@@ -0,0 +1,54 @@
+# Lớp bao quanh các lời gọi LLM (cache câu trả lời, hedging, ...) dùng chung cho các pipeline
+from .answer_cache import (
+    AnswerProbe,
+    CachedAnswer,
+    SemanticAnswerCache,
+    answer_cache,
+    normalize_question
+)
+from .hedging import (
+    Hedger,
+    hedger
+)
+from .pacer import (
+    Pacing,
+    UpstreamPacer,
+    gemini_pacer
+)
+from .resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Resilience,
+    is_retryable,
+    resilience
+)
+from .singleflight import (
+    Flight,
+    SingleFlight,
+    attachment_fingerprint,
+    flight_key,
+    single_flight
+)
+
+__all__ = [
+    'AnswerProbe',
+    'CachedAnswer',
+    'SemanticAnswerCache',
+    'answer_cache',
+    'normalize_question',
+    'Hedger',
+    'hedger',
+    'Pacing',
+    'UpstreamPacer',
+    'gemini_pacer',
+    'CircuitBreaker',
+    'CircuitOpenError',
+    'Resilience',
+    'is_retryable',
+    'resilience',
+    'Flight',
+    'SingleFlight',
+    'attachment_fingerprint',
+    'flight_key',
+    'single_flight'
+]
@@ -0,0 +1,230 @@
+"""
+Semantic cache of answers to standalone questions.
+
+Students ask the same textbook and competition problems again and again. A
+question that opens a chat (no earlier messages, no attachments) is normalized
+(Unicode form, whitespace, spacing inside LaTeX; case is kept, "A" and "a" are
+different matrices), embedded with Gemini and looked up
+per pipeline namespace: first by exact normalized text, then by cosine
+similarity against a local in-memory index. A hit above
+``ANSWER_CACHE_SIMILARITY`` is streamed back without calling the pipeline.
+Entries expire after ``ANSWER_CACHE_TTL_SECONDS`` and the least recently used
+are evicted beyond ``ANSWER_CACHE_MAX_ENTRIES`` (per worker process).
+"""
+
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from ..config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# An embedding slower than this is skipped; the lookup falls back to the exact match
+EMBED_TIMEOUT_SECONDS = 2.0
+# Shorter questions ("hi", "tiếp") are never cached
+MIN_QUESTION_CHARS = 20
+
+_WHITESPACE = re.compile(r"\s+")
+# Spacing around LaTeX and arithmetic punctuation does not change a problem
+_LATEX_SPACING = re.compile(r"\s*([{}()\[\]^_=+\-*/,;:<>|&$])\s*|\s+(?=\\)")
+_DISPLAY_MATH = re.compile(r"\$\$|\\\[|\\\]|\\\(|\\\)")
+
+
+def normalize_question(text: str) -> str:
+    """Canonical form of a question: NFC, single spaces, no spaces around LaTeX symbols; case is kept."""
+    text = unicodedata.normalize("NFC", text or "")
+    text = _DISPLAY_MATH.sub("$", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    # Spaces after a LaTeX command are kept: "\lambda x" is not "\lambdax"
+    return _LATEX_SPACING.sub(r"\1", text)
+
+
+class CachedAnswer:
+    __slots__ = ("namespace", "key", "embedding", "content", "artifacts", "created_at", "hits")
+
+    def __init__(self, namespace: str, key: str, embedding: Optional[np.ndarray], content: str, artifacts: List[Any]):
+        self.namespace = namespace
+        self.key = key
+        self.embedding = embedding
+        self.content = content
+        self.artifacts = artifacts
+        self.created_at = time.monotonic()
+        self.hits = 0
+
+
+class AnswerProbe(NamedTuple):
+    """A looked-up question, kept to store the answer without embedding it again."""
+    namespace: str
+    key: str
+    embedding: Optional[np.ndarray]
+
+
+class _Namespace:
+    """Entries of one pipeline with a lazily rebuilt similarity matrix."""
+
+    def __init__(self):
+        self.entries: Dict[str, CachedAnswer] = {}
+        self._matrix: Optional[np.ndarray] = None
+        self._keys: List[str] = []
+        self._dirty = True
+
+    def add(self, entry: CachedAnswer) -> None:
+        self.entries[entry.key] = entry
+        self._dirty = True
+
+    def remove(self, key: str) -> None:
+        if self.entries.pop(key, None) is not None:
+            self._dirty = True
+
+    def nearest(self, embedding: np.ndarray) -> Tuple[Optional[CachedAnswer], float]:
+        if self._dirty:
+            self._keys = [key for key, entry in self.entries.items() if entry.embedding is not None]
+            self._matrix = np.stack([self.entries[key].embedding for key in self._keys]) if self._keys else None
+            self._dirty = False
+        if self._matrix is None:
+            return None, 0.0
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        return self.entries[self._keys[best]], float(scores[best])
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[int] = None,
+        similarity: Optional[float] = None,
+    ):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._similarity = similarity
+        # LRU order over all namespaces, keyed by (namespace, normalized question)
+        self._lru: "OrderedDict[Tuple[str, str], CachedAnswer]" = OrderedDict()
+        self._namespaces: Dict[str, _Namespace] = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.embedding_errors = 0
+
+    @property
+    def max_entries(self) -> int:
+        return self._max_entries if self._max_entries is not None else get_settings().answer_cache_max_entries
+
+    @property
+    def ttl_seconds(self) -> int:
+        return self._ttl_seconds if self._ttl_seconds is not None else get_settings().answer_cache_ttl_seconds
+
+    @property
+    def similarity(self) -> float:
+        return self._similarity if self._similarity is not None else get_settings().answer_cache_similarity
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def eligible(self, question: str) -> bool:
+        return self.enabled and len(normalize_question(question)) >= MIN_QUESTION_CHARS
+
+    async def _embed(self, client, text: str) -> Optional[np.ndarray]:
+        if client is None:
+            return None
+        try:
+            result = await asyncio.wait_for(
+                client.aio.models.embed_content(
+                    model=get_settings().answer_cache_embedding_model, contents=text
+                ),
+                timeout=EMBED_TIMEOUT_SECONDS,
+            )
+            vector = np.asarray(result.embeddings[0].values, dtype=np.float32)
+        except Exception as e:
+            self.embedding_errors += 1
+            logger.warning(f"Answer cache embedding failed, using exact matches only: {e}")
+            return None
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    async def lookup(self, namespace: str, question: str, client) -> Tuple[Optional[CachedAnswer], AnswerProbe]:
+        """Cached answer for ``question`` (or None) and the probe to store a fresh answer with."""
+        key = normalize_question(question)
+        entry = self._live(namespace, key)
+        if entry is not None:
+            self.exact_hits += 1
+            return self._hit(entry), AnswerProbe(namespace, key, entry.embedding)
+
+        embedding = await self._embed(client, key)
+        probe = AnswerProbe(namespace, key, embedding)
+        space = self._namespaces.get(namespace)
+        if embedding is not None and space is not None:
+            entry, score = space.nearest(embedding)
+            if entry is not None and score >= self.similarity and self._live(namespace, entry.key) is not None:
+                self.semantic_hits += 1
+                logger.info(f"Answer cache hit in '{namespace}' (similarity {score:.3f})")
+                return self._hit(entry), probe
+        self.misses += 1
+        return None, probe
+
+    def store(self, probe: AnswerProbe, content: str, artifacts: Optional[List[Any]] = None) -> None:
+        if not self.enabled or not content:
+            return
+        self._remove((probe.namespace, probe.key))
+        entry = CachedAnswer(probe.namespace, probe.key, probe.embedding, content, list(artifacts or []))
+        self._lru[(probe.namespace, probe.key)] = entry
+        self._namespaces.setdefault(probe.namespace, _Namespace()).add(entry)
+        self.stores += 1
+        while len(self._lru) > self.max_entries:
+            lru_key, _ = next(iter(self._lru.items()))
+            self._remove(lru_key)
+            self.evictions += 1
+
+    def _live(self, namespace: str, key: str) -> Optional[CachedAnswer]:
+        entry = self._lru.get((namespace, key))
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl_seconds:
+            self._remove((namespace, key))
+            self.expirations += 1
+            return None
+        return entry
+
+    def _hit(self, entry: CachedAnswer) -> CachedAnswer:
+        entry.hits += 1
+        self._lru.move_to_end((entry.namespace, entry.key))
+        return entry
+
+    def _remove(self, lru_key: Tuple[str, str]) -> None:
+        if self._lru.pop(lru_key, None) is not None:
+            self._namespaces[lru_key[0]].remove(lru_key[1])
+
+    def clear(self) -> None:
+        self._lru.clear()
+        self._namespaces.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "namespaces": {name: len(space.entries) for name, space in self._namespaces.items()},
+            "max_entries": self.max_entries,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "embedding_errors": self.embedding_errors,
+        }
+
+
+answer_cache = SemanticAnswerCache()
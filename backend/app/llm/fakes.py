@@ -0,0 +1,51 @@
+"""
+Scripted fake LLM providers for exercising the streaming wrappers offline.
+
+A ``FakeProvider`` streams fixed chunks with a configurable delay before the
+first chunk and between chunks, can fail instead of answering, and records
+whether its stream was started, finished or cancelled (see
+tests/test_hedging.py).
+"""
+
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+
+class FakeProviderError(Exception):
+    pass
+
+
+class FakeProvider:
+    def __init__(
+        self,
+        name: str,
+        chunks: Optional[List[str]] = None,
+        first_chunk_delay: float = 0.0,
+        chunk_delay: float = 0.0,
+        fail_after: Optional[float] = None,
+    ):
+        self.name = name
+        self.chunks = chunks if chunks is not None else [f"answer from {name}"]
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.fail_after = fail_after
+        self.started = 0
+        self.finished = 0
+        self.cancelled = 0
+
+    async def stream(self) -> AsyncIterator[str]:
+        self.started += 1
+        try:
+            if self.fail_after is not None:
+                await asyncio.sleep(self.fail_after)
+                raise FakeProviderError(f"{self.name} failed")
+            await asyncio.sleep(self.first_chunk_delay)
+            for i, chunk in enumerate(self.chunks):
+                if i:
+                    await asyncio.sleep(self.chunk_delay)
+                yield chunk
+            self.finished += 1
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
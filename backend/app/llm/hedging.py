@@ -0,0 +1,152 @@
+"""
+Hedged LLM streams.
+
+Gemini's time to first chunk has a long tail. ``Hedger.stream`` starts the
+primary stream and, if no chunk has arrived after the hedge delay (a fixed
+``LLM_HEDGE_AFTER_MS`` or the rolling p95 of observed first-chunk latencies),
+starts the secondary stream as well. Whichever produces a first chunk wins;
+the other is cancelled and closed, so at most one answer reaches the client.
+A primary that fails before its first chunk fails over to the secondary at
+once. ``app/llm/fakes.py`` has scripted providers to exercise this offline.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+from ..config import get_settings
+
+logger = logging.getLogger(__name__)
+
+StreamFactory = Callable[[], AsyncIterator[str]]
+
+PRIMARY = "primary"
+SECONDARY = "secondary"
+
+# First-chunk latencies kept for the p95 estimate
+LATENCY_WINDOW = 200
+# Below this many samples the p95 is not trusted and DEFAULT_HEDGE_AFTER is used
+MIN_SAMPLES = 20
+DEFAULT_HEDGE_AFTER = 5.0
+# Never hedge sooner than this, however fast the primary usually is
+MIN_HEDGE_AFTER = 0.5
+
+_NOTHING = object()
+
+
+class Hedger:
+    def __init__(self, hedge_after_ms: Optional[int] = None):
+        self._hedge_after_ms = hedge_after_ms
+        self._latencies: deque = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.hedged = 0
+        self.failovers = 0
+        self.secondary_wins = 0
+        self.failures = 0
+
+    def hedge_after(self) -> float:
+        """Seconds to wait for the primary's first chunk before hedging."""
+        hedge_after_ms = self._hedge_after_ms if self._hedge_after_ms is not None else get_settings().llm_hedge_after_ms
+        if hedge_after_ms > 0:
+            return hedge_after_ms / 1000
+        if len(self._latencies) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_AFTER
+        ordered = sorted(self._latencies)
+        return max(MIN_HEDGE_AFTER, ordered[int(len(ordered) * 0.95) - 1])
+
+    async def stream(
+        self, primary: StreamFactory, secondary: Optional[StreamFactory] = None
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """Yield ``(source, text)`` from whichever of the two streams starts first."""
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        streams: Dict[str, AsyncIterator[str]] = {}
+        pending: Dict[asyncio.Future, str] = {}
+
+        def start(name: str, factory: StreamFactory) -> None:
+            stream = factory()
+            streams[name] = stream
+            pending[asyncio.ensure_future(stream.__anext__())] = name
+
+        winner = None
+        first = _NOTHING
+        last_error: Optional[BaseException] = None
+        try:
+            start(PRIMARY, primary)
+            timeout = self.hedge_after() if secondary is not None else None
+            while winner is None:
+                if not pending:
+                    self.failures += 1
+                    raise last_error or RuntimeError("No LLM stream produced a response")
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The primary is slower than the hedge delay: race the secondary against it
+                    timeout = None
+                    self.hedged += 1
+                    logger.info(f"No first chunk after {loop.time() - started:.2f}s, hedging with the secondary model")
+                    start(SECONDARY, secondary)
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        text = task.result()
+                    except StopAsyncIteration:
+                        text = _NOTHING
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"{name} LLM stream failed before its first chunk: {e}")
+                        if name == PRIMARY and secondary is not None and SECONDARY not in streams:
+                            timeout = None
+                            self.failovers += 1
+                            start(SECONDARY, secondary)
+                        continue
+                    if winner is None:
+                        winner, first = name, text
+
+            if winner == PRIMARY:
+                self._latencies.append(loop.time() - started)
+            else:
+                self.secondary_wins += 1
+            # Stop the loser before streaming on, so it never holds a connection
+            for name in list(streams):
+                if name != winner:
+                    await self._close(streams.pop(name), pending)
+            if first is _NOTHING:
+                return
+            yield winner, first
+            async for text in streams[winner]:
+                yield winner, text
+        finally:
+            for stream in streams.values():
+                await self._close(stream, pending)
+
+    @staticmethod
+    async def _close(stream: AsyncIterator[str], pending: Dict[asyncio.Future, str]) -> None:
+        for task in [task for task in pending if not task.done()]:
+            task.cancel()
+        if pending:
+            # A generator cannot be closed while its __anext__ is still running
+            await asyncio.gather(*pending, return_exceptions=True)
+            pending.clear()
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                logger.debug(f"Error closing LLM stream: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "secondary_wins": self.secondary_wins,
+            "failures": self.failures,
+            "hedge_after_ms": self.hedge_after() * 1000,
+            "latency_samples": len(self._latencies),
+        }
+
+
+hedger = Hedger()
@@ -0,0 +1,139 @@
+"""
+Process-wide pacing of Gemini calls against the project's RPM/TPM quota.
+
+Gemini rejects calls over the per-minute request and token limits with
+RESOURCE_EXHAUSTED, which ``handle_gemini_error`` can only turn into a 429
+after the call has been wasted. ``UpstreamPacer.acquire`` keeps a request and
+a token bucket for ``GEMINI_RPM_LIMIT`` / ``GEMINI_TPM_LIMIT`` and delays each
+call just long enough for both to cover it. Reservations are taken in arrival
+order (a bucket may go into debt), so a burst is spread out instead of failing.
+
+Each bucket holds ``BURST_SHARE`` of the limit and refills with the rest over
+a minute, so no sliding minute ever exceeds the limit. The token estimate of a
+call is replaced by the usage Gemini reports once it is done.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from ..config import get_settings
+from ..streaming.quotas import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Share of the per-minute limit that may be sent at once
+BURST_SHARE = 0.1
+
+
+class Pacing:
+    """Tokens reserved for one upstream call."""
+
+    def __init__(self, pacer: "UpstreamPacer", tokens: int, delay: float):
+        self._pacer = pacer
+        self.tokens = tokens
+        self.delay = delay
+        self.settled = False
+
+    def settle(self, used_tokens: Optional[int]) -> None:
+        """Replace the estimate by the token count Gemini reported (ignored if unknown)."""
+        if self.settled or not used_tokens:
+            return
+        self.settled = True
+        self._pacer._adjust(self.tokens - used_tokens)
+
+
+class UpstreamPacer:
+    def __init__(self, rpm_limit: Optional[int] = None, tpm_limit: Optional[int] = None):
+        self._rpm_limit = rpm_limit
+        self._tpm_limit = tpm_limit
+        self._limits = None
+        self._requests: Optional[TokenBucket] = None
+        self._tokens: Optional[TokenBucket] = None
+        self.calls = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    @property
+    def rpm_limit(self) -> int:
+        return self._rpm_limit if self._rpm_limit is not None else get_settings().gemini_rpm_limit
+
+    @property
+    def tpm_limit(self) -> int:
+        return self._tpm_limit if self._tpm_limit is not None else get_settings().gemini_tpm_limit
+
+    def _buckets(self, now: float):
+        limits = (self.rpm_limit, self.tpm_limit)
+        if limits != self._limits:
+            # Limits changed (settings reload): start again from full buckets
+            self._limits = limits
+            self._requests = self._bucket(limits[0], now)
+            self._tokens = self._bucket(limits[1], now)
+        return self._requests, self._tokens
+
+    @staticmethod
+    def _bucket(limit: int, now: float) -> Optional[TokenBucket]:
+        if limit <= 0:
+            return None
+        return TokenBucket(max(1.0, limit * BURST_SHARE), limit * (1 - BURST_SHARE) / 60, now)
+
+    def reserve(self, tokens: int) -> Pacing:
+        """Reserve one request and ``tokens`` now; the returned pacing says how long to wait."""
+        now = time.monotonic()
+        delay = 0.0
+        for bucket, amount in zip(self._buckets(now), (1, tokens)):
+            if bucket is None:
+                continue
+            bucket.refill(now)
+            # A call larger than the whole burst waits for the bucket to be full, not forever
+            delay = max(delay, bucket.seconds_until(min(amount, bucket.capacity)))
+            bucket.tokens -= amount
+        self.calls += 1
+        if delay > 0:
+            self.delayed += 1
+            self.total_delay += delay
+            self.max_delay = max(self.max_delay, delay)
+        return Pacing(self, tokens, delay)
+
+    async def acquire(self, tokens: int) -> Pacing:
+        """Wait until one more call of about ``tokens`` tokens fits under the quota."""
+        pacing = self.reserve(tokens)
+        if pacing.delay > 0:
+            logger.info(f"Pacing Gemini call of ~{tokens} tokens by {pacing.delay:.2f}s to stay under quota")
+            try:
+                await asyncio.sleep(pacing.delay)
+            except asyncio.CancelledError:
+                # The call is never made: give its reservation to the calls behind it
+                pacing.settled = True
+                self._adjust(tokens, requests=1)
+                raise
+        return pacing
+
+    def _adjust(self, tokens: int, requests: int = 0) -> None:
+        now = time.monotonic()
+        for bucket, amount in ((self._requests, requests), (self._tokens, tokens)):
+            if bucket is not None and amount:
+                bucket.refill(now)
+                bucket.tokens = min(bucket.capacity, bucket.tokens + amount)
+
+    def stats(self) -> Dict[str, Any]:
+        requests, tokens = self._buckets(time.monotonic())
+        for bucket in (requests, tokens):
+            if bucket is not None:
+                bucket.refill(time.monotonic())
+        return {
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+            # None when not paced; negative is debt: queued calls already hold the next refills
+            "request_headroom": requests.tokens if requests is not None else None,
+            "token_headroom": tokens.tokens if tokens is not None else None,
+            "calls": self.calls,
+            "delayed": self.delayed,
+            "total_delay_seconds": self.total_delay,
+            "max_delay_seconds": self.max_delay,
+        }
+
+
+gemini_pacer = UpstreamPacer()
@@ -0,0 +1,247 @@
+"""
+Retries and circuit breakers around model and vector-store calls.
+
+Every external dependency (Gemini generation, Gemini Files API, the LangChain
+chat model, the vector store) has a ``CircuitBreaker``. Calls made through
+``Resilience.call`` / ``Resilience.stream`` are retried on transient errors
+(timeouts, connection errors, 408/429/5xx) with full-jitter exponential
+backoff, up to ``LLM_RETRY_ATTEMPTS`` attempts. After
+``BREAKER_FAILURE_THRESHOLD`` consecutive transient failures the breaker opens
+and calls fail at once with ``CircuitOpenError`` for
+``BREAKER_RESET_SECONDS``; then a single probe call is let through and closes
+it again on success. A dependency outage therefore costs one fast error per
+request instead of thousands of coroutines hanging on timeouts.
+
+Streams are retried only until their first chunk: once text has reached the
+client, a failure is reported instead of starting the answer again.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from ..config import get_settings
+
+logger = logging.getLogger(__name__)
+
+GEMINI = "gemini"
+GEMINI_FILES = "gemini_files"
+CHAT_MODEL = "chat_model"
+VECTOR_STORE = "vector_store"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_STATUS_NAMES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL", "ABORTED"}
+# Transport errors of httpx / openai / qdrant clients, matched by name to avoid importing them here
+RETRYABLE_ERROR_NAMES = {
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError", "WriteTimeout", "PoolTimeout",
+    "RemoteProtocolError", "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",
+    "ServiceUnavailableError", "ResponseHandlingException",
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"{dependency} is unavailable, retry in {retry_after:.0f}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Whether ``exc`` is a transient failure worth retrying (and counting against the breaker)."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    for attr in ("code", "status_code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+            return True
+    if getattr(exc, "status", None) in RETRYABLE_STATUS_NAMES or getattr(exc, "code", None) in RETRYABLE_STATUS_NAMES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(exc).__mro__)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_seconds: Optional[int] = None):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def failure_threshold(self) -> int:
+        return self._failure_threshold if self._failure_threshold is not None else get_settings().breaker_failure_threshold
+
+    @property
+    def reset_seconds(self) -> int:
+        return self._reset_seconds if self._reset_seconds is not None else get_settings().breaker_reset_seconds
+
+    def before_call(self) -> None:
+        """Let a call through, or raise ``CircuitOpenError``."""
+        if self.state == OPEN:
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = HALF_OPEN
+            logger.info(f"Circuit breaker '{self.name}' half-open, probing")
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, 1)
+            self._probing = True
+        self.calls += 1
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"Circuit breaker '{self.name}' closed")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def record_failure(self, exc: BaseException) -> None:
+        self._probing = False
+        if not is_retryable(exc):
+            # The dependency answered (bad request, safety filter, ...): it is up
+            self.record_success()
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = f"{type(exc).__name__}: {exc}"[:300]
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened += 1
+                logger.warning(f"Circuit breaker '{self.name}' open after {self.consecutive_failures} failures: {self.last_error}")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def record_abandoned(self) -> None:
+        """The call was cancelled before the dependency answered; it says nothing about its health."""
+        self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        retry_after = max(0.0, self.opened_at + self.reset_seconds - time.monotonic()) if self.state == OPEN else 0.0
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after_seconds": retry_after,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "opened": self.opened,
+            "last_error": self.last_error,
+        }
+
+
+class Resilience:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.retries = 0
+
+    def breaker(self, dependency: str) -> CircuitBreaker:
+        breaker = self._breakers.get(dependency)
+        if breaker is None:
+            breaker = self._breakers[dependency] = CircuitBreaker(dependency)
+        return breaker
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """Full-jitter delay before retry number ``attempt`` (1-based)."""
+        settings = get_settings()
+        cap = min(settings.llm_retry_max_ms, settings.llm_retry_base_ms * 2 ** (attempt - 1)) / 1000
+        return random.uniform(0, cap)
+
+    async def _retry_or_raise(self, dependency: str, attempt: int, exc: BaseException) -> None:
+        if isinstance(exc, CircuitOpenError) or not is_retryable(exc) or attempt >= get_settings().llm_retry_attempts:
+            raise exc
+        delay = self.backoff(attempt)
+        self.retries += 1
+        logger.warning(f"{dependency} call failed ({type(exc).__name__}: {exc}), retry {attempt} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def call(self, dependency: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await ``fn()`` through the dependency's breaker, retrying transient failures."""
+        breaker = self.breaker(dependency)
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                breaker.record_abandoned()
+                raise
+            except Exception as e:
+                breaker.record_failure(e)
+                await self._retry_or_raise(dependency, attempt, e)
+                continue
+            breaker.record_success()
+            return result
+
+    async def stream(self, dependency: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Items of ``factory()``, retrying transient failures that happen before the first item."""
+        breaker = self.breaker(dependency)
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            stream = factory()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                breaker.record_success()
+                return
+            except asyncio.CancelledError:
+                breaker.record_abandoned()
+                await _aclose(stream)
+                raise
+            except Exception as e:
+                breaker.record_failure(e)
+                await _aclose(stream)
+                await self._retry_or_raise(dependency, attempt, e)
+                continue
+            break
+
+        breaker.record_success()
+        try:
+            yield first
+            async for item in stream:
+                yield item
+        except Exception as e:
+            # Too late to retry: part of the answer is already out
+            breaker.record_failure(e)
+            raise
+        finally:
+            await _aclose(stream)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "breakers": {name: breaker.stats() for name, breaker in self._breakers.items()},
+        }
+
+
+async def _aclose(stream) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        try:
+            await aclose()
+        except Exception as e:
+            logger.debug(f"Error closing stream: {e}")
+
+
+resilience = Resilience()
@@ -0,0 +1,143 @@
+"""
+Single-flight coalescing of identical concurrent prompts.
+
+When a teacher posts a problem, dozens of students paste the same text into
+new chats within seconds. Requests with the same key (pipeline, model
+settings, normalized prompt and attachment contents) that arrive while an
+upstream generation for that key is running join it instead of starting
+their own: every participant replays the flight's events into its own stream
+and persists its own copy of the answer. The upstream call belongs to the
+flight, not to the request that started it, so it is cancelled only when
+every participant has gone.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Optional, Sequence, Tuple
+
+from .answer_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Content hashes of binary attachments, by file id
+FINGERPRINT_CACHE_SIZE = 1024
+_fingerprints: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def attachment_fingerprint(fm) -> str:
+    """Content hash of an attachment, so the same file uploaded twice gives the same key."""
+    if fm.extracted_text_sha256:
+        return fm.extracted_text_sha256
+    fingerprint = _fingerprints.get(fm.id)
+    if fingerprint is None:
+        fingerprint = await asyncio.to_thread(_hash_file, fm.local_disk_path)
+        _fingerprints[fm.id] = fingerprint
+        while len(_fingerprints) > FINGERPRINT_CACHE_SIZE:
+            _fingerprints.popitem(last=False)
+    return fingerprint
+
+
+def flight_key(pipeline_type: str, model_settings: Sequence[Any], prompt: str, attachment_hashes: Sequence[str]) -> str:
+    payload = json.dumps(
+        [pipeline_type, list(model_settings), normalize_question(prompt), sorted(attachment_hashes)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """One upstream generation shared by identical requests; also the queue its pipeline writes into."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: List[Any] = []
+        self.task: Optional[asyncio.Task] = None
+        self.response: Any = None
+        # Why the upstream call failed; None when it succeeded or was cancelled
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self.subscribers = 0
+        self._wakeup = asyncio.Event()
+
+    # Same interface as StreamBuffer, which is all a pipeline uses
+    async def put(self, event: Any) -> None:
+        self.events.append(event)
+        self._notify()
+
+    async def close(self) -> None:
+        pass
+
+    def _notify(self) -> None:
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[Any]:
+        """Every event of the flight from the start, until it finishes."""
+        self.subscribers += 1
+        cursor = 0
+        try:
+            while True:
+                wakeup = self._wakeup
+                while cursor < len(self.events):
+                    cursor += 1
+                    yield self.events[cursor - 1]
+                if self.finished:
+                    return
+                await wakeup.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.task is not None and not self.task.done():
+                logger.info(f"All requests left flight {self.key[:12]}, cancelling it")
+                self.task.cancel()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str, run: Callable[[Flight], Coroutine[Any, Any, Any]]) -> Tuple[Flight, bool]:
+        """The running flight for ``key`` and True, or a new flight running ``run(flight)`` and False."""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.finished:
+            self.followers += 1
+            return flight, True
+        flight = Flight(key)
+        self._flights[key] = flight
+        flight.task = asyncio.create_task(run(flight))
+        flight.task.add_done_callback(lambda task: self._finish(flight, task))
+        self.leaders += 1
+        return flight, False
+
+    def _finish(self, flight: Flight, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is None:
+            flight.response = task.result()
+        elif not task.cancelled():
+            flight.error = task.exception()
+            logger.error(f"Flight {flight.key[:12]} failed: {flight.error}")
+        flight.finished = True
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        flight._notify()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight()
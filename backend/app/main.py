@@ -15,6 +15,10 @@ from datetime import datetime
 from .database import engine, Base
 from . import models  # noqa
 from .tasks import start_background_tasks
+from .config import get_settings
+from .strategy import pipeline_registry
+from .message_writer import message_writer
+from .attachment_io import attachment_io
 from .middleware import (
     ErrorHandlerMiddleware,
     RateLimiter,
@@ -117,18 +121,32 @@ app.add_middleware(
 def read_root():
     return {"message": "Welcome to the AI Math Chatbot API"}
 
-from .routers import chat_router, message_router, file_router, streaming_router
+from .routers import chat_router, message_router, file_router, streaming_router, ops_router, ws_router
 
 app.include_router(chat_router.router)
 app.include_router(message_router.router)
 app.include_router(file_router.router)
 app.include_router(streaming_router.router)
 app.include_router(auth_router.router)
+app.include_router(ops_router.router)
+app.include_router(ws_router.router)
 
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(start_background_tasks())
     logger.info("Background tasks started.")
+    # Dựng sẵn pipeline để request đầu tiên không phải chờ
+    warmup = [name.strip() for name in get_settings().pipeline_warmup.split(",") if name.strip()]
+    if warmup:
+        await pipeline_registry.warmup(warmup)
+        logger.info(f"Pipelines warmed up: {', '.join(warmup)}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Ghi nốt các tin nhắn còn trong hàng đợi trước khi tắt
+    await message_writer.close()
+    logger.info("Message writer flushed.")
+    attachment_io.shutdown()
 
 @app.get("/health", tags=["Health"])
 def health_check():
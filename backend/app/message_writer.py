@@ -0,0 +1,316 @@
+"""
+Write-behind persistence of chat messages.
+
+Saving a message used to cost an INSERT, a lookup per attachment, a COMMIT
+and a refresh on the event loop, before the model was even contacted.
+``MessageWriter.submit`` only queues the message and returns a
+``PendingMessage`` at once; a background task drains the queue and writes
+each batch (up to ``MESSAGE_WRITER_BATCH_SIZE`` messages, gathered for at most
+``MESSAGE_WRITER_FLUSH_MS``) in one transaction on a worker thread. One task
+writes in submission order, so the messages of a chat keep their order.
+
+Callers await ``PendingMessage.wait_id()`` only when they need the row, and
+``settled(chat_id)`` before reading a chat's history. The id of a message is
+set before its transaction commits, so a reader that sees the row can always
+tell it is the pending message.
+
+``ResponseCheckpoint`` saves an answer while it is streamed: a "partial"
+model message every ``MESSAGE_CHECKPOINT_TOKENS`` tokens or
+``MESSAGE_CHECKPOINT_INTERVAL_MS``, rewritten through the same queue
+(``update``) and marked "complete" at the end. An interrupted answer stays
+"partial" and can be continued instead of regenerated.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from . import crud
+from .config import get_settings
+from .context import prompt_context_cache
+from .context.budget import estimate_text_tokens
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Queued by ``close``: write what came before it, then stop
+_STOP = object()
+
+PARTIAL = "partial"
+COMPLETE = "complete"
+
+
+class PendingMessage:
+    """A message waiting to be written; has the fields the pipelines read from ``models.Message``."""
+
+    def __init__(
+        self, chat_id: int, role: str, content: str,
+        file_ids: Optional[Sequence[str]] = None, status: str = COMPLETE,
+    ):
+        self.chat_id = chat_id
+        self.role = role
+        self.content = content
+        self.file_ids = list(file_ids or [])
+        self.status = status
+        self.timestamp = datetime.now(timezone.utc)
+        # Set by the writer before the transaction that inserts the row commits
+        self.id: Optional[int] = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # An ``_Update`` of this message is queued and will write its latest content
+        self.update_queued = False
+
+    async def wait_id(self) -> int:
+        """Id of the row once written; raises if the write failed."""
+        return await asyncio.shield(self.future)
+
+
+class _Update:
+    """Rewrites a message with its content and status at the time the batch is written."""
+
+    __slots__ = ("message", "chat_id", "future")
+
+    def __init__(self, message: PendingMessage):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class MessageWriter:
+    def __init__(self, batch_size: Optional[int] = None, flush_ms: Optional[int] = None):
+        self._batch_size = batch_size
+        self._flush_ms = flush_ms
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Messages and updates not written yet, per chat, in submission order
+        self._pending: Dict[int, List[Union[PendingMessage, _Update]]] = {}
+        self.written = 0
+        self.updated = 0
+        self.batches = 0
+        self.failed = 0
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size if self._batch_size is not None else get_settings().message_writer_batch_size
+
+    @property
+    def flush_ms(self) -> int:
+        return self._flush_ms if self._flush_ms is not None else get_settings().message_writer_flush_ms
+
+    def submit(
+        self, chat_id: int, role: str, content: str,
+        file_ids: Optional[Sequence[str]] = None, status: str = COMPLETE,
+    ) -> PendingMessage:
+        """Queue a message for writing and return immediately."""
+        message = PendingMessage(chat_id, role, content, file_ids, status)
+        self._enqueue(message)
+        return message
+
+    def update(self, message: PendingMessage, content: str, status: str) -> None:
+        """Queue a rewrite of a submitted (or tracked) message; repeated updates coalesce into one write."""
+        message.content = content
+        message.status = status
+        if message.update_queued:
+            return
+        message.update_queued = True
+        self._enqueue(_Update(message))
+
+    @staticmethod
+    def track(chat_id: int, message_id: int, role: str, content: str, status: str) -> PendingMessage:
+        """A message already in the DB, so it can be rewritten with ``update``."""
+        message = PendingMessage(chat_id, role, content, status=status)
+        message.id = message_id
+        message.future.set_result(message_id)
+        return message
+
+    def _enqueue(self, item: Union[PendingMessage, _Update]) -> None:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        self._pending.setdefault(item.chat_id, []).append(item)
+        self._queue.put_nowait(item)
+
+    async def settled(self, chat_id: int, before: Optional[PendingMessage] = None) -> None:
+        """Wait until the chat's queued messages (only those queued before ``before``, if given) are written."""
+        waiting = []
+        for message in self._pending.get(chat_id, []):
+            if message is before:
+                break
+            waiting.append(message.future)
+        if waiting:
+            await asyncio.gather(*(asyncio.shield(future) for future in waiting), return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size - 1:
+                # Let concurrent turns add their messages to the same transaction
+                await asyncio.sleep(self.flush_ms / 1000)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = _STOP in batch
+            batch = [message for message in batch if message is not _STOP]
+            for item in batch:
+                if isinstance(item, _Update):
+                    # Content changed after this point needs another update
+                    item.message.update_queued = False
+            if batch:
+                await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[Union[PendingMessage, _Update]]) -> None:
+        try:
+            rewritten = await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            # One bad message (e.g. its chat was deleted) must not lose the others: retry one by one
+            logger.warning(f"Writing a batch of {len(batch)} messages failed ({e}); writing them one by one")
+            for item in batch:
+                try:
+                    rewritten = await asyncio.to_thread(self._write, [item])
+                except Exception as item_error:
+                    self.failed += 1
+                    message = item.message if isinstance(item, _Update) else item
+                    logger.error(f"Failed to save {message.role} message for chat {message.chat_id}: {item_error}")
+                    self._done(item, error=item_error)
+                else:
+                    self._invalidate(rewritten)
+                    self._done(item)
+            return
+        self._invalidate(rewritten)
+        self.batches += 1
+        for item in batch:
+            self._done(item)
+
+    @staticmethod
+    def _write(batch: List[Union[PendingMessage, _Update]]) -> List[Tuple[int, int]]:
+        """Write ``batch`` in one transaction; returns the (chat_id, message_id) of the rewritten messages."""
+        # Worker thread with its own session: the commit never blocks the event loop
+        inserts = [item for item in batch if isinstance(item, PendingMessage)]
+        updates = [item.message for item in batch if isinstance(item, _Update)]
+        with SessionLocal() as db:
+            rows = crud.add_chat_messages(db, inserts) if inserts else []
+            for message, row in zip(inserts, rows):
+                message.id = row.id
+            for message in updates:
+                # No id: its insert failed, there is no row to rewrite
+                if message.id is not None:
+                    crud.update_message_content(db, message.id, message.content, message.status)
+            try:
+                db.commit()
+            except Exception:
+                for message in inserts:
+                    message.id = None
+                raise
+        return [(message.chat_id, message.id) for message in updates if message.id is not None]
+
+    @staticmethod
+    def _invalidate(rewritten: List[Tuple[int, int]]) -> None:
+        # On the loop, after the commit: cached prompts must not keep the old text of a continued answer
+        for chat_id, message_id in rewritten:
+            prompt_context_cache.invalidate_message(chat_id, message_id)
+
+    def _done(self, item: Union[PendingMessage, _Update], error: Optional[BaseException] = None) -> None:
+        chat_pending = self._pending.get(item.chat_id)
+        if chat_pending is not None:
+            if item in chat_pending:
+                chat_pending.remove(item)
+            if not chat_pending:
+                del self._pending[item.chat_id]
+        if item.future.done():
+            return
+        if error is None:
+            if isinstance(item, _Update):
+                self.updated += 1
+                item.future.set_result(item.message.id)
+            else:
+                self.written += 1
+                item.future.set_result(item.id)
+        else:
+            item.future.set_exception(error)
+            # Nobody may be waiting for this id; the error is already logged
+            item.future.exception()
+
+    async def close(self) -> None:
+        """Write everything still queued and stop (on shutdown)."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(_STOP)
+        await self._task
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending_chats": len(self._pending),
+            "written": self.written,
+            "updated": self.updated,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+
+
+class ResponseCheckpoint:
+    """
+    Stream queue wrapper that saves the answer as it goes out: a "partial" model
+    message, rewritten every ``MESSAGE_CHECKPOINT_TOKENS`` tokens or
+    ``MESSAGE_CHECKPOINT_INTERVAL_MS``. ``message`` is the partial answer being
+    continued, if any; new text is appended to it.
+    """
+
+    def __init__(self, writer: MessageWriter, queue, chat_id: int, message: Optional[PendingMessage] = None):
+        self._writer = writer
+        self._queue = queue
+        self.chat_id = chat_id
+        self.message = message
+        self._prefix = message.content if message is not None else ""
+        self._parts: List[str] = []
+        self._unsaved_tokens = 0
+        self._saved_at: Optional[float] = None
+        self.finished = False
+
+    @property
+    def text(self) -> str:
+        return self._prefix + "".join(self._parts)
+
+    # Same interface as StreamBuffer, which is all a pipeline uses
+    async def put(self, event) -> None:
+        if getattr(event, "is_chunk", False) and event.text:
+            self._parts.append(event.text)
+            self._unsaved_tokens += estimate_text_tokens(event.text)
+            now = time.monotonic()
+            if self._saved_at is None:
+                self._saved_at = now
+            settings = get_settings()
+            if (
+                self._unsaved_tokens >= settings.message_checkpoint_tokens
+                or now - self._saved_at >= settings.message_checkpoint_interval_ms / 1000
+            ):
+                self._save(self.text, PARTIAL)
+        await self._queue.put(event)
+
+    async def close(self) -> None:
+        await self._queue.close()
+
+    def _save(self, content: str, status: str) -> None:
+        self._unsaved_tokens = 0
+        self._saved_at = time.monotonic()
+        if self.message is None:
+            self.message = self._writer.submit(self.chat_id, "model", content, status=status)
+        else:
+            self._writer.update(self.message, content, status)
+
+    def complete(self, content: str) -> None:
+        """Save the final answer (``content`` excludes the continued part)."""
+        self.finished = True
+        self._save(self._prefix + content, COMPLETE)
+
+    def interrupt(self) -> None:
+        """Save what was streamed so far as a partial answer (cancelled, failed)."""
+        if self.finished or not self._parts:
+            return
+        self.finished = True
+        self._save(self.text, PARTIAL)
+
+
+message_writer = MessageWriter()
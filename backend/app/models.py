@@ -21,6 +21,10 @@ class Chat(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     user = relationship("User", back_populates="chats")
 
+    # Rolling summary of the messages up to summary_upto_message_id (see app/summaries.py)
+    summary = Column(Text, nullable=True)
+    summary_upto_message_id = Column(Integer, nullable=True)
+
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
 
 class FileMetadata(Base):
@@ -38,6 +42,11 @@ class FileMetadata(Base):
     gemini_api_upload_timestamp = Column(DateTime, nullable=True)
     gemini_api_expiry_timestamp = Column(DateTime, nullable=True) # Calculated (upload + ~48h)
 
+    # Extracted text of .txt/.docx files, stored content-addressed (see app/extracted_text.py)
+    extracted_text_sha256 = Column(String(64), nullable=True, index=True)
+    extracted_char_count = Column(Integer, nullable=True)
+    extracted_token_count = Column(Integer, nullable=True)
+
     # Relationship to link table
     messages = relationship(
         "Message",
@@ -58,6 +67,8 @@ class Message(Base):
     role = Column(String, nullable=False, index=True)  # "user" or "model" or "assistant"
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    # "partial" while a model answer is being streamed, or when it was interrupted; "complete" otherwise
+    status = Column(String, nullable=False, default="complete", server_default="complete")
 
     # Add a CHECK constraint to ensure role is either 'user', 'model', or 'assistant'
     __table_args__ = (
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Literal, Union, cast
+from typing import Any, Dict, List, Literal, Optional, Union, cast
 
 from langchain_core.messages import AIMessage, trim_messages
 from langchain_core.runnables import RunnableConfig
@@ -12,6 +12,7 @@ from .tools import retriever_tool
 from app.rag.schemas.template import Template
 from app.rag.schemas.user import UserProfile
 from app.utils import get_value_from_dict
+from app.llm.resilience import CHAT_MODEL, resilience
 from .system_message_generator import SystemMessageGenerator, SystemMessageGeneratorConfig
 from app.rag.config.config_loader import CONFIG as rag_config
 
@@ -121,7 +122,8 @@ class Agent:
 
         state["prompt_token"] = (state.get("prompt_token") or 0) + prompt_token
 
-        response = await self.model.ainvoke(cut_messages, config)
+        # Retry transient errors with backoff; fail fast while the chat model's circuit is open
+        response = await resilience.call(CHAT_MODEL, lambda: self.model.ainvoke(cut_messages, config))
         print(f"DEBUG: Agent response = {repr(response)}")
 
         completion_token = tiktoken_counter([response])
@@ -185,7 +187,7 @@ def route_after_human(state) -> Literal[ "agent"]:
 
 # Define the Workflow Manager Class
 class GraphBuilder:
-    def __init__(self, config: BaseConfiguration = BaseConfiguration()):
+    def __init__(self, config: BaseConfiguration = BaseConfiguration(), memory: Optional[MemorySaver] = None):
         self.state_graph = StateGraph(State)
         self.chat_model = create_chat_model(config["chat_model_config"])
         self.tool_model = self.chat_model.bind_tools(
@@ -195,7 +197,8 @@ class GraphBuilder:
             # tool_choice="retriever_tool",
             parallel_tool_calls=False,
         )
-        self.memory = MemorySaver()  # TODO: Need to use redis checkpointer
+        # Passing the previous builder's memory keeps conversations across a pipeline reload
+        self.memory = memory if memory is not None else MemorySaver()  # TODO: Need to use redis checkpointer
 
         # Initialize nodes
         self.agent = Agent(self.tool_model)
@@ -4,6 +4,7 @@ from app.rag.config.base_config import BaseConfiguration
 from app.rag.factories.embedding_factory import create_embedding_model
 from app.rag.factories.vector_store_factory import create_vector_store
 from app.rag.config.config_loader import CONFIG
+from app.llm.resilience import VECTOR_STORE, resilience
 import logging
 
 # --- Thêm Pydantic BaseModel vào ---
@@ -30,7 +31,7 @@ async def search_documents(query: str, retriever: VectorStore) -> tuple[str, lis
         A tuple containing the formatted context string and a list of source documents.
     """
     logger.info(f"Searching for documents with query: '{query}'")
-    docs = await retriever.ainvoke(query)
+    docs = await resilience.call(VECTOR_STORE, lambda: retriever.ainvoke(query))
     
     context = "\n\n".join(doc.page_content for doc in docs)
     artifacts = [doc.metadata for doc in docs if doc.metadata]
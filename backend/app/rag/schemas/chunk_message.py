@@ -11,6 +11,10 @@ class MessageType(str, Enum):
     message_chunk = "message_chunk"
     tool_call = "tool_call"
     artifact = "artifact"
+    # Stream control events (see app.streaming.protocol)
+    status = "status"
+    error = "error"
+    done = "done"
 
 
 class NameType(str, Enum):
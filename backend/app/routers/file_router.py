@@ -7,12 +7,14 @@ from pathlib import Path
 import uuid
 import mimetypes
 import logging
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import config, services, schemas
-from ..database import get_db
+from ..attachment_io import attachment_io
+from ..database import get_async_db
 from ..utils import sanitize_filename, validate_mime_type
-from ..crud import file_crud
+from ..crud.aio import file_crud
+from ..extracted_text import extract_text, get_extracted_text_async, is_text_attachment, save_extracted_text_async
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -55,7 +57,7 @@ router = APIRouter(
 async def upload_file_to_server(
     file: UploadFile = File(...),
     background_tasks: BackgroundTasks = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> schemas.FileUploadResponse:
     """
     Upload a file, store its metadata in DB, and save file to disk.
@@ -98,22 +100,24 @@ async def upload_file_to_server(
             os.unlink(local_disk_path)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not save file: {str(e)}")
 
+    extracted_text = None
     if content_type == 'text/plain':
         try:
-            with open(local_disk_path, 'r', encoding='utf-8', errors='replace') as f: f.read(1024)
+            extracted_text = await attachment_io.run(extract_text, str(local_disk_path), content_type)
         except Exception as e:
             os.unlink(local_disk_path); raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid text file: {str(e)}")
     elif content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
         try:
-            text_c = services.extract_text_from_docx(str(local_disk_path))
+            text_c = await attachment_io.run(services.extract_text_from_docx, str(local_disk_path))
             if not text_c or text_c.startswith('[Error'): 
                 os.unlink(local_disk_path); raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid/corrupt DOCX")
+            extracted_text = text_c
         except Exception as e:
             os.unlink(local_disk_path); raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Error processing DOCX: {str(e)}")
 
     processing_method = "inline" if file_size <= MAX_INLINE_SIZE else "files_api"
     
-    db_file_metadata = file_crud.create_file_metadata(
+    db_file_metadata = await file_crud.create_file_metadata(
         db=db, 
         file_id=file_id, 
         original_filename=original_filename, 
@@ -122,6 +126,9 @@ async def upload_file_to_server(
         local_disk_path=str(local_disk_path),
         processing_method=processing_method
     )
+    if extracted_text is not None:
+        # Extracted once here; chat turns and /process-file reuse the stored text
+        await save_extracted_text_async(db, db_file_metadata, extracted_text)
 
     logger.info(f"File metadata saved: {original_filename} (ID: {file_id}, Size: {file_size}, Type: {content_type}, Method: {processing_method})")
     
@@ -136,16 +143,16 @@ async def upload_file_to_server(
 @router.get("/{file_id}/info", response_model=schemas.FileMetadataInfo)
 async def get_file_metadata_info(
     file_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> schemas.FileMetadataInfo:
     """Get metadata for a specific file from the database."""
-    db_file_metadata = file_crud.get_file_metadata_by_id(db, file_id=file_id)
+    db_file_metadata = await file_crud.get_file_metadata_by_id(db, file_id=file_id)
     if not db_file_metadata:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File metadata not found")
     return db_file_metadata
 
 @router.post("/process-file/{file_id}", response_model=schemas.FileProcessingResult, status_code=status.HTTP_200_OK)
-async def process_file_for_chat(file_id: str) -> schemas.FileProcessingResult:
+async def process_file_for_chat(file_id: str, db: AsyncSession = Depends(get_async_db)) -> schemas.FileProcessingResult:
     """
     Process a file for use in a chat message.
     
@@ -182,9 +189,22 @@ async def process_file_for_chat(file_id: str) -> schemas.FileProcessingResult:
         "processing_method": processing_method
     }
     
+    file_metadata = await file_crud.get_file_metadata_by_id(db, file_id=file_id)
+
     try:
+        # Text/DOCX files with metadata: use the stored extracted text instead of re-parsing
+        if file_metadata is not None and is_text_attachment(file_metadata.content_type):
+            text_content = await get_extracted_text_async(file_metadata, db) or ""
+            processing_result.update({
+                "content_type": file_metadata.content_type,
+                "processing_type": "text_extraction" if file_metadata.content_type == 'text/plain' else "docx_extraction",
+                "char_count": file_metadata.extracted_char_count if file_metadata.extracted_char_count is not None else len(text_content),
+                "token_count": file_metadata.extracted_token_count,
+                "preview": text_content[:200] + "..." if len(text_content) > 200 else text_content
+            })
+
         # For text files
-        if mime_type == 'text/plain' or file_extension == '.txt':
+        elif mime_type == 'text/plain' or file_extension == '.txt':
             with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
                 text_content = f.read()
                 char_count = len(text_content)
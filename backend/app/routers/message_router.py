@@ -1,10 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Request, status, File, UploadFile, Form
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 
 from .. import crud, models, schemas, services
-from ..database import get_db
+from ..auth_service import quota_user_key
+from ..database import get_async_db
+from ..message_writer import message_writer
 from ..config import get_settings # For upload limits if needed here
+from ..streaming import (
+    STREAM_DONE,
+    QuotaExceededError,
+    SchedulerFullError,
+    StreamBuffer,
+    generation_scheduler,
+    user_quotas,
+)
 
 # Lưu ý: Các route message được lồng dưới chat để tổ chức hợp lý,
 # nhưng được định nghĩa riêng để dễ bảo trì.
@@ -16,13 +27,14 @@ router = APIRouter(
 
 @router.post("/chats/{chat_id}/messages/", response_model=schemas.Message, status_code=status.HTTP_201_CREATED)
 async def create_new_message_for_chat(
+    request: Request,
     chat_id: int, 
     message_text: str = Form(...),
     files: Optional[List[UploadFile]] = File(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Tạo một tin nhắn mới (có thể kèm file) trong một phiên chat cụ thể."""
-    db_chat = crud.get_chat(db, chat_id=chat_id)
+    db_chat = await crud.aio.get_chat(db, chat_id=chat_id)
     if db_chat is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Không tìm thấy phiên chat")
 
@@ -38,67 +50,98 @@ async def create_new_message_for_chat(
             file_meta = await services.prepare_file_metadata_for_db(upload_file, db)
             processed_files_metadata.append(file_meta)
 
-    # 1. Lưu tin nhắn người dùng và file liên quan
-    user_message_schema = schemas.MessageCreate(role="user", content=message_text)
-    user_db_message = crud.create_chat_message_with_files(
-        db=db, 
-        message_data=user_message_schema, 
-        chat_id=chat_id, 
-        file_metadatas=processed_files_metadata
+    # --- Logic chọn pipeline ---
+    pipeline_type, message_for_pipeline = services.parse_pipeline_command(message_text)
+
+    # Quota LLM của người dùng, như endpoint streaming: vượt quota thì trả 429 trước khi lưu tin nhắn
+    prompt_tokens = await services.estimate_request_tokens(
+        message_for_pipeline, [file_meta.id for file_meta in processed_files_metadata]
     )
+    try:
+        quota = user_quotas.reserve(quota_user_key(request), prompt_tokens)
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    try:
+        # 1. Lưu tin nhắn người dùng và file liên quan
+        user_message_schema = schemas.MessageCreate(role="user", content=message_text)
+        user_db_message = await crud.aio.create_chat_message_with_files(
+            db=db, 
+            message_data=user_message_schema, 
+            chat_id=chat_id, 
+            file_metadatas=processed_files_metadata
+        )
+
+        # 2. Lấy lịch sử chat (loại trừ tin nhắn vừa thêm) để làm ngữ cảnh cho AI
+        chat_history_for_ai = await crud.aio.get_messages_for_chat(db=db, chat_id=chat_id, limit=50, exclude_message_id=user_db_message.id)
+        # Kết thúc transaction đọc: không giữ kết nối DB trong lúc chờ AI trả lời
+        await db.commit()
 
-    # 2. Lấy lịch sử chat (loại trừ tin nhắn vừa thêm) để làm ngữ cảnh cho AI
-    chat_history_for_ai = crud.get_messages_for_chat(db=db, chat_id=chat_id, limit=50, exclude_message_id=user_db_message.id)
+        if quota.delay:
+            # Quota cho phép sau một lúc chờ ngắn (USER_QUOTA_MAX_WAIT_SECONDS)
+            await asyncio.sleep(quota.delay)
+        # Chờ slot gọi LLM; hàng đợi đầy thì trả 503 ngay thay vì timeout
+        ticket = generation_scheduler.admit(services.generation_priority(pipeline_type))
+    except BaseException as e:
+        # Chưa có generation nào giữ quota: trả lại ngay
+        quota.release()
+        if not isinstance(e, SchedulerFullError):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "5"},
+        )
 
     # 3. Gọi AI để sinh phản hồi
-    import asyncio
-    import json
-    queue = asyncio.Queue()
+    # Buffer có giới hạn: phải đọc song song với tác vụ sinh, không chờ nó xong trước
+    queue = StreamBuffer()
 
-    # --- Logic chọn pipeline ---
-    if message_text.strip().startswith("/rag"):
-        pipeline_type = "rag"
-        # Cắt '/rag' khỏi message_text khi gửi vào pipeline RAG
-        message_for_pipeline = message_text.strip()[4:].lstrip()
-    else:
-        pipeline_type = None  # Không truyền pipeline_type, backend sẽ tự quyết định theo USE_RAG
-        message_for_pipeline = message_text
-
-    await services.generate_ai_response_stream(
-        chat_id=str(chat_id),
-        user_message_content=message_for_pipeline,
-        file_ids=[f.id for f in user_db_message.files] if user_db_message.files else [],
-        db=db,
-        queue=queue,
-        pipeline_type=pipeline_type
-    )
-    ai_response_content = ""
-    while True:
-        chunk = await queue.get()
-        if chunk == "[DONE]":
-            break
-        if not chunk or not chunk.strip():
-            continue  # Bỏ qua chunk rỗng hoặc chỉ chứa whitespace
-        try:
-            data = json.loads(chunk)
-        except json.JSONDecodeError:
-            print(f"Chunk không phải JSON hợp lệ: {repr(chunk)}")
-            continue
-        if "text" in data:
-            ai_response_content += data["text"]
-
-    # 4. Lưu tin nhắn AI vào DB
-    ai_message_schema = schemas.MessageCreate(role="model", content=ai_response_content)
-    ai_db_message = crud.create_chat_message_with_files(db=db, message_data=ai_message_schema, chat_id=chat_id, file_metadatas=[])
+    generation_task = asyncio.create_task(generation_scheduler.run(
+        ticket,
+        services.generate_ai_response_stream(
+            chat_id=str(chat_id),
+            user_message_content=message_for_pipeline,
+            file_ids=[f.id for f in user_db_message.files] if user_db_message.files else [],
+            queue=queue,
+            pipeline_type=pipeline_type,
+            persist_user_message=False,  # Đã lưu ở bước 1
+            quota=quota  # Được tính lại theo câu trả lời thực tế
+        )
+    ))
+
+    def on_generation_done(_):
+        # Task bị huỷ trước khi chạy thì `finally` của run() không chạy: trả slot và đóng buffer ở đây
+        ticket.release()
+        quota.release()
+        queue.close_nowait()
+
+    generation_task.add_done_callback(on_generation_done)
+    # Chỉ cần đọc hết stream; câu trả lời do generation tự lưu (ResponseCheckpoint)
+    while await queue.next_frame() != STREAM_DONE:
+        pass
+    ai_pending_message = await generation_task
+
+    # 4. Chờ câu trả lời được ghi xong (kể cả lần cập nhật 'complete' cuối cùng)
+    if ai_pending_message is None:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="AI không trả lời được, vui lòng thử lại")
+    ai_message_id = await ai_pending_message.wait_id()
+    await message_writer.settled(chat_id)
 
     # 5. Trả về tin nhắn AI (không kèm file)
-    return ai_db_message
+    return await crud.aio.get_message(db, ai_message_id)
 
 @router.get("/chats/{chat_id}/messages/", response_model=List[schemas.Message])
-def read_messages_for_chat(chat_id: int, skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
+async def read_messages_for_chat(chat_id: int, skip: int = 0, limit: int = 1000, db: AsyncSession = Depends(get_async_db)):
     """Lấy toàn bộ tin nhắn của một phiên chat cụ thể."""
-    db_chat = crud.get_chat(db, chat_id=chat_id)
+    # Đợi các tin nhắn vừa gửi/vừa trả lời được ghi xong
+    await message_writer.settled(chat_id)
+    db_chat = await crud.aio.get_chat(db, chat_id=chat_id)
     if db_chat is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Không tìm thấy phiên chat")
-    messages = crud.get_messages_for_chat(db, chat_id=chat_id, skip=skip, limit=limit)
+    messages = await crud.aio.get_messages_for_chat(db, chat_id=chat_id, skip=skip, limit=limit)
     return messages
\ No newline at end of file
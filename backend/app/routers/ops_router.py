@@ -0,0 +1,92 @@
+from fastapi import APIRouter, Depends
+import logging
+
+from .. import schemas
+from ..attachment_io import attachment_io
+from ..auth_service import get_current_user
+from ..attachments import attachment_transport
+from ..context import prompt_context_cache
+from ..database import pool_stats
+from ..llm import answer_cache, gemini_pacer, hedger, resilience, single_flight
+from ..message_writer import message_writer
+from ..strategy import pipeline_registry
+from ..streaming import generation_registry, generation_scheduler, user_quotas
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/ops",
+    tags=["Operations"],
+)
+
+@router.get("/generations", response_model=schemas.GenerationStats)
+async def read_generation_stats() -> schemas.GenerationStats:
+    """Number of active, queued and finished generations and LLM slot usage on this worker."""
+    return schemas.GenerationStats(**generation_registry.stats(), **generation_scheduler.stats())
+
+@router.get("/context-cache", response_model=schemas.ContextCacheStats)
+async def read_context_cache_stats() -> schemas.ContextCacheStats:
+    """Size and hit rate of the per-chat prompt context cache on this worker."""
+    return schemas.ContextCacheStats(**prompt_context_cache.stats())
+
+@router.get("/attachments", response_model=schemas.AttachmentTransportStats)
+async def read_attachment_transport_stats() -> schemas.AttachmentTransportStats:
+    """How many inline attachments were moved to the Gemini Files API and the bytes that saved."""
+    return schemas.AttachmentTransportStats(**attachment_transport.stats())
+
+@router.get("/attachment-io", response_model=schemas.AttachmentIOStats)
+async def read_attachment_io_stats() -> schemas.AttachmentIOStats:
+    """Disk reads and text extraction of attachments on the dedicated thread pool."""
+    return schemas.AttachmentIOStats(**attachment_io.stats())
+
+@router.get("/answer-cache", response_model=schemas.AnswerCacheStats)
+async def read_answer_cache_stats() -> schemas.AnswerCacheStats:
+    """Entries and hit rate of the semantic answer cache on this worker."""
+    return schemas.AnswerCacheStats(**answer_cache.stats())
+
+@router.get("/pipelines", response_model=schemas.PipelineRegistryStats)
+async def read_pipeline_stats() -> schemas.PipelineRegistryStats:
+    """Loaded pipelines, their build time and per-request lookup overhead on this worker."""
+    return schemas.PipelineRegistryStats(**pipeline_registry.stats())
+
+@router.post("/pipelines/reload", response_model=schemas.PipelineRegistryStats, dependencies=[Depends(get_current_user)])
+async def reload_pipelines() -> schemas.PipelineRegistryStats:
+    """Re-read Settings and config.yaml and rebuild the loaded pipelines without a restart (requires a login)."""
+    await pipeline_registry.reload()
+    return schemas.PipelineRegistryStats(**pipeline_registry.stats())
+
+@router.get("/hedging", response_model=schemas.HedgingStats)
+async def read_hedging_stats() -> schemas.HedgingStats:
+    """How often Gemini requests were hedged with the secondary model, and who won."""
+    return schemas.HedgingStats(**hedger.stats())
+
+@router.get("/upstream-quota", response_model=schemas.UpstreamPacerStats)
+async def read_upstream_quota_stats() -> schemas.UpstreamPacerStats:
+    """Headroom under the Gemini RPM/TPM quota and how long calls were delayed to stay under it."""
+    return schemas.UpstreamPacerStats(**gemini_pacer.stats())
+
+@router.get("/single-flight", response_model=schemas.SingleFlightStats)
+async def read_single_flight_stats() -> schemas.SingleFlightStats:
+    """How many identical first questions joined a running generation instead of starting one."""
+    return schemas.SingleFlightStats(**single_flight.stats())
+
+@router.get("/quotas", response_model=schemas.UserQuotaStats)
+async def read_user_quota_stats() -> schemas.UserQuotaStats:
+    """Per-user LLM token quotas and concurrency caps: admitted, delayed and rejected generations."""
+    return schemas.UserQuotaStats(**user_quotas.stats())
+
+@router.get("/breakers", response_model=schemas.ResilienceStats)
+async def read_breaker_stats() -> schemas.ResilienceStats:
+    """Circuit breaker state per dependency (Gemini, Files API, chat model, vector store) and retry count."""
+    return schemas.ResilienceStats(**resilience.stats())
+
+@router.get("/db-pool", response_model=schemas.DbPoolStats)
+async def read_db_pool_stats() -> schemas.DbPoolStats:
+    """Connections checked out of the sync and async DB pools, and how long they are held."""
+    return schemas.DbPoolStats(pools=pool_stats())
+
+@router.get("/message-writer", response_model=schemas.MessageWriterStats)
+async def read_message_writer_stats() -> schemas.MessageWriterStats:
+    """Chat messages queued for the write-behind writer, and how many were written per transaction."""
+    return schemas.MessageWriterStats(**message_writer.stats())
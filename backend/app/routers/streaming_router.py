@@ -1,19 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, File, UploadFile, Header
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, File, UploadFile, Header, Query
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional, List
 import json
 import asyncio
 from pydantic import BaseModel
 import os
 import logging
-import random
-from sqlalchemy.orm import Session
 
 from .. import crud, models, schemas, services
-from ..crud import file_crud
-from ..database import get_db
+from ..crud.aio import file_crud
+from ..auth_service import quota_user_key
+from ..database import AsyncSessionLocal
 from ..utils import sanitize_text
+from ..streaming import (
+    Generation,
+    GenerationLimitError,
+    QuotaExceededError,
+    SchedulerFullError,
+    StreamEvent,
+    Transport,
+    SSE,
+    generation_registry,
+    select_transport,
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -23,9 +32,88 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-# Global dictionary to store active generation tasks
-# This allows us to interrupt them if needed
-active_generations: Dict[str, asyncio.Task] = {}
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # Disable buffering in Nginx
+    "Content-Type": "text/event-stream",
+}
+
+# Seconds a client should wait before retrying when the generation queue is full
+QUEUE_FULL_RETRY_AFTER = 5
+
+# Encoded once at import: the last resort when an error event cannot be encoded
+FALLBACK_ERROR_FRAME = StreamEvent.error("stream failed", text="An error occurred.").encode()
+
+
+async def event_generator(
+    generation: Generation,
+    last_event_id: Optional[int] = None,
+    transport: Transport = SSE,
+):
+    """
+    Stream a generation's journal as SSE (or NDJSON) frames.
+
+    A client disconnect only detaches this subscriber; the generation keeps
+    running for the configured grace period so the client can resume.
+    """
+    try:
+        async for frame in generation.subscribe(last_event_id):
+            if frame is None:
+                # Send a keepalive to prevent proxy timeouts
+                logger.debug("Sending keepalive")
+                yield transport.keepalive()
+            else:
+                yield transport.frame(frame)
+        yield transport.done(generation.last_seq)
+    except Exception as e:
+        logger.error(f"Event generator error: {e}", exc_info=True)
+        # Send a final error message
+        try:
+            error_event = StreamEvent.error(str(e), text="An error occurred while streaming the response.")
+            yield transport.frame(error_event.encode())
+        except Exception:
+            # If we can't even encode the error, send the pre-encoded one in the client's format
+            yield transport.frame(FALLBACK_ERROR_FRAME)
+
+
+def streaming_response(
+    generation: Generation,
+    transport: Transport,
+    last_event_id: Optional[int] = None,
+) -> StreamingResponse:
+    return StreamingResponse(
+        event_generator(generation, last_event_id, transport),
+        media_type=transport.media_type,
+        headers={**SSE_HEADERS, "Content-Type": transport.media_type},
+    )
+
+
+async def _start_generation(**kwargs):
+    """``services.start_generation``, with its admission errors mapped to HTTP errors."""
+    try:
+        return await services.start_generation(**kwargs)
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except SchedulerFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER)},
+        )
+    except GenerationLimitError as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+
+
+def _parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
 
 # We're not using chat contexts anymore since we now rebuild from the database each time
 # chat_contexts: Dict[str, Any] = {}
@@ -44,78 +132,16 @@ async def stream_chat_response(
     request: Request,
     chat_id: int,
     user_message: schemas.UserMessageInput, # Use the schema from schemas.py
-    db: Session = Depends(get_db),
     x_chat_context: Optional[str] = Header(None), # Keep for now, though context handling changed
+    format: Optional[str] = Query(None, description="'sse' (default) or 'ndjson'"),
+    accept: Optional[str] = Header(None),
 ):
     """
     Stream a response from the AI to the user.
     Receives user message content and a list of file_ids (UUIDs for FileMetadata).
+    Responds with SSE, or NDJSON with `?format=ndjson` / `Accept: application/x-ndjson`.
     """
-    # Define the streaming response generator
-    async def event_generator():
-        try:
-            # Send the generation ID first
-            generation_id_event = f"data: {json.dumps({'generation_id': generation_id})}\n\n"
-            logger.info(f"Sending generation ID event: {generation_id_event.strip()}")
-            yield generation_id_event
-
-            # Stream the response chunks
-            while True:
-                # Check if client disconnected
-                if await request.is_disconnected():
-                    # Cancel the generation task
-                    if not generation_task.done():
-                        generation_task.cancel()
-                    break
-
-                # Get message from queue
-                try:
-                    chunk = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    # Check for done signal
-                    if chunk == "[DONE]":
-                        # Send a proper [DONE] marker in SSE format
-                        logger.info("Sending [DONE] marker")
-                        yield f"data: [DONE]\n\n"
-                        break
-
-                    # The chunk is already formatted as "data: {json}\n\n" by the generate_ai_response_stream function
-                    # Just pass it through
-                    logger.info(f"Sending chunk (length: {len(chunk)})")
-                    if chunk.startswith("data:"):
-                        yield chunk
-                    else:
-                        # For backward compatibility, format any unformatted chunks
-                        yield f"data: {json.dumps({'text': chunk})}\n\n"
-                except asyncio.TimeoutError:
-                    # Send a keepalive comment to prevent proxy timeouts
-                    logger.debug("Sending keepalive")
-                    yield ": keepalive\n\n"
-                except Exception as e:
-                    # Log full stack trace for debugging event generator errors
-                    logger.error(f"Error in event generator: {e}", exc_info=True)
-                    # Try to send an error message
-                    try:
-                        error_chunk = {
-                            "error": str(e),
-                            "text": "An error occurred while generating the response."
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
-                    except:
-                        pass
-                    break
-        except Exception as e:
-            logger.error(f"Event generator error: {e}", exc_info=True)
-            # Send a final error message
-            try:
-                error_message = {
-                    "error": str(e),
-                    "text": "An error occurred while streaming the response."
-                }
-                yield f"data: {json.dumps(error_message)}\n\n"
-            except:
-                # If we can't even send the error, just send a plain message
-                yield f"data: An error occurred.\n\n"
-
+    transport = select_transport(format, accept)
     try:
         logger.info(f"Received streaming request for chat_id: {chat_id}")
         logger.info(f"User message content: {user_message.content}")
@@ -124,9 +150,14 @@ async def stream_chat_response(
         if user_message.file_ids:
             logger.info(f"File IDs included in request: {user_message.file_ids}")
             valid_file_metadata_for_service = []
-            for file_id_str in user_message.file_ids:
+            # Session ngắn, không phải của request: kết nối không bị giữ trong suốt lúc stream
+            async with AsyncSessionLocal() as db:
+                file_metadata_entries = [
+                    (file_id_str, await file_crud.get_file_metadata_by_id(db=db, file_id=file_id_str))
+                    for file_id_str in user_message.file_ids
+                ]
+            for file_id_str, file_metadata_entry in file_metadata_entries:
                 # file_info = crud.get_file_by_id(db=db, file_id=file_id_str) # Old way (filesystem scan)
-                file_metadata_entry = file_crud.get_file_metadata_by_id(db=db, file_id=file_id_str) # New way (DB query)
                 if file_metadata_entry:
                     # valid_file_metadata_for_service.append(file_metadata_entry) # Pass the whole object or just ID?
                                                                           # Service layer will need to re-fetch or be passed enough info.
@@ -137,57 +168,21 @@ async def stream_chat_response(
             # The services.generate_ai_response_stream will receive the original list of file_ids
             # and will be responsible for fetching their metadata and handling missing ones.
         
-        # Generate a unique ID for this generation
-        generation_id = f"{chat_id}_{random.randint(100, 999)}"
-        logger.info(f"Generation ID: {generation_id}")
-        
-        # Create a queue for passing chunks between tasks
-        queue = asyncio.Queue()
-        
-        # Start the AI response generation in a background task
-        logger.info(f"Starting generate_ai_response_stream for generation_id: {generation_id}")
-        generation_task = asyncio.create_task(
-            services.generate_ai_response_stream(
-                chat_id=str(chat_id),
-                user_message_content=user_message.content, # Pass content directly
-                file_ids=user_message.file_ids,      # Pass the list of UUIDs
-                db=db,
-                queue=queue,
-                # context=None, # context handling has changed
-            )
-        )
-        
-        # When the generation task completes, log any exceptions
-        def on_generation_done(task):
-            try:
-                if task.cancelled():
-                    logger.info(f"Generation task for {generation_id} was cancelled")
-                elif task.exception():
-                    logger.error(f"Generation task for {generation_id} raised an exception: {task.exception()}", 
-                                exc_info=task.exception())
-                elif task.done():
-                    # Log completion
-                    logger.info(f"Generation task for {generation_id} completed successfully")
-            except Exception as e:
-                logger.error(f"Error handling generation completion: {e}", exc_info=True)
-        
-        # Add the callback to the task
-        generation_task.add_done_callback(on_generation_done)
-        
-        # Store in active generations to allow cancellation
-        active_generations[generation_id] = generation_task
-        
-        # Set content type for SSE
-        return StreamingResponse(
-            event_generator(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",  # Disable buffering in Nginx
-                "Content-Type": "text/event-stream",
-            },
+        # Reserves an LLM slot (or a wait-queue place) before doing any work, so
+        # overload is rejected up front instead of timing out upstream. A second
+        # tab or a retried POST for the same turn joins the in-flight generation
+        # (replayed from the start) instead of calling the LLM again
+        generation, shared = await _start_generation(
+            chat_id=chat_id,
+            content=user_message.content,
+            file_ids=user_message.file_ids,      # Pass the list of UUIDs
+            user_key=quota_user_key(request),
         )
+        logger.info(f"Generation ID: {generation.id} (shared: {shared})")
+
+        return streaming_response(generation, transport)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error during streaming: {str(e)}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error during streaming: {str(e)}")
@@ -197,6 +192,57 @@ async def stream_chat_response(
 # For now, let's assume UserMessageInput on the main stream endpoint is the primary path.
 # If keeping stream-with-file, it also needs to use schemas.UserMessageInput and ensure file_ids are UUIDs.
 
+@router.post("/chats/{chat_id}/continue")
+async def continue_chat_response(
+    request: Request,
+    chat_id: int,
+    format: Optional[str] = Query(None, description="'sse' (default) or 'ndjson'"),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Continue the interrupted answer at the end of the chat ("continue from here").
+    Streams only the new text, which is appended to that message (status back to 'complete').
+    """
+    async with AsyncSessionLocal() as db:
+        partial = await services.find_partial_answer(db, chat_id)
+    if partial is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Chat has no interrupted answer to continue")
+    generation, _ = await _start_generation(
+        chat_id=chat_id,
+        content=services.CONTINUE_PROMPT,
+        file_ids=[],
+        persist_user_message=False,
+        share=False,
+        use_answer_cache=False,
+        user_key=quota_user_key(request),
+        continue_message_id=partial.id,
+    )
+    logger.info(f"Continuing message {partial.id} of chat {chat_id} in generation {generation.id}")
+    return streaming_response(generation, select_transport(format, accept))
+
+@router.get("/generations/{generation_id}/stream")
+async def resume_generation_stream(
+    generation_id: str,
+    last_event_id: Optional[str] = Header(None),
+    last_event_id_param: Optional[int] = Query(None, alias="last_event_id"),
+    format: Optional[str] = Query(None, description="'sse' (default) or 'ndjson'"),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Re-attach to an in-flight (or just finished) generation.
+
+    Sends only the frames after the given `Last-Event-ID` header (or the
+    `last_event_id` query parameter for clients that cannot set headers).
+    """
+    generation = generation_registry.get(generation_id)
+    if generation is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Generation not found or expired")
+    resume_from = _parse_last_event_id(last_event_id)
+    if resume_from is None:
+        resume_from = last_event_id_param
+    logger.info(f"Resuming generation {generation_id} after event {resume_from}")
+    return streaming_response(generation, select_transport(format, accept), resume_from)
+
 @router.post("/chats/{chat_id}/interrupt", response_model=schemas.InterruptResponse)
 async def interrupt_chat_stream(
     chat_id: int,
@@ -209,23 +255,15 @@ async def interrupt_chat_stream(
     try:
         generation_id = payload.generation_id # Get generation_id from the payload
         # If generation_id is provided, use it to find the specific task
-        if generation_id and generation_id in active_generations:
-            task = active_generations[generation_id]
-            if not task.done():
-                task.cancel()
+        generation = generation_registry.get(generation_id) if generation_id else None
+        if generation is not None:
+            if generation.cancel():
                 logger.info(f"Cancelled generation {generation_id}")
-            # Remove from tracking
-            del active_generations[generation_id]
+            # The registry evicts the entry once its replay grace period is over
             return schemas.InterruptResponse(status="success", message=f"Generation {generation_id} interrupted")
         
         # If no generation_id, try to cancel all tasks for this chat_id
-        prefix = f"{chat_id}_"
-        cancelled_count = 0 # Renamed variable to avoid conflict
-        for gen_id, task in list(active_generations.items()):
-            if gen_id.startswith(prefix) and not task.done():
-                task.cancel()
-                del active_generations[gen_id]
-                cancelled_count += 1
+        cancelled_count = generation_registry.cancel_chat(chat_id)
         
         if cancelled_count > 0:
             return schemas.InterruptResponse(status="success", message=f"Interrupted {cancelled_count} active generations for chat {chat_id}")
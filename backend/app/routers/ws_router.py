@@ -0,0 +1,263 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from typing import Any, Dict, Optional
+import asyncio
+import json
+import logging
+
+from .. import crud, services
+from ..auth_service import quota_user_key
+from ..database import AsyncSessionLocal
+from ..message_writer import message_writer
+from ..streaming import (
+    Generation,
+    GenerationLimitError,
+    QuotaExceededError,
+    SchedulerFullError,
+    StreamEvent,
+    generation_registry,
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["WebSocket"],
+)
+
+# Outgoing messages waiting for the socket; a slow client blocks its own forwarders only
+WS_OUTBOX_SIZE = 256
+
+
+class ChatSocket:
+    """
+    One client connection carrying many generations.
+
+    Client -> server (JSON, `ref` is echoed back in the ack/error):
+        {"action": "send", "chat_id": 1, "content": "...", "file_ids": [...], "ref": "..."}
+        {"action": "stream", "generation_id": "...", "last_event_id": 12}
+        {"action": "interrupt", "generation_id": "..."} or {"action": "interrupt", "chat_id": 1}
+        {"action": "regenerate", "chat_id": 1}
+        {"action": "continue", "chat_id": 1}   (interrupted 'partial' answer at the end of the chat)
+
+    Server -> client:
+        {"type": "ack", "action": "...", "ref": ..., "generation_id": "...", ...}
+        {"type": "event", "generation_id": "...", "event": {<stream protocol event>}}
+        {"type": "error", "ref": ..., "code": 429, "error": "...", "retry_after": 12}
+
+    LLM quotas are per user: the JWT subject of the `token` query parameter
+    (or Authorization header) of the connection, else the client IP.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.user_key = quota_user_key(websocket)
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_OUTBOX_SIZE)
+        self.forwarders: Dict[str, asyncio.Task] = {}
+        self.handlers = {
+            "send": self.handle_send,
+            "stream": self.handle_stream,
+            "interrupt": self.handle_interrupt,
+            "regenerate": self.handle_regenerate,
+            "continue": self.handle_continue,
+        }
+
+    async def writer(self):
+        # The only task writing to the socket, so frames from different generations never interleave
+        while True:
+            message = await self.outbox.get()
+            await self.websocket.send_text(message)
+
+    async def send_json(self, payload: Dict[str, Any]):
+        await self.outbox.put(json.dumps(payload, ensure_ascii=False))
+
+    async def send_error(self, ref: Any, code: int, error: str, retry_after: Optional[int] = None):
+        payload = {"type": "error", "ref": ref, "code": code, "error": error}
+        if retry_after is not None:
+            payload["retry_after"] = retry_after
+        await self.send_json(payload)
+
+    # --- Generations ---
+
+    def attach(self, generation: Generation, last_event_id: Optional[int] = None):
+        """Forward a generation's events to this socket, replacing an earlier subscription to it."""
+        previous = self.forwarders.pop(generation.id, None)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.create_task(self._forward(generation, last_event_id))
+        self.forwarders[generation.id] = task
+
+        def on_done(_):
+            if self.forwarders.get(generation.id) is task:
+                del self.forwarders[generation.id]
+
+        task.add_done_callback(on_done)
+
+    async def _forward(self, generation: Generation, last_event_id: Optional[int]):
+        # Frames are already JSON-encoded by the journal; only wrap them
+        prefix = f'{{"type": "event", "generation_id": "{generation.id}", "event": '
+        async for frame in generation.subscribe(last_event_id):
+            if frame is None:
+                continue  # WebSocket pings keep the connection alive
+            await self.outbox.put(prefix + frame.body + "}")
+        await self.outbox.put(prefix + StreamEvent.done(generation.last_seq).encode().body + "}")
+
+    async def _start(self, chat_id: int, content: str, file_ids, **kwargs):
+        """Start a generation; it opens its own short DB sessions."""
+        return await services.start_generation(
+            chat_id=chat_id, content=content, file_ids=file_ids, user_key=self.user_key, **kwargs
+        )
+
+    # --- Actions ---
+
+    async def handle_send(self, message: Dict[str, Any]):
+        ref = message.get("ref")
+        chat_id = message.get("chat_id")
+        content = message.get("content")
+        if not isinstance(chat_id, int) or not isinstance(content, str) or not content.strip():
+            await self.send_error(ref, status.HTTP_400_BAD_REQUEST, "'chat_id' and 'content' are required")
+            return
+        async with AsyncSessionLocal() as db:
+            chat_exists = await crud.aio.get_chat(db, chat_id=chat_id) is not None
+        if not chat_exists:
+            await self.send_error(ref, status.HTTP_404_NOT_FOUND, f"Chat {chat_id} not found")
+            return
+        generation, shared = await self._start(chat_id, content, message.get("file_ids") or [])
+        await self.send_json({
+            "type": "ack", "action": "send", "ref": ref,
+            "generation_id": generation.id, "chat_id": chat_id, "shared": shared,
+        })
+        self.attach(generation)
+
+    async def handle_stream(self, message: Dict[str, Any]):
+        ref = message.get("ref")
+        generation = generation_registry.get(message.get("generation_id") or "")
+        if generation is None:
+            await self.send_error(ref, status.HTTP_404_NOT_FOUND, "Generation not found or expired")
+            return
+        last_event_id = message.get("last_event_id")
+        await self.send_json({
+            "type": "ack", "action": "stream", "ref": ref,
+            "generation_id": generation.id, "chat_id": generation.chat_id,
+        })
+        self.attach(generation, last_event_id if isinstance(last_event_id, int) else None)
+
+    async def handle_interrupt(self, message: Dict[str, Any]):
+        ref = message.get("ref")
+        generation_id = message.get("generation_id")
+        if generation_id:
+            generation = generation_registry.get(generation_id)
+            cancelled = 1 if generation is not None and generation.cancel() else 0
+        elif isinstance(message.get("chat_id"), int):
+            cancelled = generation_registry.cancel_chat(message["chat_id"])
+        else:
+            await self.send_error(ref, status.HTTP_400_BAD_REQUEST, "'generation_id' or 'chat_id' is required")
+            return
+        await self.send_json({
+            "type": "ack", "action": "interrupt", "ref": ref,
+            "generation_id": generation_id, "cancelled": cancelled,
+        })
+
+    async def handle_regenerate(self, message: Dict[str, Any]):
+        """Drop the answer(s) after the last user message and generate it again."""
+        ref = message.get("ref")
+        chat_id = message.get("chat_id")
+        if not isinstance(chat_id, int):
+            await self.send_error(ref, status.HTTP_400_BAD_REQUEST, "'chat_id' is required")
+            return
+        # A regenerate must not race the answer it replaces; wait for it to save its partial text
+        replaced = [g.task for g in generation_registry.active(chat_id) if g.cancel()]
+        if replaced:
+            await asyncio.wait(replaced)
+        # The last messages of the chat may still be queued for writing
+        await message_writer.settled(chat_id)
+        async with AsyncSessionLocal() as db:
+            last_user_message = await crud.aio.get_last_user_message(db, chat_id=chat_id)
+            if last_user_message is None:
+                await self.send_error(ref, status.HTTP_404_NOT_FOUND, f"Chat {chat_id} has no user message to answer")
+                return
+            content = last_user_message.content
+            file_ids = [f.id for f in last_user_message.files]
+            await crud.aio.delete_messages_after(db, chat_id=chat_id, message_id=last_user_message.id)
+        generation, _ = await self._start(
+            chat_id, content, file_ids, persist_user_message=False, share=False, use_answer_cache=False
+        )
+        await self.send_json({
+            "type": "ack", "action": "regenerate", "ref": ref,
+            "generation_id": generation.id, "chat_id": chat_id,
+        })
+        self.attach(generation)
+
+    async def handle_continue(self, message: Dict[str, Any]):
+        """Continue the interrupted answer at the end of the chat; new text is appended to it."""
+        ref = message.get("ref")
+        chat_id = message.get("chat_id")
+        if not isinstance(chat_id, int):
+            await self.send_error(ref, status.HTTP_400_BAD_REQUEST, "'chat_id' is required")
+            return
+        async with AsyncSessionLocal() as db:
+            partial = await services.find_partial_answer(db, chat_id)
+            message_id = partial.id if partial is not None else None
+        if message_id is None:
+            await self.send_error(ref, status.HTTP_409_CONFLICT, f"Chat {chat_id} has no interrupted answer to continue")
+            return
+        generation, _ = await self._start(
+            chat_id, services.CONTINUE_PROMPT, [], persist_user_message=False, share=False,
+            use_answer_cache=False, continue_message_id=message_id,
+        )
+        await self.send_json({
+            "type": "ack", "action": "continue", "ref": ref,
+            "generation_id": generation.id, "chat_id": chat_id, "message_id": message_id,
+        })
+        self.attach(generation)
+
+    async def handle(self, raw: str):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            await self.send_error(None, status.HTTP_400_BAD_REQUEST, "Messages must be JSON objects")
+            return
+        if not isinstance(message, dict):
+            await self.send_error(None, status.HTTP_400_BAD_REQUEST, "Messages must be JSON objects")
+            return
+        handler = self.handlers.get(message.get("action"))
+        if handler is None:
+            await self.send_error(message.get("ref"), status.HTTP_400_BAD_REQUEST, f"Unknown action: {message.get('action')}")
+            return
+        try:
+            await handler(message)
+        except QuotaExceededError as e:
+            await self.send_error(message.get("ref"), status.HTTP_429_TOO_MANY_REQUESTS, str(e), e.retry_after)
+        except SchedulerFullError as e:
+            await self.send_error(message.get("ref"), status.HTTP_503_SERVICE_UNAVAILABLE, str(e))
+        except GenerationLimitError as e:
+            await self.send_error(message.get("ref"), status.HTTP_429_TOO_MANY_REQUESTS, str(e))
+        except Exception as e:
+            logger.error(f"Error handling WebSocket action {message.get('action')}: {e}", exc_info=True)
+            await self.send_error(message.get("ref"), status.HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+
+    def close(self):
+        # Generations only lose a subscriber; they keep running for the detach grace period
+        for task in list(self.forwarders.values()):
+            task.cancel()
+        self.forwarders.clear()
+
+
+@router.websocket("/ws/chats")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Multiplex send / stream / interrupt / regenerate / continue for many chats over one connection.
+
+    Uses the same generation registry, scheduler and pipelines as the SSE endpoints.
+    """
+    await websocket.accept()
+    connection = ChatSocket(websocket)
+    writer_task = asyncio.create_task(connection.writer())
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            await connection.handle(raw)
+    except WebSocketDisconnect:
+        logger.info("WebSocket client disconnected")
+    finally:
+        connection.close()
+        writer_task.cancel()
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 # --- File Metadata Schemas ---
 class FileMetadataInfo(BaseModel):
@@ -40,6 +40,7 @@ class Message(MessageBase):
     id: int
     chat_id: int
     timestamp: datetime
+    status: str = "complete" # "partial": interrupted answer, can be continued
     files: List[FileMetadataInfo] = [] # List of associated file metadata
 
     class Config:
@@ -83,6 +84,7 @@ class FileProcessingResult(BaseModel):
     processing_type: str
     processing_method: str
     char_count: Optional[int] = None
+    token_count: Optional[int] = None # Estimated tokens of the extracted text
     preview: Optional[str] = None
     error: Optional[str] = None
 
@@ -97,6 +99,145 @@ class InterruptResponse(BaseModel):
     status: str
     message: str
 
+# --- Operations / Stats Schemas ---
+class GenerationStats(BaseModel):
+    active: int # Not finished yet (queued + running)
+    queued: int
+    running: int
+    finished: int # Total finished since the worker started
+    shared: int # Requests that attached to an in-flight generation of the same chat turn
+    retained: int # Finished, kept in memory for stream replay until evicted
+    max_active: int
+    max_per_chat: int
+    slots_total: int # Concurrent upstream LLM calls allowed
+    slots_in_use: int
+    waiting: int # Generations queued for a slot right now
+    queue_capacity: int # Generations that may wait for a slot
+
+class ContextCacheStats(BaseModel):
+    chats: int # Chats with a cached prompt context
+    size_bytes: int
+    budget_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+class HedgingStats(BaseModel):
+    requests: int
+    hedged: int # Secondary started because the first Gemini chunk was late
+    failovers: int # Secondary started because Gemini failed before its first chunk
+    secondary_wins: int
+    failures: int
+    hedge_after_ms: float # Current hedge delay (fixed or rolling p95)
+    latency_samples: int
+
+class UserQuotaStats(BaseModel):
+    users: int # Users (JWT subject or IP) currently tracked
+    active_generations: int
+    tokens_per_minute: int # Per-user token bucket refill rate (0 = no token quota)
+    max_active_per_user: int
+    admitted: int
+    delayed: int # Admitted after waiting for the user's bucket to refill
+    rejected_tokens: int # 429: token quota exhausted beyond the maximum wait
+    rejected_concurrency: int # 429: too many active generations for the user
+
+class UpstreamPacerStats(BaseModel):
+    rpm_limit: int # GEMINI_RPM_LIMIT, 0 = requests not paced
+    tpm_limit: int # GEMINI_TPM_LIMIT, 0 = tokens not paced
+    request_headroom: Optional[float] = None # Requests that can be sent now; negative = calls already waiting
+    token_headroom: Optional[float] = None # Tokens that can be sent now; negative = calls already waiting
+    calls: int
+    delayed: int
+    total_delay_seconds: float
+    max_delay_seconds: float
+
+class CircuitBreakerStats(BaseModel):
+    state: str # closed, open (failing fast) or half_open (one probe call allowed)
+    consecutive_failures: int
+    retry_after_seconds: float # Until the next probe, while open
+    calls: int
+    failures: int # Transient failures (timeouts, connection errors, 408/429/5xx)
+    rejected: int # Calls failed fast while open
+    opened: int
+    last_error: Optional[str] = None
+
+class ResilienceStats(BaseModel):
+    retries: int
+    breakers: Dict[str, CircuitBreakerStats] # By dependency: gemini, gemini_files, chat_model, vector_store
+
+class SingleFlightStats(BaseModel):
+    in_flight: int # Upstream generations currently shared
+    leaders: int # Requests that started an upstream generation
+    followers: int # Requests that joined an identical one instead
+
+class MessageWriterStats(BaseModel):
+    queued: int # Messages waiting for the next batch
+    pending_chats: int # Chats with messages not written yet
+    written: int
+    updated: int # Rewrites of answers saved while streaming (partial -> complete)
+    batches: int # Transactions committed; written / batches = average batch size
+    failed: int # Messages that could not be saved
+
+class AttachmentIOStats(BaseModel):
+    workers: int # Threads of the attachment pool (ATTACHMENT_IO_WORKERS)
+    concurrency: int # Attachments prepared at once per turn
+    busy: int # Disk reads / extractions running or waiting for a thread
+    jobs: int
+    avg_ms: float
+    max_ms: float
+
+class DbPoolInfo(BaseModel):
+    pool: str # Pool class (QueuePool, AsyncAdaptedQueuePool, ...)
+    size: Optional[int] = None # None for pools without a fixed size
+    overflow: Optional[int] = None
+    checked_out: int # Connections in use now
+    utilization: Optional[float] = None # checked_out / (pool_size + max_overflow)
+    peak_checked_out: int
+    checkouts: int
+    avg_hold_ms: float # How long a connection stays checked out
+    max_hold_seconds: float
+
+class DbPoolStats(BaseModel):
+    pools: Dict[str, DbPoolInfo] # "sync" (db_manager, sync routers, message writer) and "async" engines
+
+class PipelineInfo(BaseModel):
+    loaded: bool
+    version: int # Incremented on every (re)build
+    built_at: Optional[datetime] = None
+    build_seconds: Optional[float] = None
+    requests: int
+    avg_lookup_ms: float # Per-request cost of getting the pipeline
+    last_error: Optional[str] = None
+
+class PipelineRegistryStats(BaseModel):
+    pipelines: Dict[str, PipelineInfo]
+    reloads: int
+    warmup_seconds: Optional[float] = None
+
+class AnswerCacheStats(BaseModel):
+    entries: int
+    namespaces: Dict[str, int] # Entries per pipeline ("gemini", "rag")
+    max_entries: int
+    exact_hits: int
+    semantic_hits: int
+    misses: int
+    hit_rate: float
+    stores: int
+    evictions: int
+    expirations: int
+    embedding_errors: int
+
+class AttachmentTransportStats(BaseModel):
+    tracked_files: int # Attachments still sent inline whose reuse is being counted
+    handles: int # Files API handles known to this worker
+    uploads_in_flight: int
+    promoted: int
+    refreshed: int
+    failed: int
+    reference_hits: int # Attachments sent as a reference instead of bytes
+    inline_bytes_avoided: int
+    promote_after_uses: int
+
 # === AUTHENTICATION SCHEMAS ===
 from pydantic import EmailStr
 
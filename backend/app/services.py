@@ -3,7 +3,7 @@
 # --- Imports ---
 from google import genai
 from google.genai import types
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import logging
 import asyncio
 import os
@@ -11,16 +11,37 @@ import mimetypes
 from fastapi import HTTPException
 from pathlib import Path
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import hashlib
 import json
 from fastapi import UploadFile
 
 from . import config, schemas, crud
-from .crud import file_crud
-from .models import FileMetadata
+from .crud.aio import file_crud
+from .models import FileMetadata, Message
+from .attachment_io import attachment_io, read_bytes
+from .extracted_text import get_extracted_text_async, is_text_attachment, save_extracted_text_async
+from .llm import answer_cache, attachment_fingerprint, flight_key, single_flight
+from .llm.resilience import GEMINI_FILES, resilience
+from .streaming import (
+    Generation,
+    GenerationLimitError,
+    Priority,
+    QuotaReservation,
+    SchedulerFullError,
+    StreamBuffer,
+    StreamEvent,
+    generation_registry,
+    generation_scheduler,
+    turn_key,
+    user_quotas
+)
 
 from app.config import USE_RAG
 from .config import get_settings
+from .context.budget import estimate_attachment_tokens, estimate_text_tokens
+from .database import AsyncSessionLocal
+from .message_writer import PARTIAL, PendingMessage, ResponseCheckpoint, message_writer
 
 # --- Cấu hình Logging ---
 logging.basicConfig(level=logging.INFO)
@@ -73,9 +94,10 @@ def extract_text_from_docx(file_path: str) -> str:
         return f"[Error extracting text from DOCX file: {str(e)}]"
 
 # === KHÔI PHỤC HÀM: Làm mới file Gemini nếu sắp hết hạn ===
-def refresh_gemini_file_if_needed(fm: FileMetadata, db: Session) -> Optional[str]:
+async def refresh_gemini_file_if_needed(fm: FileMetadata) -> Optional[str]:
     """
     Làm mới file đã upload lên Gemini nếu sắp hết hạn, trả về gemini_api_file_id mới hoặc cũ.
+    Session DB chỉ được mở sau khi upload xong, không giữ kết nối trong lúc chờ mạng.
     """
     if not client or not fm.gemini_api_file_id or not fm.gemini_api_upload_timestamp:
         return None
@@ -85,25 +107,28 @@ def refresh_gemini_file_if_needed(fm: FileMetadata, db: Session) -> Optional[str
     if fm.gemini_api_expiry_timestamp and now < fm.gemini_api_expiry_timestamp - timedelta(hours=1):
         return fm.gemini_api_file_id
     try:
-        # Re-upload file lên Gemini
-        uploaded_file = client.files.upload(
-            path=fm.local_disk_path,
-            display_name=fm.original_filename,
-            mime_type=fm.content_type
-        )
+        # Re-upload file lên Gemini (client.aio để không chặn event loop; lỗi tạm thời được thử lại)
+        uploaded_file = await resilience.call(GEMINI_FILES, lambda: client.aio.files.upload(
+            file=fm.local_disk_path,
+            config=types.UploadFileConfig(
+                display_name=fm.original_filename,
+                mime_type=fm.content_type
+            )
+        ))
         # Cập nhật DB
-        file_crud.update_file_metadata_gemini_info(
-            db=db,
-            file_id=fm.id,
-            gemini_api_file_id=uploaded_file.name
-        )
+        async with AsyncSessionLocal() as db:
+            await file_crud.update_file_metadata_gemini_info(
+                db=db,
+                file_id=fm.id,
+                gemini_api_file_id=uploaded_file.name
+            )
         return uploaded_file.name
     except Exception as e:
         logger.error(f"Failed to refresh Gemini file for {fm.original_filename}: {e}", exc_info=True)
         return fm.gemini_api_file_id
 
-# === KHÔI PHỤC HÀM: Chuẩn bị file cho Gemini (đầy đủ, nhận cả db) ===
-async def _prepare_single_file_for_gemini(fm: FileMetadata, db: Session) -> Optional[list]:
+# === KHÔI PHỤC HÀM: Chuẩn bị file cho Gemini (đầy đủ) ===
+async def _prepare_single_file_for_gemini(fm: FileMetadata) -> Optional[list]:
     """
     Chuẩn bị nội dung file để truyền vào Gemini:
     - Nếu là text/docx: trích xuất text, trả về [context_part, text_part]
@@ -115,24 +140,18 @@ async def _prepare_single_file_for_gemini(fm: FileMetadata, db: Session) -> Opti
         return None
     try:
         context_part = types.Part(text=f"[File đính kèm: {fm.original_filename}, loại: {fm.content_type}]")
-        # Xử lý file text
-        if fm.content_type == 'text/plain':
-            with open(fm.local_disk_path, 'r', encoding='utf-8', errors='replace') as f:
-                text_content = f.read()
-            return [context_part, types.Part(text=text_content)]
-        # Xử lý file docx
-        elif fm.content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-            text_content = extract_text_from_docx(fm.local_disk_path)
-            return [context_part, types.Part(text=text_content)]
+        # Xử lý file text/docx: dùng text đã trích xuất sẵn
+        if is_text_attachment(fm.content_type):
+            text_content = await get_extracted_text_async(fm)
+            return [context_part, types.Part(text=text_content or "")]
         # Xử lý file PDF/ảnh nhỏ (inline)
         elif fm.processing_method == 'inline':
-            with open(fm.local_disk_path, 'rb') as f_bytes:
-                file_data = f_bytes.read()
+            file_data = await attachment_io.run(read_bytes, fm.local_disk_path)
             return [context_part, types.Part(inline_data={"data": file_data, "mime_type": fm.content_type})]
         # Xử lý file lớn đã upload Gemini (files_api)
         elif fm.processing_method == 'files_api' and fm.gemini_api_file_id:
             # Kiểm tra TTL, làm mới nếu cần
-            gemini_file_id = refresh_gemini_file_if_needed(fm, db)
+            gemini_file_id = await refresh_gemini_file_if_needed(fm)
             return [context_part, types.Part(uri=gemini_file_id, mime_type=fm.content_type)]
         else:
             logger.warning(f"Unknown processing_method '{fm.processing_method}' for file {fm.id}")
@@ -142,7 +161,7 @@ async def _prepare_single_file_for_gemini(fm: FileMetadata, db: Session) -> Opti
         return None
 
 # === Hàm chuẩn hóa metadata file upload cho message_router ===
-async def prepare_file_metadata_for_db(upload_file: UploadFile, db: Session):
+async def prepare_file_metadata_for_db(upload_file: UploadFile, db: AsyncSession):
     """
     Kiểm tra, lưu file upload vào disk, tạo metadata và lưu vào DB.
     Trả về đối tượng FileMetadata.
@@ -151,7 +170,7 @@ async def prepare_file_metadata_for_db(upload_file: UploadFile, db: Session):
     from pathlib import Path
     from .config import get_settings
     from .utils import sanitize_filename, validate_mime_type
-    from .crud import file_crud
+    from .crud.aio import file_crud
 
     ALLOWED_MIME_TYPES = [
         'text/plain',
@@ -193,9 +212,10 @@ async def prepare_file_metadata_for_db(upload_file: UploadFile, db: Session):
         if os.path.exists(local_disk_path):
             os.unlink(local_disk_path)
         raise Exception(f"Could not save file: {str(e)}")
+    extracted_text = None
     if content_type == 'text/plain':
         try:
-            with open(local_disk_path, 'r', encoding='utf-8', errors='replace') as f: f.read(1024)
+            with open(local_disk_path, 'r', encoding='utf-8', errors='replace') as f: extracted_text = f.read()
         except Exception as e:
             os.unlink(local_disk_path); raise Exception(f"Invalid text file: {str(e)}")
     elif content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
@@ -203,10 +223,11 @@ async def prepare_file_metadata_for_db(upload_file: UploadFile, db: Session):
             text_c = extract_text_from_docx(str(local_disk_path))
             if not text_c or text_c.startswith('[Error'):
                 os.unlink(local_disk_path); raise Exception("Invalid/corrupt DOCX")
+            extracted_text = text_c
         except Exception as e:
             os.unlink(local_disk_path); raise Exception(f"Error processing DOCX: {str(e)}")
     processing_method = "inline" if file_size <= MAX_INLINE_SIZE else "files_api"
-    db_file_metadata = file_crud.create_file_metadata(
+    db_file_metadata = await file_crud.create_file_metadata(
         db=db,
         file_id=file_id,
         original_filename=original_filename,
@@ -215,17 +236,51 @@ async def prepare_file_metadata_for_db(upload_file: UploadFile, db: Session):
         local_disk_path=str(local_disk_path),
         processing_method=processing_method
     )
+    if extracted_text is not None:
+        # Lưu text đã trích xuất để các lượt sau không phải parse lại file
+        await save_extracted_text_async(db, db_file_metadata, extracted_text)
     return db_file_metadata
 
 # === STRATEGY PATTERN INTEGRATION ===
+RAG_COMMAND = "/rag"
+# Pipeline có lịch sử chat nằm trong DB; RAG giữ lịch sử trong checkpointer theo từng chat nên không dùng chung được
+SINGLE_FLIGHT_PIPELINES = ("gemini",)
+# Lượt "viết tiếp" một câu trả lời bị gián đoạn; không được lưu vào chat
+CONTINUE_PROMPT = (
+    "Câu trả lời trước của bạn bị gián đoạn. Hãy viết tiếp đúng từ chỗ đã dừng, "
+    "không lặp lại phần đã viết và không mở đầu lại."
+)
+
+def parse_pipeline_command(message_text: str) -> Tuple[Optional[str], str]:
+    """
+    Tách lệnh `/rag` ở đầu tin nhắn.
+    Trả về (pipeline_type, nội dung gửi vào pipeline); pipeline_type là None
+    nếu không có lệnh, khi đó backend tự quyết định theo USE_RAG.
+    """
+    stripped = message_text.strip()
+    if stripped.startswith(RAG_COMMAND):
+        return "rag", stripped[len(RAG_COMMAND):].lstrip()
+    return None, message_text
+
+def generation_priority(pipeline_type: Optional[str]) -> Priority:
+    """Câu hỏi `/rag` chạy theo lô, nhường slot cho chat tương tác."""
+    return Priority.BATCH if pipeline_type == "rag" else Priority.INTERACTIVE
+
 async def generate_ai_response_stream(
     chat_id: str,
     user_message_content: str,
     file_ids: Optional[List[str]],
-    db: Session,
-    queue: asyncio.Queue,
+    queue: StreamBuffer,
     # Giữ nguyên pipeline_type để có thể override thủ công
-    pipeline_type: Optional[str] = None
+    pipeline_type: Optional[str] = None,
+    # False khi tin nhắn người dùng đã có trong DB (message_router, regenerate)
+    persist_user_message: bool = True,
+    # False khi người dùng yêu cầu sinh lại câu trả lời
+    use_answer_cache: bool = True,
+    # Quota token của người dùng, được tính lại theo câu trả lời thực tế
+    quota: Optional[QuotaReservation] = None,
+    # Id câu trả lời "partial" cần viết tiếp (khi đó user_message_content là CONTINUE_PROMPT)
+    continue_message_id: Optional[int] = None
 ):
     """
     Hàm điều phối chính cho AI response, sử dụng Strategy Pattern.
@@ -233,14 +288,34 @@ async def generate_ai_response_stream(
     1. Giá trị `pipeline_type` được truyền trực tiếp (ví dụ: từ lệnh /rag).
     2. Biến môi trường `USE_RAG=True`.
     3. Mặc định là 'gemini'.
+    Câu trả lời được lưu dần (trạng thái 'partial') trong lúc stream, xem ResponseCheckpoint;
+    hàm trả về PendingMessage của câu trả lời đó (None nếu chưa stream được gì).
+    Generation có thể chạy nhiều phút nên không giữ session DB: mỗi lần đọc/ghi
+    mở một session ngắn (AsyncSessionLocal), trả kết nối về pool ngay sau đó.
     """
+    checkpoint = None
     try:
-        # Bước 1: Lưu tin nhắn của người dùng (giữ nguyên)
-        crud.create_chat_message(
-            db=db, chat_id=int(chat_id), role="user",
-            content=user_message_content, file_ids=file_ids
-        )
-        logger.info(f"User message saved to DB for chat {chat_id}")
+        # Bước 1: Lưu tin nhắn của người dùng (ghi nền, không chờ commit trước khi gọi model)
+        pending_message = None
+        if persist_user_message:
+            pending_message = message_writer.submit(
+                int(chat_id), "user", user_message_content, file_ids
+            )
+        # Lịch sử chat phải có đủ các tin nhắn của lượt trước (có thể vẫn đang chờ ghi)
+        await message_writer.settled(int(chat_id), before=pending_message)
+
+        continued_message = None
+        if continue_message_id is not None:
+            async with AsyncSessionLocal() as db:
+                partial = await crud.aio.get_message(db, continue_message_id)
+            if partial is None or partial.chat_id != int(chat_id) or partial.status != PARTIAL:
+                raise ValueError(f"Message {continue_message_id} is not an interrupted answer of chat {chat_id}")
+            continued_message = message_writer.track(
+                partial.chat_id, partial.id, partial.role, partial.content, partial.status
+            )
+            # Lời nhắc viết tiếp chỉ có trong prompt, không ghi vào DB (id None: không trùng tin nhắn nào)
+            pending_message = PendingMessage(int(chat_id), "user", user_message_content)
+        checkpoint = ResponseCheckpoint(message_writer, queue, int(chat_id), continued_message)
 
         # --- BƯỚC 2: LOGIC CHỌN PIPELINE ĐÃ ĐƯỢC TỐI ƯU HÓA ---
         from .strategy import get_pipeline
@@ -255,32 +330,272 @@ async def generate_ai_response_stream(
         logger.info(f"Selected pipeline: '{final_pipeline_type}' (USE_RAG={USE_RAG}, override='{pipeline_type}')")
         
         # Lấy pipeline từ factory với các dependency cần thiết
-        pipeline = get_pipeline(
+        pipeline = await get_pipeline(
             pipeline_type=final_pipeline_type,
             config_service=get_settings() # Truyền config vào để factory sử dụng
         )
         # --- KẾT THÚC LOGIC CHỌN PIPELINE ---
 
-        # Bước 3: Lấy response từ pipeline (giữ nguyên)
-        response = await pipeline.generate_response(
-            chat_id=chat_id,
-            user_message_content=user_message_content,
-            file_ids=file_ids,
-            db=db,
-            queue=queue
-        )
+        if continued_message is not None and final_pipeline_type == "rag":
+            # RAG giữ lịch sử riêng, không có phần đã viết: gửi kèm trong lời nhắc
+            user_message_content = f"{user_message_content}\n\nPhần đã viết:\n{continued_message.content}"
 
-        # Bước 4: Lưu response vào DB (giữ nguyên)
-        if response.content and not response.error:
-            crud.create_chat_message(
-                db=db, chat_id=int(chat_id), role="model", content=response.content
+        # Chat chưa có lịch sử: câu trả lời không phụ thuộc vào chat, có thể dùng chung
+        if continued_message is not None:
+            first_turn = False
+        else:
+            async with AsyncSessionLocal() as db:
+                if pending_message is not None:
+                    # Tin nhắn đang chờ ghi không được đếm, dù đã được commit hay chưa
+                    first_turn = await crud.aio.count_messages_for_chat(
+                        db, chat_id=int(chat_id), exclude_message_id=pending_message.id
+                    ) == 0
+                else:
+                    first_turn = await crud.aio.count_messages_for_chat(db, chat_id=int(chat_id)) <= 1
+
+        # Câu hỏi mở đầu chat (không file) được tra trong cache câu trả lời
+        answer_probe = None
+        if use_answer_cache and first_turn and not file_ids and answer_cache.eligible(user_message_content):
+            cached_answer, answer_probe = await answer_cache.lookup(
+                final_pipeline_type, user_message_content, client
+            )
+            if cached_answer is not None:
+                await _stream_cached_answer(cached_answer, queue)
+                if quota is not None:
+                    quota.settle(0)
+                cached_message = message_writer.submit(int(chat_id), "model", cached_answer.content)
+                logger.info(f"Cached answer served for chat_id {chat_id}")
+                return cached_message
+
+        # Bước 3: Lấy response từ pipeline; câu hỏi mở đầu giống hệt nhau gửi cùng lúc dùng chung một lần gọi
+        if first_turn and final_pipeline_type in SINGLE_FLIGHT_PIPELINES and get_settings().single_flight_enabled:
+            response, joined = await _generate_single_flight(
+                pipeline, final_pipeline_type, chat_id, user_message_content, file_ids, checkpoint, pending_message
+            )
+            if joined and quota is not None:
+                quota.settle(0)
+        else:
+            response = await pipeline.generate_response(
+                chat_id=chat_id,
+                user_message_content=user_message_content,
+                file_ids=file_ids,
+                queue=checkpoint,
+                pending_message=pending_message
             )
-            logger.info(f"AI response saved for chat_id {chat_id}")
+
+        if quota is not None:
+            quota.settle(quota.prompt_tokens + estimate_text_tokens(response.content))
+
+        # Bước 4: Lưu response vào DB, đánh dấu 'complete'
+        if response.content and not response.error:
+            checkpoint.complete(response.content)
+            logger.info(f"AI response queued for saving for chat_id {chat_id}")
+            if answer_probe is not None:
+                answer_cache.store(answer_probe, response.content, response.artifacts)
         elif response.error:
             logger.error(f"Pipeline error from '{final_pipeline_type}': {response.error}")
+            # Phần đã stream được giữ lại dưới dạng 'partial' để có thể viết tiếp
+            checkpoint.interrupt()
 
+    except asyncio.CancelledError:
+        # Người dùng dừng, hoặc worker tắt: giữ lại phần đã stream
+        if checkpoint is not None:
+            checkpoint.interrupt()
+        raise
     except Exception as e:
         logger.error(f"Error in AI response stream for chat {chat_id}: {e}", exc_info=True)
-        await queue.put(json.dumps({"error": str(e), "text": "An error occurred during generation."}))
+        if checkpoint is not None:
+            checkpoint.interrupt()
+        await queue.put(StreamEvent.error(str(e), text="An error occurred during generation."))
     finally:
-        await queue.put("[DONE]")
\ No newline at end of file
+        await queue.close()
+    # Tin nhắn câu trả lời (đang chờ ghi); None nếu không có gì để lưu
+    return checkpoint.message if checkpoint is not None else None
+
+async def _generate_single_flight(
+    pipeline, pipeline_type: str, chat_id: str, user_message_content: str,
+    file_ids: Optional[List[str]], queue: StreamBuffer, pending_message=None
+):
+    """
+    Chạy pipeline qua single-flight: request đầu tiên với một khóa sẽ gọi LLM,
+    các request giống hệt đến trong lúc đó nhận lại toàn bộ event của lần gọi này.
+    Mỗi request tự lưu bản sao câu trả lời vào chat của mình.
+    Trả về (response, joined); joined=True khi request không tự gọi LLM.
+    """
+    async with AsyncSessionLocal() as db:
+        files = [(file_id, await file_crud.get_file_metadata_by_id(db, file_id)) for file_id in file_ids or []]
+    attachment_hashes = [await attachment_fingerprint(fm) if fm else file_id for file_id, fm in files]
+    key = flight_key(
+        pipeline_type,
+        (
+            getattr(pipeline, "model_name", None),
+            hashlib.sha256((getattr(pipeline, "system_instruction", None) or "").encode("utf-8")).hexdigest()
+        ),
+        user_message_content,
+        attachment_hashes
+    )
+
+    async def run(flight):
+        # Lần gọi thuộc về flight chứ không thuộc request khởi tạo
+        return await pipeline.generate_response(
+            chat_id=chat_id,
+            user_message_content=user_message_content,
+            file_ids=file_ids,
+            queue=flight,
+            pending_message=pending_message
+        )
+
+    flight, joined = single_flight.join(key, run)
+    if joined:
+        logger.info(f"Chat {chat_id} joined a running generation for an identical question")
+    async for event in flight.follow():
+        await queue.put(event)
+    if flight.response is None:
+        from .strategy import PipelineResponse
+        error = str(flight.error) if flight.error is not None else "Shared generation did not complete"
+        return PipelineResponse(content="", error=error), joined
+    return flight.response, joined
+
+async def _stream_cached_answer(cached_answer, queue: StreamBuffer):
+    """Phát lại câu trả lời đã cache qua đường streaming bình thường."""
+    await queue.put(StreamEvent.status(cached=True))
+    frame_chars = get_settings().stream_max_frame_chars
+    content = cached_answer.content
+    for start in range(0, len(content), frame_chars):
+        await queue.put(StreamEvent.chunk(content[start:start + frame_chars]))
+    if cached_answer.artifacts:
+        await queue.put(StreamEvent.artifact(cached_answer.artifacts))
+
+async def estimate_request_tokens(content: str, file_ids: Optional[List[str]]) -> int:
+    """Ước lượng số token prompt của tin nhắn mới và file đính kèm, trước khi gọi LLM."""
+    tokens = estimate_text_tokens(content)
+    if not file_ids:
+        return tokens
+    async with AsyncSessionLocal() as db:
+        for file_id in file_ids:
+            fm = await file_crud.get_file_metadata_by_id(db, file_id)
+            if fm is not None:
+                tokens += estimate_attachment_tokens(fm)
+    return tokens
+
+async def find_partial_answer(db: AsyncSession, chat_id: int) -> Optional[Message]:
+    """
+    Câu trả lời bị gián đoạn ('partial') ở cuối chat, có thể viết tiếp; None nếu không có
+    hoặc chat đang có generation chạy (câu trả lời đó chưa xong).
+    """
+    if generation_registry.active(chat_id):
+        return None
+    await message_writer.settled(chat_id)
+    last_message = await crud.aio.get_last_message(db, chat_id=chat_id)
+    if last_message is None or last_message.role == "user" or last_message.status != PARTIAL:
+        return None
+    return last_message
+
+async def start_generation(
+    chat_id: int,
+    content: str,
+    file_ids: Optional[List[str]],
+    persist_user_message: bool = True,
+    share: bool = True,
+    use_answer_cache: bool = True,
+    user_key: Optional[str] = None,
+    continue_message_id: Optional[int] = None,
+) -> Tuple[Generation, bool]:
+    """
+    Bắt đầu generation cho một lượt chat; dùng chung cho SSE và WebSocket.
+
+    Trả về (generation, shared): shared=True khi đã có generation đang chạy cho
+    cùng lượt chat (tab thứ hai, POST gửi lại) và request chỉ cần gắn vào nó.
+    Ném SchedulerFullError khi hàng đợi đầy, GenerationLimitError khi vượt giới hạn
+    (QuotaExceededError, kèm retry_after, khi `user_key` hết quota).
+    Với `continue_message_id`, generation viết tiếp câu trả lời 'partial' đó (xem find_partial_answer).
+    Không nhận session của request: generation tự mở session ngắn cho mỗi lần truy cập DB.
+    """
+    pipeline_type, message_for_pipeline = parse_pipeline_command(content)
+    priority = generation_priority(pipeline_type)
+    # Đọc DB trước: từ find_turn đến create không được có await, để hai request giống nhau không cùng tạo generation
+    prompt_tokens = await estimate_request_tokens(message_for_pipeline, file_ids)
+
+    turn = turn_key(chat_id, content, file_ids) if share else None
+    if turn is not None:
+        shared_generation = generation_registry.find_turn(turn)
+        if shared_generation is not None:
+            logger.info(f"Attaching to in-flight generation {shared_generation.id} for chat {chat_id}")
+            return shared_generation, True
+
+    # Quota của người dùng được giữ trước mọi thứ khác: vượt quota thì trả 429 ngay
+    quota = user_quotas.reserve(user_key, prompt_tokens)
+    ticket = None
+    try:
+        # Giữ slot LLM (hoặc chỗ trong hàng đợi) trước khi làm bất cứ việc gì,
+        # trừ khi phải chờ quota: khi đó slot được xin sau khi chờ xong
+        if not quota.delay:
+            ticket = generation_scheduler.admit(priority)
+        generation = generation_registry.create(chat_id, turn=turn)
+    except Exception:
+        if ticket is not None:
+            ticket.release()
+        quota.release()
+        raise
+    generation_id = generation.id
+    queue = generation.buffer
+    generation.queued = ticket is None or not ticket.granted
+
+    async def report_queue_position(position: int):
+        await queue.put(StreamEvent.status(queue_position=position))
+
+    def on_slot_granted():
+        generation.queued = False
+
+    async def run_generation():
+        nonlocal ticket
+        try:
+            if ticket is None:
+                await queue.put(StreamEvent.status(quota_wait=round(quota.delay, 1)))
+                await asyncio.sleep(quota.delay)
+                try:
+                    ticket = generation_scheduler.admit(priority)
+                except SchedulerFullError as e:
+                    await queue.put(StreamEvent.error(str(e), text="Server is busy, please try again."))
+                    await queue.close()
+                    return
+            await generation_scheduler.run(
+                ticket,
+                generate_ai_response_stream(
+                    chat_id=str(chat_id),
+                    user_message_content=message_for_pipeline,
+                    file_ids=file_ids,
+                    queue=queue,
+                    pipeline_type=pipeline_type,
+                    persist_user_message=persist_user_message,
+                    use_answer_cache=use_answer_cache,
+                    quota=quota,
+                    continue_message_id=continue_message_id,
+                ),
+                on_position=report_queue_position,
+                on_granted=on_slot_granted,
+            )
+        finally:
+            quota.release()
+
+    def release_slot():
+        # Task bị huỷ trước khi chạy thì `finally` của run_generation không chạy:
+        # trả slot và quota ở đây (release() không làm gì nếu đã trả rồi)
+        if ticket is not None:
+            ticket.release()
+        quota.release()
+
+    logger.info(f"Starting generate_ai_response_stream for generation_id: {generation_id}")
+    generation_task = generation.start(run_generation(), on_done=release_slot)
+
+    def on_generation_done(task):
+        if task.cancelled():
+            logger.info(f"Generation task for {generation_id} was cancelled")
+        elif task.exception():
+            logger.error(f"Generation task for {generation_id} raised an exception: {task.exception()}",
+                         exc_info=task.exception())
+        else:
+            logger.info(f"Generation task for {generation_id} completed successfully")
+
+    generation_task.add_done_callback(on_generation_done)
+    return generation, False
\ No newline at end of file
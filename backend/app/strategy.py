@@ -10,16 +10,61 @@ The strategy pattern allows easy switching between pipelines via configuration.
 
 import abc
 import asyncio
-import json
 import logging
-from typing import Dict, List, Optional, Any
-from sqlalchemy.orm import Session
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Any, Tuple
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
 from app.rag.orchestrator.graph_builder import GraphBuilder
 from app.rag.config.config_loader import CONFIG as RAG_CONFIG
+from app.streaming import StreamBuffer, StreamEvent
+from app.config import get_settings
+from app.context import (
+    AttachmentRef,
+    ChatContext,
+    PreparedMessage,
+    attachment_digest,
+    estimate_contents_tokens,
+    estimate_message_tokens,
+    estimate_text_tokens,
+    plan_history,
+    prompt_context_cache,
+    retained_attachments,
+)
+from app.summaries import SUMMARY_PREFIX, chat_summarizer
+from app.llm.hedging import SECONDARY, hedger
+from app.llm.pacer import gemini_pacer
+from app.llm.resilience import CHAT_MODEL, GEMINI, resilience
+from app.crud.aio import file_crud
+from app.database import AsyncSessionLocal
+from app.attachments import attachment_transport
+from app.attachment_io import attachment_io, read_bytes
+from app.extracted_text import get_extracted_text_async, is_text_attachment
 
 logger = logging.getLogger(__name__)
 
+
+def _part_size(part) -> int:
+    """Approximate memory held by a prepared part (text and inline data)."""
+    size = len(getattr(part, "text", None) or "")
+    inline_data = getattr(part, "inline_data", None)
+    if inline_data is not None:
+        size += len(getattr(inline_data, "data", None) or b"")
+    return size
+
+
+async def _close_stream(stream) -> None:
+    """Close an async response stream, releasing the upstream HTTP connection."""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        logger.debug(f"Error closing upstream stream: {e}")
+
 class PipelineResponse:
     """Standard response format for all pipelines."""
     def __init__(self, content: str, artifacts: Optional[List[Dict]] = None, error: Optional[str] = None):
@@ -42,89 +87,240 @@ class PipelineStrategy(abc.ABC):
         chat_id: str,
         user_message_content: str,
         file_ids: Optional[List[str]],
-        db: Session,
-        queue: asyncio.Queue
+        queue: StreamBuffer,
+        pending_message=None
     ) -> PipelineResponse:
-        """Generate AI response using the specific pipeline strategy."""
+        """
+        Generate AI response using the specific pipeline strategy.
+        ``pending_message`` is the user message still queued in the message writer, if any.
+        A generation can run for minutes, so pipelines hold no DB session: each
+        DB access opens a short one (``AsyncSessionLocal``).
+        """
         pass
 
     @abc.abstractmethod
-    async def _prepare_context(self, chat_id: str, db: Session) -> List[Any]:
+    async def _prepare_context(self, chat_id: str) -> List[Any]:
         """Prepare context from chat history."""
         pass
 
     @abc.abstractmethod
-    async def _process_files(self, file_ids: Optional[List[str]], db: Session) -> List[Any]:
+    async def _process_files(self, file_ids: Optional[List[str]]) -> List[Any]:
         """Process attached files for the pipeline."""
         pass 
 
 class GeminiPipeline(PipelineStrategy):
     """Pipeline strategy for direct Gemini API calls."""
-    def __init__(self, client, types, model_name, system_instruction, crud_service=None, file_service=None):
+    def __init__(self, client, types, model_name, system_instruction, crud_service=None, file_service=None,
+                 hedge_chat_config=None):
         self.client = client
         self.types = types
         self.model_name = model_name
         self.system_instruction = system_instruction
         self.crud_service = crud_service
         self.file_service = file_service
+        # chat_model_config của RAG (Azure/OpenAI), dùng làm model dự phòng khi Gemini chậm
+        self.hedge_chat_config = hedge_chat_config
+        self._secondary_model = None
 
-    async def _prepare_context(self, chat_id: str, db: Session) -> list:
-        """Chuẩn bị context từ lịch sử chat cho Gemini."""
+    async def _prepare_context(self, chat_id: str, pending_message=None) -> list:
+        """
+        Chuẩn bị context từ lịch sử chat cho Gemini.
+        Dùng cache theo chat: chỉ chuẩn bị các tin nhắn mới sau lần gọi trước.
+        File đính kèm cũ được thay bằng mô tả ngắn; lịch sử vượt ngân sách token
+        được thay bằng bản tóm tắt của chat.
+        Tin nhắn người dùng đang chờ ghi (`pending_message`) được thêm từ bộ nhớ,
+        không đợi DB và không đưa vào cache (lượt sau sẽ đọc nó từ DB).
+        """
         if not self.crud_service:
             logger.warning("crud_service not provided, returning empty context")
             return []
-            
-        chat_history_models = self.crud_service.get_messages_for_chat(db, chat_id=int(chat_id))
-        gemini_prompt_contents = []
-        for msg_model in chat_history_models:
-            message_parts = [self.types.Part(text=msg_model.content)]
-            # Nếu message có file đính kèm, truyền nội dung file vào prompt
-            if hasattr(msg_model, 'files') and msg_model.files:
-                for fm in msg_model.files:
-                    file_parts = await self._prepare_single_file_for_gemini(fm, db)
-                    if file_parts:
-                        message_parts.extend(file_parts)
-            gemini_prompt_contents.append(
-                self.types.Content(
-                    role="user" if msg_model.role == "user" else "model",
-                    parts=message_parts
+
+        chat_id_int = int(chat_id)
+        cached = prompt_context_cache.get(chat_id_int)
+        # Chỉ đọc DB trong session này; file đính kèm được chuẩn bị sau khi trả kết nối
+        async with AsyncSessionLocal() as db:
+            if cached is not None and await self.crud_service.count_messages_up_to(
+                db, chat_id=chat_id_int, message_id=cached.last_message_id
+            ) == cached.message_count:
+                context = cached.copy()
+                new_messages = await self.crud_service.get_messages_for_chat_after(
+                    db, chat_id=chat_id_int, after_message_id=cached.last_message_id
                 )
+            else:
+                # Lần đầu, hoặc tin nhắn cũ đã bị xoá ở nơi khác: dựng lại toàn bộ
+                if cached is not None:
+                    prompt_context_cache.invalidate(chat_id_int)
+                context = ChatContext()
+                new_messages = await self.crud_service.get_messages_for_chat(db, chat_id=chat_id_int)
+            pending_files = []
+            if pending_message is not None:
+                pending_files = [
+                    await file_crud.get_file_metadata_by_id(db, file_id) for file_id in pending_message.file_ids
+                ]
+
+        current = None
+        if pending_message is not None:
+            # Id được gán trước khi commit: nếu đọc thấy dòng này thì id đã có
+            new_messages = [msg for msg in new_messages if msg.id != pending_message.id]
+            current = SimpleNamespace(
+                role=pending_message.role,
+                content=pending_message.content,
+                files=[fm for fm in pending_files if fm is not None],
             )
-        return gemini_prompt_contents
 
-    async def _process_files(self, file_ids: Optional[list], db: Session) -> list:
+        # File đính kèm của mọi tin nhắn được chuẩn bị song song, không lần lượt từng file
+        prepared_files = await self._prepare_files(list(new_messages) + ([current] if current is not None else []))
+        for msg_model in new_messages:
+            context.append(msg_model.id, self._prepare_message_content(msg_model, prepared_files))
+
+        prompt_context_cache.put(chat_id_int, context)
+        if current is not None:
+            context = context.copy()
+            # Id tạm lớn hơn mọi tin nhắn đã có, để không bị coi là đã nằm trong bản tóm tắt
+            context.append(context.last_message_id + 1, self._prepare_message_content(current, prepared_files))
+        return await self._assemble_contents(chat_id_int, context)
+
+    async def _assemble_contents(self, chat_id: int, context: ChatContext) -> list:
+        """
+        Chọn nội dung gửi đi: file đính kèm chỉ gửi lại ở các lượt gần nhất (hoặc khi được nhắc tới),
+        giữ nguyên các tin nhắn gần nhất trong ngân sách token, phần cũ hơn thay bằng bản tóm tắt.
+        """
+        settings = get_settings()
+        messages = context.messages
+        current_text = messages[-1].content.parts[0].text if messages else ""
+        retained = retained_attachments(messages, current_text, settings.attachment_retention_turns)
+        contents = [m.content if keep else m.digest for m, keep in zip(messages, retained)]
+        tokens = [m.tokens if keep else m.digest_tokens for m, keep in zip(messages, retained)]
+
+        start = 0
+        summary = None
+        if settings.context_token_budget > 0:
+            start, summary = await self._apply_token_budget(chat_id, context.message_ids, tokens)
+
+        # Lượt này gửi lại các file inline; file dùng lại nhiều lần sẽ được upload lên Files API ở nền
+        attachment_transport.record_uses(
+            [ref.file_id for m, keep in zip(messages[start:], retained[start:]) if keep
+             for ref in m.attachments if ref.inline],
+            self.client,
+        )
+        contents = contents[start:]
+        if summary:
+            summary_content = self.types.Content(role="user", parts=[self.types.Part(text=SUMMARY_PREFIX + summary)])
+            contents = [summary_content] + contents
+        return contents
+
+    async def _apply_token_budget(
+        self, chat_id: int, message_ids: List[int], tokens: List[int]
+    ) -> Tuple[int, Optional[str]]:
+        """Vị trí tin nhắn đầu tiên gửi nguyên văn, và bản tóm tắt thay cho phần trước đó."""
+        settings = get_settings()
+        async with AsyncSessionLocal() as db:
+            chat = await self.crud_service.get_chat(db, chat_id)
+        summary = chat.summary if chat is not None else None
+        summary_upto = (chat.summary_upto_message_id or 0) if summary else 0
+        plan = plan_history(
+            message_ids,
+            tokens,
+            summary_upto=summary_upto,
+            summary_tokens=estimate_text_tokens(summary),
+            budget=settings.context_token_budget,
+            recent_messages=settings.context_recent_messages,
+        )
+        if plan.summarize_upto is not None:
+            # Tóm tắt chạy ở nền; lượt hiện tại dùng bản tóm tắt đang có
+            chat_summarizer.schedule(chat_id, plan.summarize_upto, self.client, self.model_name)
+        if plan.dropped:
+            logger.info(f"Chat {chat_id}: {plan.dropped} older messages left out until the summary catches up")
+        return plan.start, summary
+
+    async def _prepare_files(self, messages: list) -> Dict[str, Optional[list]]:
+        """
+        Parts của mọi file đính kèm trong `messages`, theo id file. Các file được chuẩn bị
+        đồng thời (tối đa ATTACHMENT_PREPARE_CONCURRENCY), đọc đĩa/trích xuất text trên
+        thread pool riêng: lượt có 5 file chỉ mất khoảng thời gian của file chậm nhất.
+        """
+        files = {}
+        for msg_model in messages:
+            for fm in getattr(msg_model, 'files', None) or []:
+                files.setdefault(fm.id, fm)
+        parts = await attachment_io.gather(files.values(), self._prepare_single_file_for_gemini)
+        return dict(zip(files, parts))
+
+    def _prepare_message_content(self, msg_model, prepared_files: Dict[str, Optional[list]]) -> PreparedMessage:
+        """
+        Một tin nhắn -> types.Content kèm kích thước, số token ước lượng, thời điểm hết hiệu lực
+        của file Gemini, và bản thay file đính kèm bằng mô tả ngắn (dùng cho các lượt cũ).
+        `prepared_files` là kết quả của `_prepare_files`.
+        """
+        message_parts = [self.types.Part(text=msg_model.content)]
+        digest_parts = [self.types.Part(text=msg_model.content)]
+        expires_at = None
+        attachments = []
+        # Nếu message có file đính kèm, truyền nội dung file vào prompt
+        if hasattr(msg_model, 'files') and msg_model.files:
+            for fm in msg_model.files:
+                file_parts = prepared_files.get(fm.id)
+                if not file_parts:
+                    continue
+                message_parts.extend(file_parts)
+                inline = any(getattr(part, "inline_data", None) is not None for part in file_parts)
+                attachments.append(AttachmentRef(fm.id, fm.original_filename or "", inline))
+                text_content = file_parts[-1].text if is_text_attachment(fm.content_type) else None
+                digest_parts.append(self.types.Part(text=attachment_digest(fm, text_content)))
+                if not inline and any(getattr(part, "file_data", None) is not None for part in file_parts):
+                    # Tham chiếu Files API chỉ dùng được đến 1 giờ trước khi file hết hạn
+                    file_expiry = attachment_transport.expires_at(fm.id)
+                    if file_expiry is None and fm.gemini_api_expiry_timestamp:
+                        file_expiry = fm.gemini_api_expiry_timestamp - timedelta(hours=1)
+                    if file_expiry is not None and (expires_at is None or file_expiry < expires_at):
+                        expires_at = file_expiry
+        role = "user" if msg_model.role == "user" else "model"
+        content = self.types.Content(role=role, parts=message_parts)
+        size = sum(_part_size(part) for part in message_parts)
+        if not attachments:
+            return PreparedMessage(content, size, estimate_message_tokens(msg_model), expires_at)
+        digest = self.types.Content(role=role, parts=digest_parts)
+        return PreparedMessage(
+            content,
+            size + sum(_part_size(part) for part in digest_parts),
+            estimate_message_tokens(msg_model),
+            expires_at,
+            tuple(attachments),
+            digest,
+            sum(estimate_text_tokens(part.text) for part in digest_parts),
+        )
+
+    async def _process_files(self, file_ids: Optional[list]) -> list:
         # Đã xử lý file trong _prepare_context, nên trả về []
         return []
 
-    async def _prepare_single_file_for_gemini(self, fm, db):
+    async def _prepare_single_file_for_gemini(self, fm):
         """Chuẩn bị file cho Gemini API."""
         import os
         try:
             context_part = self.types.Part(text=f"[File đính kèm: {fm.original_filename}, loại: {fm.content_type}]")
-            if fm.content_type == 'text/plain':
-                with open(fm.local_disk_path, 'r', encoding='utf-8', errors='replace') as f:
-                    text_content = f.read()
-                return [context_part, self.types.Part(text=text_content)]
-            elif fm.content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-                if self.file_service:
-                    text_content = self.file_service.extract_text_from_docx(fm.local_disk_path)
-                else:
-                    # Fallback nếu không có file_service
-                    import docx
-                    doc = docx.Document(fm.local_disk_path)
-                    text_content = '\n'.join([para.text for para in doc.paragraphs])
+            if is_text_attachment(fm.content_type):
+                # Text đã trích xuất một lần lúc upload (hoặc lần dùng đầu tiên), không parse lại DOCX
+                text_content = await get_extracted_text_async(fm)
+                if text_content is None:
+                    logger.warning(f"No text available for attachment {fm.id}")
+                    return None
                 return [context_part, self.types.Part(text=text_content)]
-            elif fm.processing_method == 'inline':
-                with open(fm.local_disk_path, 'rb') as f_bytes:
-                    file_data = f_bytes.read()
+            # File đã có trên Files API (upload lớn, hoặc file inline được dùng lại nhiều lần):
+            # chỉ gửi tham chiếu, làm mới ở nền khi gần hết hạn
+            reference_part = await attachment_transport.reference_part(fm, self.client)
+            if reference_part is not None:
+                return [context_part, reference_part]
+            if fm.processing_method == 'inline':
+                file_data = await attachment_io.run(read_bytes, fm.local_disk_path)
                 return [context_part, self.types.Part(inline_data={"data": file_data, "mime_type": fm.content_type})]
             elif fm.processing_method == 'files_api' and fm.gemini_api_file_id:
                 if self.file_service:
-                    gemini_file_id = self.file_service.refresh_gemini_file_if_needed(fm, db)
+                    gemini_file_id = await self.file_service.refresh_gemini_file_if_needed(fm)
                 else:
                     # Fallback logic
                     gemini_file_id = fm.gemini_api_file_id
-                return [context_part, self.types.Part(uri=gemini_file_id, mime_type=fm.content_type)]
+                return [context_part, self.types.Part.from_uri(file_uri=gemini_file_id, mime_type=fm.content_type)]
             else:
                 logger.warning(f"Unknown processing_method '{fm.processing_method}' for file {fm.id}")
                 return None
@@ -132,38 +328,89 @@ class GeminiPipeline(PipelineStrategy):
             logger.error(f"Error preparing file {fm.id}: {e}", exc_info=True)
             return None
 
+    async def _gemini_stream(self, contents: list):
+        """Các đoạn text trả về từ Gemini."""
+        # Chờ vừa đủ để không vượt quota RPM/TPM của Gemini, thay vì bị từ chối với RESOURCE_EXHAUSTED
+        pacing = await gemini_pacer.acquire(
+            estimate_contents_tokens(contents) + estimate_text_tokens(self.system_instruction)
+        )
+        # Dùng client.aio để mỗi lần đọc mạng đều nhường event loop,
+        # thay vì lặp iterator đồng bộ ngay trong coroutine.
+        response_stream = await self.client.aio.models.generate_content_stream(
+            model=self.model_name,
+            contents=contents,
+            config=self.types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                temperature=0.7
+            )
+        )
+        usage = None
+        try:
+            async for chunk in response_stream:
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                if hasattr(chunk, 'text') and chunk.text:
+                    yield chunk.text
+        finally:
+            pacing.settle(getattr(usage, 'total_token_count', None))
+            await _close_stream(response_stream)
+
+    async def _secondary_stream(self, contents: list):
+        """Cùng prompt gửi tới chat model dự phòng (chỉ phần text; file nhị phân được thay bằng tên file)."""
+        if self._secondary_model is None:
+            from app.rag.factories.chat_factory import create_chat_model
+            self._secondary_model = create_chat_model(self.hedge_chat_config)
+        messages = [SystemMessage(content=self.system_instruction)]
+        for content in contents:
+            texts = []
+            for part in content.parts or []:
+                if getattr(part, "text", None):
+                    texts.append(part.text)
+                elif getattr(part, "inline_data", None) is not None or getattr(part, "file_data", None) is not None:
+                    texts.append("[File đính kèm không gửi được tới model này]")
+            text = "\n".join(texts)
+            messages.append(HumanMessage(content=text) if content.role == "user" else AIMessage(content=text))
+        async for chunk in self._secondary_model.astream(messages):
+            if isinstance(chunk.content, str) and chunk.content:
+                yield chunk.content
+
     async def generate_response(
         self,
         chat_id: str,
         user_message_content: str,
         file_ids: Optional[list],
-        db: Session,
-        queue: asyncio.Queue
+        queue: StreamBuffer,
+        pending_message=None
     ) -> PipelineResponse:
         """
         Triển khai logic gọi Gemini API.
         Đã sửa để gửi về các chunk JSON hợp lệ.
         """
         try:
-            gemini_prompt_contents = await self._prepare_context(chat_id, db)
-            
+            gemini_prompt_contents = await self._prepare_context(chat_id, pending_message)
+
             logger.info(f"Sending request to Gemini for chat_id {chat_id}")
-            response_stream = self.client.models.generate_content_stream(
-                model=self.model_name,
-                contents=gemini_prompt_contents,
-                config=self.types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    temperature=0.7
-                )
+            secondary = None
+            if self.hedge_chat_config is not None:
+                secondary = lambda: resilience.stream(CHAT_MODEL, lambda: self._secondary_stream(gemini_prompt_contents))
+            # Nếu Gemini chưa trả chunk đầu sau ngưỡng p95, gửi thêm request tới model dự phòng;
+            # stream nào bắt đầu trước được giữ, stream kia bị huỷ.
+            # Lỗi tạm thời trước chunk đầu được thử lại (backoff), circuit breaker chặn khi Gemini sập
+            stream = hedger.stream(
+                lambda: resilience.stream(GEMINI, lambda: self._gemini_stream(gemini_prompt_contents)), secondary
             )
 
             ai_response_content = ""
-            for chunk in response_stream:
-                if hasattr(chunk, 'text') and chunk.text:
-                    ai_response_content += chunk.text
-                    # Đảm bảo luôn gửi JSON string hợp lệ
-                    json_chunk = json.dumps({"text": chunk.text})
-                    await queue.put(json_chunk)
+            try:
+                async for source, text in stream:
+                    if source == SECONDARY and not ai_response_content:
+                        await queue.put(StreamEvent.status(model=self.hedge_chat_config.get("deployment_name")))
+                    ai_response_content += text
+                    # Buffer gộp các chunk nhỏ, journal encode JSON đúng một lần
+                    await queue.put(StreamEvent.chunk(text))
+            finally:
+                # Khi task bị huỷ (qua /chats/{chat_id}/interrupt) CancelledError
+                # được ném ra tại `async for`; đóng ngay kết nối upstream.
+                await _close_stream(stream)
 
             logger.info(f"Gemini response generated for chat_id {chat_id}")
             return PipelineResponse(content=ai_response_content.strip())
@@ -171,13 +418,13 @@ class GeminiPipeline(PipelineStrategy):
         except Exception as e:
             logger.error(f"Error in GeminiPipeline: {e}")
             error_message = f"Lỗi từ Gemini pipeline: {e}"
-            await queue.put(json.dumps({"error": error_message}))
+            await queue.put(StreamEvent.error(error_message))
             return PipelineResponse(content="", error=error_message)
 
 class RagPipeline(PipelineStrategy):
     """Pipeline strategy for RAG (Retrieval-Augmented Generation)."""
-    def __init__(self, rag_config=None):
-        self.graph_builder = GraphBuilder(config=rag_config)
+    def __init__(self, rag_config=None, memory=None):
+        self.graph_builder = GraphBuilder(config=rag_config, memory=memory)
         self.graph = self.graph_builder.graph
         self.rag_config = rag_config
 
@@ -186,47 +433,65 @@ class RagPipeline(PipelineStrategy):
         chat_id: str,
         user_message_content: str,
         file_ids: Optional[list],
-        db: Session,
-        queue: asyncio.Queue
+        queue: StreamBuffer,
+        pending_message=None
     ) -> PipelineResponse:
         try:
-            state = {"messages": [{"role": "user", "content": user_message_content}]}
+            # Nội dung các file text/docx đính kèm (đọc từ kho text đã trích xuất)
+            attachment_texts = await self._process_files(file_ids)
+            question = "\n\n".join(attachment_texts + [user_message_content])
+            state = {"messages": [{"role": "user", "content": question}]}
             content = ""
             artifacts = []
             
             async for event in self.graph.astream(state, {"configurable": {"thread_id": chat_id}}):
-                print(f"DEBUG: RAG event = {repr(event)}")
+                logger.debug(f"RAG event = {repr(event)}")
                 if "agent" in event and "messages" in event["agent"]:
-                    print(f"DEBUG: RAG event['agent']['messages'] = {repr(event['agent']['messages'])}")
                     for msg in event["agent"]["messages"]:
-                        print(f"DEBUG: RAG msg type = {type(msg)}, msg = {repr(msg)}")
-                        if isinstance(msg, dict) and "content" in msg:
-                            chunk_text = msg["content"]
-                            print(f"DEBUG: RAG chunk_text = {repr(chunk_text)}")
-                            content += chunk_text
-                            await queue.put(json.dumps({"text": chunk_text}))
-                        elif hasattr(msg, "content"):
-                            chunk_text = msg.content
-                            print(f"DEBUG: RAG chunk_text (attr) = {repr(chunk_text)}")
+                        if isinstance(msg, dict):
+                            chunk_text = msg.get("content") or ""
+                            tool_calls = msg.get("tool_calls") or []
+                        else:
+                            chunk_text = getattr(msg, "content", "") or ""
+                            tool_calls = getattr(msg, "tool_calls", None) or []
+                        # Lượt gọi tool có thể không kèm nội dung; không gửi chunk rỗng
+                        if isinstance(chunk_text, str) and chunk_text:
                             content += chunk_text
-                            await queue.put(json.dumps({"text": chunk_text}))
-                        # Xử lý artifact nếu có
-                        if isinstance(msg, dict) and "artifact" in msg:
+                            await queue.put(StreamEvent.chunk(chunk_text))
+                        for tool_call in tool_calls:
+                            await queue.put(StreamEvent.tool_call(
+                                tool_call.get("name", ""), tool_call.get("args"), tool_call.get("id")
+                            ))
+                # Nguồn tài liệu do tool retriever trả về được gửi thành event artifact riêng
+                if "run_tool_retriever" in event and "messages" in event["run_tool_retriever"]:
+                    for msg in event["run_tool_retriever"]["messages"]:
+                        if isinstance(msg, dict) and msg.get("artifact"):
                             artifacts.extend(msg["artifact"])
-                            await queue.put(json.dumps({"artifacts": msg["artifact"]}))
-                             
+                            await queue.put(StreamEvent.artifact(msg["artifact"]))
+
             return PipelineResponse(content=content, artifacts=artifacts)
         except Exception as e:
             logger.error(f"Error in RagPipeline: {e}")
             error_message = f"Lỗi từ RAG pipeline: {e}"
-            await queue.put(json.dumps({"error": error_message}))
+            await queue.put(StreamEvent.error(error_message))
             return PipelineResponse(content="", error=error_message)
 
-    async def _prepare_context(self, chat_id: str, db: Session) -> list:
+    async def _prepare_context(self, chat_id: str) -> list:
         return []
 
-    async def _process_files(self, file_ids: Optional[list], db: Session) -> list:
-        return []
+    async def _process_files(self, file_ids: Optional[list]) -> list:
+        """Text của các file text/docx đính kèm; file nhị phân (PDF, ảnh) không dùng được cho RAG."""
+        if not file_ids:
+            return []
+        async with AsyncSessionLocal() as db:
+            files = [await file_crud.get_file_metadata_by_id(db, file_id=file_id) for file_id in file_ids]
+        files = [fm for fm in files if fm is not None and is_text_attachment(fm.content_type)]
+        # Các file được đọc song song trên thread pool riêng
+        texts = await attachment_io.gather(files, get_extracted_text_async)
+        return [
+            f"[File đính kèm: {fm.original_filename}]\n{text_content}"
+            for fm, text_content in zip(files, texts) if text_content
+        ]
 
 class PipelineFactory:
     """Factory class để tạo pipeline dựa trên configuration."""
@@ -252,12 +517,13 @@ class PipelineFactory:
             model_name=model_name,
             system_instruction=system_instruction,
             crud_service=self.crud_service,
-            file_service=self.file_service
+            file_service=self.file_service,
+            hedge_chat_config=(self.rag_config or {}).get("chat_model_config") if get_settings().llm_hedge_enabled else None
         )
     
-    def create_rag_pipeline(self):
+    def create_rag_pipeline(self, memory=None):
         # Luôn truyền self.rag_config (không bao giờ None)
-        return RagPipeline(rag_config=self.rag_config)
+        return RagPipeline(rag_config=self.rag_config, memory=memory)
     
     def get_pipeline(self, pipeline_type: str = "gemini"):
         if pipeline_type.lower() == "gemini":
@@ -272,18 +538,159 @@ class PipelineFactory:
 def create_pipeline_factory(client, types, crud_service, file_service, config_service=None, rag_config=None):
     return PipelineFactory(client, types, crud_service, file_service, config_service, rag_config)
 
+class PipelineRegistry:
+    """
+    Pipeline dùng chung cho cả process, tạo một lần (lúc khởi động hoặc lần dùng đầu) rồi tái sử dụng.
+
+    Trước đây mỗi request dựng PipelineFactory mới; với RAG là một GraphBuilder mới
+    (chat model client, bind_tools, compile graph, MemorySaver rỗng nên mất luôn bộ
+    nhớ hội thoại). Các pipeline không giữ trạng thái theo request nên dùng chung được.
+    ``reload()`` đọc lại cấu hình và thay pipeline mới mà không cần khởi động lại;
+    request đang chạy vẫn dùng instance cũ.
+    """
+
+    PIPELINE_TYPES = ("gemini", "rag")
+
+    def __init__(self):
+        self._pipelines: Dict[str, PipelineStrategy] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        # Chỉ dùng trên event loop; việc dựng chạy trong thread nên loop không bị chặn
+        self._lock = asyncio.Lock()
+        self._rag_config = None
+        self.reloads = 0
+        self.warmup_seconds: Optional[float] = None
+
+    def _factory(self) -> PipelineFactory:
+        from . import services
+        from google.genai import types
+        return create_pipeline_factory(
+            client=services.client,
+            types=types,
+            crud_service=services.crud.aio,
+            file_service=services,
+            config_service=get_settings(),
+            rag_config=self._rag_config,
+        )
+
+    def _stats_for(self, pipeline_type: str) -> Dict[str, Any]:
+        return self._stats.setdefault(pipeline_type, {"version": 0, "requests": 0, "lookup_seconds": 0.0})
+
+    def _build(self, pipeline_type: str, factory: PipelineFactory) -> PipelineStrategy:
+        # Chạy trong thread (asyncio.to_thread)
+        started = time.perf_counter()
+        if pipeline_type == "rag":
+            # Giữ bộ nhớ hội thoại của graph cũ khi reload
+            previous = self._pipelines.get("rag")
+            pipeline = factory.create_rag_pipeline(
+                memory=previous.graph_builder.memory if previous is not None else None
+            )
+        else:
+            pipeline = factory.get_pipeline(pipeline_type)
+        build_seconds = time.perf_counter() - started
+        logger.info(f"Pipeline '{pipeline_type}' built in {build_seconds:.3f}s")
+        return pipeline
+
+    def _installed(self, pipeline_type: str, pipeline: PipelineStrategy, build_seconds: float) -> None:
+        self._pipelines[pipeline_type] = pipeline
+        stats = self._stats_for(pipeline_type)
+        stats.update(version=stats["version"] + 1, built_at=datetime.utcnow(), build_seconds=build_seconds, last_error=None)
+
+    @classmethod
+    def _check_type(cls, pipeline_type: str) -> str:
+        pipeline_type = pipeline_type.lower()
+        if pipeline_type not in cls.PIPELINE_TYPES:
+            raise ValueError(f"Unknown pipeline type: {pipeline_type}")
+        return pipeline_type
+
+    def get(self, pipeline_type: str = "gemini") -> Optional[PipelineStrategy]:
+        """Instance hiện tại, không chờ và không dựng; None nếu chưa được dựng (xem ``acquire``)."""
+        return self._pipelines.get(self._check_type(pipeline_type))
+
+    async def acquire(self, pipeline_type: str = "gemini") -> PipelineStrategy:
+        """Instance hiện tại; lần dùng đầu thì dựng trong thread, mỗi loại chỉ dựng một lần."""
+        pipeline_type = self._check_type(pipeline_type)
+        started = time.perf_counter()
+        pipeline = self._pipelines.get(pipeline_type)
+        if pipeline is None:
+            async with self._lock:
+                pipeline = self._pipelines.get(pipeline_type)
+                if pipeline is None:
+                    build_started = time.perf_counter()
+                    try:
+                        pipeline = await asyncio.to_thread(self._build, pipeline_type, self._factory())
+                    except Exception as e:
+                        self._stats_for(pipeline_type)["last_error"] = str(e)
+                        raise
+                    self._installed(pipeline_type, pipeline, time.perf_counter() - build_started)
+        stats = self._stats_for(pipeline_type)
+        stats["requests"] += 1
+        stats["lookup_seconds"] += time.perf_counter() - started
+        return pipeline
+
+    async def warmup(self, pipeline_types: Optional[List[str]] = None) -> None:
+        """Dựng trước các pipeline (trong thread, không chặn event loop); lỗi chỉ ghi log, lần dùng đầu sẽ thử lại."""
+        started = time.perf_counter()
+        for pipeline_type in pipeline_types or self.PIPELINE_TYPES:
+            try:
+                await self.acquire(pipeline_type)
+            except Exception as e:
+                logger.error(f"Warmup of pipeline '{pipeline_type}' failed: {e}", exc_info=True)
+        self.warmup_seconds = time.perf_counter() - started
+
+    async def reload(self) -> None:
+        """Đọc lại Settings và config.yaml rồi dựng lại các pipeline đã có, thay thế nguyên tử."""
+        from app.rag.config.config_loader import load_config
+
+        def rebuild(pipeline_types: List[str]) -> Dict[str, Tuple[PipelineStrategy, float]]:
+            get_settings.cache_clear()
+            self._rag_config = load_config()
+            factory = self._factory()
+            rebuilt = {}
+            for pipeline_type in pipeline_types:
+                build_started = time.perf_counter()
+                rebuilt[pipeline_type] = (self._build(pipeline_type, factory), time.perf_counter() - build_started)
+            return rebuilt
+
+        async with self._lock:
+            rebuilt = await asyncio.to_thread(rebuild, list(self._pipelines))
+            # Thay trên event loop: request nào cũng thấy hoặc toàn bộ bản cũ hoặc bản mới
+            for pipeline_type, (pipeline, build_seconds) in rebuilt.items():
+                self._installed(pipeline_type, pipeline, build_seconds)
+            self.reloads += 1
+        logger.info("Pipelines reloaded")
+
+    def stats(self) -> Dict[str, Any]:
+        pipelines = {}
+        for pipeline_type, stats in self._stats.items():
+            requests = stats["requests"]
+            pipelines[pipeline_type] = {
+                "loaded": pipeline_type in self._pipelines,
+                "version": stats["version"],
+                "built_at": stats.get("built_at"),
+                "build_seconds": stats.get("build_seconds"),
+                "requests": requests,
+                "avg_lookup_ms": stats["lookup_seconds"] * 1000 / requests if requests else 0.0,
+                "last_error": stats.get("last_error"),
+            }
+        return {"pipelines": pipelines, "reloads": self.reloads, "warmup_seconds": self.warmup_seconds}
+
+
+pipeline_registry = PipelineRegistry()
+
 # Helper function để lấy pipeline
 
-def get_pipeline(pipeline_type: str = "gemini", config_service=None, rag_config=None):
+async def get_pipeline(pipeline_type: str = "gemini", config_service=None, rag_config=None):
+    """Pipeline dùng chung từ registry; chỉ dựng instance riêng khi truyền rag_config khác."""
+    if rag_config is None:
+        return await pipeline_registry.acquire(pipeline_type)
     from . import services
-    from google import genai
     from google.genai import types
     factory = create_pipeline_factory(
         client=services.client,
         types=types,
-        crud_service=services.crud,
+        crud_service=services.crud.aio,
         file_service=services,
         config_service=config_service,
         rag_config=rag_config
     )
-    return factory.get_pipeline(pipeline_type) 
\ No newline at end of file
+    return await asyncio.to_thread(factory.get_pipeline, pipeline_type)
@@ -0,0 +1,60 @@
+# Hạ tầng streaming dùng chung cho các router (SSE/NDJSON) và pipeline
+from .buffer import (
+    STREAM_DONE,
+    StreamBuffer
+)
+from .protocol import (
+    NDJSON,
+    SSE,
+    Frame,
+    StreamEvent,
+    Transport,
+    select_transport
+)
+from .generation import Generation
+from .registry import (
+    GenerationLimitError,
+    GenerationRegistry,
+    generation_registry,
+    turn_key
+)
+from .quotas import (
+    QuotaExceededError,
+    QuotaReservation,
+    TokenBucket,
+    UserQuotas,
+    user_quotas
+)
+from .scheduler import (
+    GenerationScheduler,
+    Priority,
+    SchedulerFullError,
+    Ticket,
+    generation_scheduler
+)
+
+__all__ = [
+    'STREAM_DONE',
+    'StreamBuffer',
+    'NDJSON',
+    'SSE',
+    'Frame',
+    'StreamEvent',
+    'Transport',
+    'select_transport',
+    'Generation',
+    'GenerationLimitError',
+    'GenerationRegistry',
+    'generation_registry',
+    'turn_key',
+    'QuotaExceededError',
+    'QuotaReservation',
+    'TokenBucket',
+    'UserQuotas',
+    'user_quotas',
+    'GenerationScheduler',
+    'Priority',
+    'SchedulerFullError',
+    'Ticket',
+    'generation_scheduler'
+]
@@ -0,0 +1,118 @@
+"""
+Bounded, coalescing buffer between an AI pipeline and a streaming response.
+
+Pipelines ``put`` typed ``StreamEvent``s (see ``protocol``). The consumer
+calls ``next_frame`` which merges consecutive message chunks that arrive
+within a short time/size window into a single event, so one frame (one JSON
+encode, one socket write) carries many model tokens. The buffer is
+bounded: when the consumer falls behind, ``put`` waits, pushing backpressure
+onto the producer instead of growing memory without limit.
+"""
+
+import asyncio
+from typing import Optional, Union
+
+from ..config import get_settings
+from .protocol import StreamEvent
+
+# Sentinel marking the end of a stream
+STREAM_DONE = "[DONE]"
+
+
+def _is_text_event(event: Union[StreamEvent, str]) -> bool:
+    """Only message chunks can be merged; errors, tool calls and artifacts pass through as-is."""
+    return isinstance(event, StreamEvent) and event.is_chunk
+
+
+class StreamBuffer:
+    """Bounded queue of stream events with frame coalescing on the consumer side."""
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        max_frame_chars: Optional[int] = None,
+    ):
+        settings = get_settings()
+        self.maxsize = maxsize if maxsize is not None else settings.stream_buffer_size
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else settings.stream_flush_interval_ms / 1000
+        )
+        self.max_frame_chars = (
+            max_frame_chars if max_frame_chars is not None else settings.stream_max_frame_chars
+        )
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.maxsize)
+        # Event read while coalescing that could not be merged into the previous frame
+        self._pending: Optional[Union[StreamEvent, str]] = None
+        self._closed = False
+
+    async def put(self, event: StreamEvent) -> None:
+        """Queue an event, waiting while the buffer is full."""
+        await self._queue.put(event)
+
+    async def close(self) -> None:
+        """Signal the consumer that no more events will be produced."""
+        self.close_nowait()
+
+    def close_nowait(self) -> None:
+        """
+        Synchronous variant of ``close`` (usable from task done-callbacks).
+
+        Never blocks: a cancelled producer must be able to close the buffer even
+        when it is full and nobody is reading any more.
+        """
+        self._closed = True
+        try:
+            self._queue.put_nowait(STREAM_DONE)
+        except asyncio.QueueFull:
+            # The consumer sees the closed flag once it has drained the queue
+            pass
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def _get(self, timeout: Optional[float]) -> Union[StreamEvent, str]:
+        if self._pending is not None:
+            event, self._pending = self._pending, None
+            return event
+        if self._closed and self._queue.empty():
+            return STREAM_DONE
+        if timeout is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout=timeout)
+
+    async def next_frame(self, timeout: Optional[float] = None) -> Union[StreamEvent, str]:
+        """
+        Return the next frame to send: a (possibly merged) event or ``STREAM_DONE``.
+
+        Raises ``asyncio.TimeoutError`` if nothing arrives within ``timeout``.
+        """
+        event = await self._get(timeout)
+        if not _is_text_event(event):
+            return event
+
+        parts = [event.text]
+        size = len(parts[0])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+
+        while size < self.max_frame_chars:
+            try:
+                nxt = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._closed:
+                    break
+                try:
+                    nxt = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            if not _is_text_event(nxt):
+                self._pending = nxt
+                break
+            parts.append(nxt.text)
+            size += len(nxt.text)
+
+        if len(parts) == 1:
+            return event
+        return StreamEvent.chunk("".join(parts))
@@ -0,0 +1,202 @@
+"""
+In-flight AI generations with a bounded replay journal.
+
+A ``Generation`` owns the background task producing the answer, the
+``StreamBuffer`` the pipeline writes into, and a ring buffer of sequenced,
+already-encoded protocol frames. Responses subscribe to the journal instead of
+reading the buffer directly, so a client that drops its connection can
+re-attach with ``Last-Event-ID`` and receive only the frames it missed while
+the generation keeps running. A generation left without subscribers is
+cancelled after a grace period; a finished one is evicted after the same
+period so late reconnects can still read its tail.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator, Callable, Coroutine, Deque, List, Optional, Tuple
+
+from ..config import get_settings
+from .buffer import STREAM_DONE, StreamBuffer
+from .protocol import Frame, StreamEvent
+
+logger = logging.getLogger(__name__)
+
+
+class Generation:
+    """One AI generation: its task, input buffer and replayable output frames."""
+
+    def __init__(
+        self,
+        generation_id: str,
+        chat_id: int,
+        buffer: Optional[StreamBuffer] = None,
+        replay_size: Optional[int] = None,
+        detach_grace: Optional[float] = None,
+        on_evict: Optional[Callable[["Generation"], None]] = None,
+        on_finish: Optional[Callable[["Generation"], None]] = None,
+    ):
+        settings = get_settings()
+        self.id = generation_id
+        self.chat_id = chat_id
+        # Chat turn this generation answers, if it can be shared (see GenerationRegistry)
+        self.turn: Optional[str] = None
+        self.buffer = buffer or StreamBuffer()
+        self.detach_grace = (
+            detach_grace if detach_grace is not None else settings.stream_detach_grace_seconds
+        )
+        self.task: Optional[asyncio.Task] = None
+        self.finished = False
+        # True while the task waits for a scheduler slot
+        self.queued = False
+        self.subscribers = 0
+
+        self._frames: Deque[Frame] = deque(
+            maxlen=replay_size if replay_size is not None else settings.stream_replay_buffer_size
+        )
+        self._last_seq = 0
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._on_evict = on_evict
+        self._on_finish = on_finish
+
+        # The generation id is always the first frame, so a replay from the start includes it
+        self._append(StreamEvent.status(generation_id=generation_id))
+
+    # --- Lifecycle ---
+
+    def start(self, coro: Coroutine, on_done: Optional[Callable[[], None]] = None) -> asyncio.Task:
+        """
+        Run ``coro`` (which writes into ``self.buffer``) and start journaling its output.
+
+        ``on_done`` releases what the task holds (scheduler slot, ...); it must be
+        idempotent, since the coroutine may release the same things itself.
+        """
+        self.task = asyncio.create_task(coro)
+
+        def on_task_done(_):
+            # If the task is cancelled before it ever runs, its coroutine's `finally`
+            # blocks never run: nobody else closes the buffer or gives the slot back
+            self.buffer.close_nowait()
+            if on_done is not None:
+                on_done()
+
+        self.task.add_done_callback(on_task_done)
+        self._pump_task = asyncio.create_task(self._pump())
+        # Until the first subscriber attaches, the generation counts as detached
+        self._arm_timer()
+        return self.task
+
+    def cancel(self) -> bool:
+        """Cancel the underlying task. Returns False if it had already finished."""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            return True
+        return False
+
+    @property
+    def last_seq(self) -> int:
+        return self._last_seq
+
+    @property
+    def state(self) -> str:
+        if self.finished:
+            return "finished"
+        return "queued" if self.queued else "running"
+
+    async def _pump(self) -> None:
+        try:
+            while True:
+                frame = await self.buffer.next_frame()
+                if frame == STREAM_DONE:
+                    break
+                self._append(frame)
+        finally:
+            self.finished = True
+            self._notify()
+            if self._on_finish is not None:
+                self._on_finish(self)
+            if self.subscribers == 0:
+                self._arm_timer()
+
+    def _append(self, event: StreamEvent) -> None:
+        self._last_seq += 1
+        # Encoded once here and shared by every subscriber, transport and replay
+        self._frames.append(event.encode(self._last_seq))
+        self._notify()
+
+    def _notify(self) -> None:
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    # --- Detach / eviction ---
+
+    def _arm_timer(self) -> None:
+        self._disarm_timer()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(self.detach_grace, self._on_timer)
+
+    def _disarm_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        if self.subscribers > 0:
+            return
+        if not self.finished:
+            logger.info(f"Generation {self.id} detached for {self.detach_grace}s, cancelling")
+            # The pump re-arms the timer once the cancelled task has closed the buffer
+            self.cancel()
+            return
+        if self._on_evict is not None:
+            self._on_evict(self)
+
+    # --- Subscribers ---
+
+    def _frames_after(self, cursor: int) -> Tuple[List[Frame], bool]:
+        """Frames with seq > cursor, and whether some of them already fell out of the ring."""
+        if not self._frames:
+            return [], False
+        first_seq = self._frames[0].seq
+        start = max(cursor + 1 - first_seq, 0)
+        return list(islice(self._frames, start, None)), cursor + 1 < first_seq
+
+    async def subscribe(
+        self, last_event_id: Optional[int] = None, keepalive: float = 30.0
+    ) -> AsyncIterator[Optional[Frame]]:
+        """
+        Yield encoded frames after ``last_event_id`` until the generation ends.
+
+        Yields ``None`` whenever ``keepalive`` seconds pass without a new frame so
+        the caller can send a keepalive; the caller writes the transport's end
+        marker once the iterator is exhausted.
+        """
+        self.subscribers += 1
+        self._disarm_timer()
+        cursor = last_event_id or 0
+        try:
+            while True:
+                wakeup = self._wakeup
+                frames, gap = self._frames_after(cursor)
+                if gap:
+                    logger.warning(f"Subscriber of {self.id} fell behind the replay window after seq {cursor}")
+                    yield StreamEvent.status(replay_gap={"after": cursor, "resumed_at": frames[0].seq}).encode()
+                for frame in frames:
+                    cursor = frame.seq
+                    yield frame
+                if frames:
+                    continue
+                if self.finished:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self._arm_timer()
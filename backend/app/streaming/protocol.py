@@ -0,0 +1,141 @@
+"""
+Typed streaming protocol shared by the pipelines, the journal and the transports.
+
+Every event has a ``MessageType`` (see ``app.rag.schemas.chunk_message``) and
+a flat payload. Once the journal gives an event its sequence number, the event
+is JSON-encoded exactly once into a ``Frame``. Each transport then only wraps
+that body: an SSE ``id:``/``data:`` frame or an NDJSON line. Wire format::
+
+    {"seq": 3, "type": "message_chunk", "text": "..."}
+    {"seq": 4, "type": "tool_call", "name": "...", "args": {...}, "id": "..."}
+    {"seq": 5, "type": "artifact", "artifact": {"sources": [...]}}
+    {"seq": 1, "type": "status", "generation_id": "..."}
+    {"seq": 6, "type": "error", "error": "..."}
+
+Existing SSE clients keep working because the ``text``, ``error`` and
+``generation_id`` keys are unchanged and SSE still ends with ``data: [DONE]``.
+"""
+
+import json
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from ..rag.schemas.chunk_message import Artifact, MessageType
+
+
+class StreamEvent:
+    """One protocol event before it is sequenced and encoded."""
+
+    __slots__ = ("type", "data")
+
+    def __init__(self, type: MessageType, **data: Any):
+        self.type = type
+        self.data = data
+
+    @classmethod
+    def chunk(cls, text: str) -> "StreamEvent":
+        return cls(MessageType.message_chunk, text=text)
+
+    @classmethod
+    def tool_call(cls, name: str, args: Optional[Dict[str, Any]] = None, call_id: Optional[str] = None) -> "StreamEvent":
+        return cls(MessageType.tool_call, name=name, args=args or {}, id=call_id)
+
+    @classmethod
+    def artifact(cls, sources: List[str]) -> "StreamEvent":
+        return cls(MessageType.artifact, artifact=Artifact(sources=sources).model_dump())
+
+    @classmethod
+    def status(cls, **fields: Any) -> "StreamEvent":
+        return cls(MessageType.status, **fields)
+
+    @classmethod
+    def error(cls, message: str, text: Optional[str] = None) -> "StreamEvent":
+        """``text`` is an optional user-facing message shown instead of the raw error."""
+        if text is None:
+            return cls(MessageType.error, error=message)
+        return cls(MessageType.error, error=message, text=text)
+
+    @classmethod
+    def done(cls, last_seq: int) -> "StreamEvent":
+        """End of a generation; not journaled, tells the reader the last seq it should have."""
+        return cls(MessageType.done, last_seq=last_seq)
+
+    @property
+    def is_chunk(self) -> bool:
+        return self.type is MessageType.message_chunk
+
+    @property
+    def text(self) -> str:
+        return self.data.get("text", "")
+
+    def encode(self, seq: Optional[int] = None) -> "Frame":
+        payload = {"type": self.type.value, **self.data}
+        if seq is not None:
+            payload = {"seq": seq, **payload}
+        return Frame(seq, json.dumps(payload, ensure_ascii=False))
+
+    def __repr__(self) -> str:
+        return f"StreamEvent({self.type.value}, {self.data!r})"
+
+
+class Frame(NamedTuple):
+    """An encoded event; ``seq`` is None for notices outside the journal."""
+
+    seq: Optional[int]
+    body: str
+
+
+class Transport:
+    """How frames are written on the wire."""
+
+    media_type: str = ""
+
+    def frame(self, frame: Frame) -> str:
+        raise NotImplementedError
+
+    def keepalive(self) -> str:
+        raise NotImplementedError
+
+    def done(self, last_seq: int) -> str:
+        raise NotImplementedError
+
+
+class SSETransport(Transport):
+    media_type = "text/event-stream"
+
+    def frame(self, frame: Frame) -> str:
+        if frame.seq is None:
+            return f"data: {frame.body}\n\n"
+        return f"id: {frame.seq}\ndata: {frame.body}\n\n"
+
+    def keepalive(self) -> str:
+        return ": keepalive\n\n"
+
+    def done(self, last_seq: int) -> str:
+        return "data: [DONE]\n\n"
+
+
+class NDJSONTransport(Transport):
+    media_type = "application/x-ndjson"
+
+    def frame(self, frame: Frame) -> str:
+        return frame.body + "\n"
+
+    def keepalive(self) -> str:
+        # Blank lines are skipped by NDJSON readers
+        return "\n"
+
+    def done(self, last_seq: int) -> str:
+        return StreamEvent.done(last_seq).encode().body + "\n"
+
+
+SSE = SSETransport()
+NDJSON = NDJSONTransport()
+
+
+def select_transport(format: Optional[str] = None, accept: Optional[str] = None) -> Transport:
+    """NDJSON when asked for via ``?format=ndjson`` or the ``Accept`` header, SSE otherwise."""
+    if format:
+        return NDJSON if format.lower() == "ndjson" else SSE
+    if accept and NDJSON.media_type in accept:
+        return NDJSON
+    return SSE
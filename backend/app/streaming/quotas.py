@@ -0,0 +1,214 @@
+"""
+Per-user quotas on LLM work.
+
+The IP-based ``RateLimiter`` middleware counts requests, but one question with
+a large attachment costs as much as hundreds of short ones. Each user (the JWT
+subject, or the client IP for anonymous requests) has a token bucket refilled
+at ``USER_TOKEN_QUOTA_PER_MINUTE``, charged with the estimated prompt tokens
+(message plus attachments) and ``USER_QUOTA_COMPLETION_TOKENS`` for the
+answer, and at most ``USER_MAX_ACTIVE_GENERATIONS`` generations at a time.
+
+A reservation is made synchronously before any work starts. When the bucket
+would refill within ``USER_QUOTA_MAX_WAIT_SECONDS`` the request is admitted
+and waits for it (the bucket goes into debt, so later requests wait behind
+it); otherwise it fails fast with ``QuotaExceededError`` and a Retry-After.
+Once the answer is known the reservation is settled against its actual size.
+"""
+
+import logging
+import math
+import time
+from typing import Dict, Optional
+
+from ..config import get_settings
+from .registry import GenerationLimitError
+
+logger = logging.getLogger(__name__)
+
+# Retry-After when the user's concurrent generations are all busy
+CONCURRENCY_RETRY_AFTER = 5
+# Idle users with a full bucket are forgotten once this many are tracked
+PRUNE_THRESHOLD = 1024
+
+
+class QuotaExceededError(GenerationLimitError):
+    """Raised when a user's token quota or concurrency cap rejects a generation."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float, now: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        """Time until ``amount`` tokens are available, after ``refill``."""
+        missing = amount - self.tokens
+        return max(0.0, missing / self.refill_per_second) if self.refill_per_second > 0 else math.inf
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class _UserState:
+    __slots__ = ("bucket", "active")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.active = 0
+
+
+class QuotaReservation:
+    """Tokens and a concurrency place held by one generation."""
+
+    def __init__(self, quotas: "UserQuotas", user: Optional[str], tokens: int, prompt_tokens: int, delay: float):
+        self._quotas = quotas
+        self.user = user
+        self.tokens = tokens
+        self.prompt_tokens = prompt_tokens
+        # Seconds to wait for the bucket before calling the model
+        self.delay = delay
+        self.released = False
+        self.settled = False
+
+    def settle(self, used_tokens: int) -> None:
+        """Replace the estimate by the tokens actually used (0 when no model was called)."""
+        if self.settled:
+            return
+        self.settled = True
+        self._quotas._refund(self, self.tokens - used_tokens)
+
+    def release(self) -> None:
+        """Give the concurrency place back. Safe to call more than once."""
+        if self.released:
+            return
+        self.released = True
+        self._quotas._release(self)
+
+
+class UserQuotas:
+    def __init__(
+        self,
+        tokens_per_minute: Optional[int] = None,
+        max_active: Optional[int] = None,
+        max_wait_seconds: Optional[int] = None,
+    ):
+        self._tokens_per_minute = tokens_per_minute
+        self._max_active = max_active
+        self._max_wait_seconds = max_wait_seconds
+        self._users: Dict[str, _UserState] = {}
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected_tokens = 0
+        self.rejected_concurrency = 0
+
+    @property
+    def tokens_per_minute(self) -> int:
+        return self._tokens_per_minute if self._tokens_per_minute is not None else get_settings().user_token_quota_per_minute
+
+    @property
+    def max_active(self) -> int:
+        return self._max_active if self._max_active is not None else get_settings().user_max_active_generations
+
+    @property
+    def max_wait_seconds(self) -> int:
+        return self._max_wait_seconds if self._max_wait_seconds is not None else get_settings().user_quota_max_wait_seconds
+
+    def reserve(self, user: Optional[str], prompt_tokens: int) -> QuotaReservation:
+        """Reserve the estimated tokens of a generation for ``user``; raises ``QuotaExceededError``."""
+        tokens = prompt_tokens + get_settings().user_quota_completion_tokens
+        if user is None:
+            return QuotaReservation(self, None, tokens, prompt_tokens, 0.0)
+
+        now = time.monotonic()
+        state = self._state(user, now)
+        if self.max_active > 0 and state.active >= self.max_active:
+            self.rejected_concurrency += 1
+            raise QuotaExceededError(
+                f"Too many active generations for this user (limit {self.max_active})",
+                CONCURRENCY_RETRY_AFTER,
+            )
+
+        delay = 0.0
+        bucket = state.bucket
+        if bucket is not None:
+            if tokens > bucket.capacity:
+                self.rejected_tokens += 1
+                raise QuotaExceededError(
+                    f"Request needs about {tokens} tokens, more than the per-user quota of "
+                    f"{int(bucket.capacity)} tokens per minute; send smaller attachments",
+                    60,
+                )
+            bucket.refill(now)
+            delay = bucket.seconds_until(tokens)
+            if delay > self.max_wait_seconds:
+                self.rejected_tokens += 1
+                raise QuotaExceededError(
+                    f"Token quota exhausted ({int(bucket.capacity)} tokens per minute); "
+                    f"retry in {math.ceil(delay)} s",
+                    math.ceil(delay),
+                )
+            bucket.tokens -= tokens
+
+        state.active += 1
+        self.admitted += 1
+        if delay > 0:
+            self.delayed += 1
+            logger.info(f"User {user} over token quota, delaying generation by {delay:.1f}s")
+        return QuotaReservation(self, user, tokens, prompt_tokens, delay)
+
+    def _state(self, user: str, now: float) -> _UserState:
+        state = self._users.get(user)
+        if state is None:
+            if len(self._users) >= PRUNE_THRESHOLD:
+                self._prune(now)
+            per_minute = self.tokens_per_minute
+            bucket = TokenBucket(per_minute, per_minute / 60, now) if per_minute > 0 else None
+            state = self._users[user] = _UserState(bucket)
+        return state
+
+    def _prune(self, now: float) -> None:
+        for user, state in list(self._users.items()):
+            if state.active:
+                continue
+            if state.bucket is not None:
+                state.bucket.refill(now)
+                if not state.bucket.full:
+                    continue
+            del self._users[user]
+
+    def _refund(self, reservation: QuotaReservation, tokens: int) -> None:
+        state = self._users.get(reservation.user) if reservation.user is not None else None
+        if state is not None and state.bucket is not None:
+            state.bucket.refill(time.monotonic())
+            state.bucket.tokens = min(state.bucket.capacity, state.bucket.tokens + tokens)
+
+    def _release(self, reservation: QuotaReservation) -> None:
+        state = self._users.get(reservation.user) if reservation.user is not None else None
+        if state is not None:
+            state.active = max(0, state.active - 1)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._users),
+            "active_generations": sum(state.active for state in self._users.values()),
+            "tokens_per_minute": self.tokens_per_minute,
+            "max_active_per_user": self.max_active,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "rejected_tokens": self.rejected_tokens,
+            "rejected_concurrency": self.rejected_concurrency,
+        }
+
+
+user_quotas = UserQuotas()
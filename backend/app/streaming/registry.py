@@ -0,0 +1,124 @@
+"""
+Process-wide registry of AI generations.
+
+Replaces the old module-level ``active_generations`` dict of the streaming
+router: ids are collision-free, finished generations stop counting against
+the concurrency caps as soon as they complete and are dropped once their
+replay grace period is over, so memory stays flat over the life of a worker.
+
+In-flight generations are also indexed by chat turn: a second tab or a
+retried POST for the same question attaches to the running generation (and
+replays it from the start) instead of starting another upstream call.
+"""
+
+import hashlib
+import json
+import logging
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+from ..config import get_settings
+from .generation import Generation
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationLimitError(Exception):
+    """Raised when a per-chat or global generation cap is reached."""
+
+
+def turn_key(chat_id: int, content: str, file_ids: Optional[Sequence[str]] = None) -> str:
+    """Identify one chat turn by its chat, message text and attachments."""
+    payload = json.dumps([content.strip(), sorted(file_ids or [])], ensure_ascii=False)
+    return f"{chat_id}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+class GenerationRegistry:
+    """Tracks live generations per worker and enforces concurrency caps."""
+
+    def __init__(self, max_active: Optional[int] = None, max_per_chat: Optional[int] = None):
+        self._max_active = max_active
+        self._max_per_chat = max_per_chat
+        self._generations: Dict[str, Generation] = {}
+        # turn key -> in-flight generation answering that turn
+        self._turns: Dict[str, Generation] = {}
+        self._finished_total = 0
+        self._shared_total = 0
+
+    @property
+    def max_active(self) -> int:
+        return self._max_active if self._max_active is not None else get_settings().max_active_generations
+
+    @property
+    def max_per_chat(self) -> int:
+        return self._max_per_chat if self._max_per_chat is not None else get_settings().max_generations_per_chat
+
+    def create(self, chat_id: int, turn: Optional[str] = None) -> Generation:
+        """Register a new generation for ``chat_id``, enforcing the caps."""
+        active = self.active()
+        if len(active) >= self.max_active:
+            raise GenerationLimitError(
+                f"Too many active generations on this worker (limit {self.max_active})"
+            )
+        if sum(1 for g in active if g.chat_id == chat_id) >= self.max_per_chat:
+            raise GenerationLimitError(
+                f"Too many active generations for chat {chat_id} (limit {self.max_per_chat})"
+            )
+        generation = Generation(
+            uuid.uuid4().hex,
+            chat_id=chat_id,
+            on_evict=self._evict,
+            on_finish=self._on_finish,
+        )
+        generation.turn = turn
+        self._generations[generation.id] = generation
+        if turn is not None:
+            self._turns[turn] = generation
+        return generation
+
+    def find_turn(self, turn: str) -> Optional[Generation]:
+        """The in-flight generation already answering ``turn``, counted as a shared attach."""
+        generation = self._turns.get(turn)
+        if generation is None or generation.finished:
+            return None
+        self._shared_total += 1
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        return self._generations.get(generation_id)
+
+    def active(self, chat_id: Optional[int] = None) -> List[Generation]:
+        """Generations that have not finished yet, optionally for a single chat."""
+        return [
+            g for g in self._generations.values()
+            if not g.finished and (chat_id is None or g.chat_id == chat_id)
+        ]
+
+    def cancel_chat(self, chat_id: int) -> int:
+        """Cancel every active generation of a chat; returns how many were cancelled."""
+        return sum(1 for g in self.active(chat_id) if g.cancel())
+
+    def stats(self) -> Dict[str, int]:
+        states = [g.state for g in self._generations.values()]
+        return {
+            "active": sum(1 for s in states if s != "finished"),
+            "queued": states.count("queued"),
+            "running": states.count("running"),
+            "finished": self._finished_total,
+            "shared": self._shared_total,
+            "retained": states.count("finished"),
+            "max_active": self.max_active,
+            "max_per_chat": self.max_per_chat,
+        }
+
+    def _on_finish(self, generation: Generation) -> None:
+        self._finished_total += 1
+        if generation.turn is not None and self._turns.get(generation.turn) is generation:
+            del self._turns[generation.turn]
+
+    def _evict(self, generation: Generation) -> None:
+        self._generations.pop(generation.id, None)
+        logger.debug(f"Evicted generation {generation.id}")
+
+
+generation_registry = GenerationRegistry()
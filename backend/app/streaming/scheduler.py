@@ -0,0 +1,155 @@
+"""
+Admission control for upstream LLM generations.
+
+A fixed number of generations may call the model at the same time; the rest
+wait in a bounded priority queue (interactive chat ahead of ``/rag`` batch
+questions, FIFO within a class). Admission is synchronous so an overloaded
+worker rejects a request before starting any work, and waiting clients are
+told their queue position as it changes instead of timing out upstream.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from enum import IntEnum
+from typing import Awaitable, Callable, Coroutine, Dict, List, Optional
+
+from ..config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class SchedulerFullError(Exception):
+    """Raised when every slot is busy and the wait queue is full."""
+
+
+class Ticket:
+    """A reserved slot, or a place in the wait queue."""
+
+    def __init__(self, scheduler: "GenerationScheduler", priority: Priority, order: int):
+        self._scheduler = scheduler
+        self.priority = priority
+        self.order = order
+        self.granted = False
+        self.released = False
+        self._changed = asyncio.Event()
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.order) < (other.priority, other.order)
+
+    async def wait(self, on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> None:
+        """
+        Wait until a slot is granted, reporting each new 1-based queue position.
+
+        A ticket that had to queue reports position 0 once its slot is granted.
+        """
+        last_position = None
+        while not self.granted:
+            position = self._scheduler.position(self)
+            if on_position is not None and position != last_position:
+                await on_position(position)
+                last_position = position
+            await self._changed.wait()
+            self._changed.clear()
+        if on_position is not None and last_position is not None:
+            await on_position(0)
+
+    def release(self) -> None:
+        """Give the slot back (or leave the queue). Safe to call more than once."""
+        if self.released:
+            return
+        self.released = True
+        self._scheduler._release(self)
+
+
+class GenerationScheduler:
+    """Fixed number of concurrent generation slots with a bounded priority wait queue."""
+
+    def __init__(self, slots: Optional[int] = None, queue_size: Optional[int] = None):
+        self._slots = slots
+        self._queue_size = queue_size
+        self._in_use = 0
+        self._waiting: List[Ticket] = []
+        self._order = itertools.count()
+
+    @property
+    def slots(self) -> int:
+        return self._slots if self._slots is not None else get_settings().generation_slots
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue_size if self._queue_size is not None else get_settings().generation_queue_size
+
+    def admit(self, priority: Priority = Priority.INTERACTIVE) -> Ticket:
+        """Reserve a slot or a queue place without waiting; raises ``SchedulerFullError``."""
+        ticket = Ticket(self, priority, next(self._order))
+        if self._in_use < self.slots and not self._waiting:
+            self._in_use += 1
+            ticket.granted = True
+            return ticket
+        if len(self._waiting) >= self.queue_size:
+            raise SchedulerFullError(
+                f"All {self.slots} generation slots are busy and {len(self._waiting)} requests are waiting"
+            )
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for other in self._waiting if other < ticket)
+
+    def _release(self, ticket: Ticket) -> None:
+        if ticket.granted:
+            self._in_use -= 1
+        else:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        moved = False
+        while self._in_use < self.slots and self._waiting:
+            ticket = heapq.heappop(self._waiting)
+            self._in_use += 1
+            ticket.granted = True
+            ticket._changed.set()
+            moved = True
+        if moved:
+            # Everybody still waiting moved up the queue
+            for ticket in self._waiting:
+                ticket._changed.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "slots_total": self.slots,
+            "slots_in_use": self._in_use,
+            # Cancelled tickets leave the queue on release; never count one that is on its way out
+            "waiting": sum(1 for ticket in self._waiting if not ticket.released),
+            "queue_capacity": self.queue_size,
+        }
+
+    async def run(
+        self,
+        ticket: Ticket,
+        coro: Coroutine,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+        on_granted: Optional[Callable[[], None]] = None,
+    ):
+        """Wait for ``ticket``'s slot, run ``coro`` in it and always give the slot back."""
+        try:
+            await ticket.wait(on_position)
+            if on_granted is not None:
+                on_granted()
+            return await coro
+        finally:
+            ticket.release()
+            # Never leave the coroutine un-awaited when cancelled while still queued
+            coro.close()
+
+
+generation_scheduler = GenerationScheduler()
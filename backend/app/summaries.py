@@ -0,0 +1,112 @@
+"""
+Rolling per-chat summary of older messages for the Gemini pipeline.
+
+When the history of a chat outgrows its token budget (see
+``app/context/budget.py``), ``ChatSummarizer`` extends the stored
+``Chat.summary`` with the messages up to a given id, in a background task so
+the current turn never waits for it. The summary is incremental: the previous
+summary plus only the newly covered messages are sent to the model.
+"""
+
+import asyncio
+import logging
+from typing import Dict
+
+from google.genai import types
+
+from . import crud
+from .config import get_settings
+from .context.budget import estimate_text_tokens
+from .database import AsyncSessionLocal
+from .llm.pacer import gemini_pacer
+from .llm.resilience import GEMINI, resilience
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTION = (
+    "Bạn tóm tắt lịch sử một cuộc hội thoại luyện thi Olympic Đại số tuyến tính. "
+    "Giữ lại đề bài, giả thiết, định nghĩa, các kết quả và công thức đã chứng minh (định dạng LaTeX), "
+    "tên các file đính kèm và những yêu cầu còn dang dở của người dùng. "
+    "Viết ngắn gọn bằng tiếng Việt, không thêm nhận xét."
+)
+SUMMARY_PREFIX = "[Tóm tắt phần đầu cuộc hội thoại]\n"
+
+
+def _render_message(msg_model) -> str:
+    speaker = "Người dùng" if msg_model.role == "user" else "Trợ lý"
+    text = f"{speaker}: {msg_model.content}"
+    files = getattr(msg_model, "files", None) or []
+    if files:
+        text += "\n(File đính kèm: " + ", ".join(fm.original_filename or fm.id for fm in files) + ")"
+    return text
+
+
+class ChatSummarizer:
+    """Runs at most one summary update per chat at a time."""
+
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.updated = 0
+        self.failed = 0
+
+    def schedule(self, chat_id: int, upto_message_id: int, client, model_name: str) -> None:
+        if client is None or chat_id in self._tasks:
+            return
+        task = asyncio.create_task(self._update(chat_id, upto_message_id, client, model_name))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+
+    async def _update(self, chat_id: int, upto_message_id: int, client, model_name: str) -> None:
+        # Own session: the turn that scheduled the update has finished with its own
+        async with AsyncSessionLocal() as db:
+            chat = await crud.aio.get_chat(db, chat_id)
+            if chat is None:
+                return
+            summary_upto = chat.summary_upto_message_id or 0
+            if summary_upto >= upto_message_id:
+                return
+            messages = [
+                msg for msg in await crud.aio.get_messages_for_chat_after(db, chat_id=chat_id, after_message_id=summary_upto)
+                if msg.id <= upto_message_id
+            ]
+            if not messages:
+                return
+            parts = []
+            if chat.summary:
+                parts.append(f"Tóm tắt trước đó:\n{chat.summary}")
+            parts.append("Các tin nhắn tiếp theo:\n" + "\n\n".join(_render_message(msg) for msg in messages))
+            prompt = "\n\n".join(parts)
+
+            async def summarize():
+                pacing = await gemini_pacer.acquire(
+                    estimate_text_tokens(prompt) + get_settings().context_summary_max_tokens
+                )
+                response = await client.aio.models.generate_content(
+                    model=model_name,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(
+                        system_instruction=SUMMARY_INSTRUCTION,
+                        max_output_tokens=get_settings().context_summary_max_tokens,
+                        temperature=0.2,
+                    ),
+                )
+                pacing.settle(getattr(response.usage_metadata, "total_token_count", None))
+                return response
+
+            try:
+                response = await resilience.call(GEMINI, summarize)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to summarize chat {chat_id} up to message {upto_message_id}: {e}", exc_info=True)
+                return
+            summary = (response.text or "").strip()
+            if not summary:
+                self.failed += 1
+                logger.warning(f"Empty summary for chat {chat_id}; keeping the previous one")
+                return
+            await crud.aio.update_chat_summary(db, chat_id=chat_id, summary=summary, upto_message_id=messages[-1].id)
+        self.updated += 1
+        logger.info(f"Summarized chat {chat_id} up to message {messages[-1].id}")
+
+
+chat_summarizer = ChatSummarizer()
@@ -7,6 +7,7 @@ from sqlalchemy.orm import Session
 from . import crud, models
 from .database import get_db
 from .crud import file_crud
+from .context import prompt_context_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -72,6 +73,9 @@ async def cleanup_old_chat_data(db: Session):
         ).delete()
         
         logger.info(f"Deleted {result} messages older than 60 days")
+        if result:
+            # Cached prompt contexts may still hold the deleted messages
+            prompt_context_cache.clear()
         
         # Clean up orphaned files
         file_records = db.query(models.FileMetadata).all()
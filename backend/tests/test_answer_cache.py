@@ -0,0 +1,27 @@
+import asyncio
+
+from app.llm.answer_cache import SemanticAnswerCache, normalize_question
+
+
+def test_normalize_question_keeps_case():
+    assert normalize_question("Tính  A^T A   với $A = (1, 2)$") == "Tính A^T A với$A=(1,2)$"
+    assert normalize_question("Cho ma trận A, tính det(A^T)") != normalize_question("Cho ma trận a, tính det(a^T)")
+
+
+def test_case_distinct_questions_do_not_share_an_answer():
+    async def scenario():
+        cache = SemanticAnswerCache(max_entries=10, ttl_seconds=60, similarity=0.9)
+        upper = "Giải hệ phương trình X + Y = 3, X - Y = 1"
+        lower = "Giải hệ phương trình x + y = 3, X - Y = 1"
+
+        answer, probe = await cache.lookup("gemini", upper, client=None)
+        assert answer is None
+        cache.store(probe, "X = 2, Y = 1")
+
+        answer, _ = await cache.lookup("gemini", lower, client=None)
+        assert answer is None
+        # Only spacing differs: still the same problem
+        answer, _ = await cache.lookup("gemini", "Giải hệ phương trình  X+Y=3, X-Y=1", client=None)
+        assert answer is not None and answer.content == "X = 2, Y = 1"
+
+    asyncio.run(scenario())
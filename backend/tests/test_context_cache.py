@@ -0,0 +1,100 @@
+import threading
+from datetime import datetime, timedelta
+
+from app.context.cache import AttachmentRef, ChatContext, PreparedMessage, PromptContextCache
+
+
+def _context(message_ids, size_each=100, inline_file_id=None, expires_at=None):
+    context = ChatContext()
+    for message_id in message_ids:
+        attachments = (AttachmentRef(inline_file_id, "scan.png", True),) if inline_file_id else ()
+        context.append(
+            message_id,
+            PreparedMessage(f"content {message_id}", size_each, 10, expires_at=expires_at, attachments=attachments),
+        )
+    return context
+
+
+def test_append_extends_a_copy_not_the_cached_entry():
+    cache = PromptContextCache(budget_bytes=10_000)
+    cache.put(1, _context([1, 2]))
+
+    cached = cache.get(1)
+    extended = cached.copy()
+    extended.append(3, PreparedMessage("content 3", 50, 5))
+    cache.put(1, extended)
+
+    assert cached.message_ids == [1, 2] and cached.size == 200
+    entry = cache.get(1)
+    assert entry.message_ids == [1, 2, 3] and entry.last_message_id == 3
+    assert cache.stats()["size_bytes"] == 250
+    # An older context never replaces a newer one
+    cache.put(1, _context([1, 2]))
+    assert cache.get(1).last_message_id == 3
+
+
+def test_least_recently_used_chats_are_evicted_over_budget():
+    cache = PromptContextCache(budget_bytes=500)
+    cache.put(1, _context([1, 2]))
+    cache.put(2, _context([3, 4]))
+    cache.get(1)
+    cache.put(3, _context([5, 6]))
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    stats = cache.stats()
+    assert stats["size_bytes"] == 400 and stats["evictions"] == 1
+
+    # Larger than the whole budget: not cached, nobody else is flushed
+    cache.put(4, _context(range(10, 16)))
+    assert cache.get(4) is None
+    assert cache.stats()["chats"] == 2
+
+
+def test_invalidation_on_rewrite_delete_and_file_move():
+    cache = PromptContextCache(budget_bytes=10_000)
+    cache.put(1, _context([1, 2]))
+    cache.put(2, _context([3, 4], inline_file_id="file-a"))
+    cache.put(3, _context([5]))
+
+    # A message of another chat was rewritten: chat 1 stays
+    cache.invalidate_message(1, 3)
+    assert cache.get(1) is not None
+    cache.invalidate_message(1, 2)
+    assert cache.get(1) is None
+
+    cache.invalidate_file("file-a")
+    assert cache.get(2) is None
+
+    # Chat deleted
+    cache.invalidate(3)
+    assert cache.get(3) is None
+    assert cache.stats()["chats"] == 0 and cache.stats()["size_bytes"] == 0
+
+
+def test_expired_entry_is_a_miss():
+    cache = PromptContextCache(budget_bytes=10_000)
+    cache.put(1, _context([1], expires_at=datetime.utcnow() - timedelta(seconds=1)))
+
+    assert cache.get(1) is None
+    assert cache.stats()["misses"] == 1 and cache.stats()["size_bytes"] == 0
+
+
+def test_concurrent_puts_and_invalidations_keep_the_size_consistent():
+    cache = PromptContextCache(budget_bytes=5_000)
+
+    def worker(offset):
+        for i in range(2_000):
+            chat_id = (offset + i) % 40
+            cache.put(chat_id, _context([i, i + 1]))
+            cache.invalidate_message(chat_id, i)
+            cache.get((chat_id + 1) % 40)
+
+    threads = [threading.Thread(target=worker, args=(n * 7,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.stats()["size_bytes"] == sum(entry.size for entry in cache._entries.values())
+    assert cache.stats()["size_bytes"] <= 5_000
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from typing import Optional
+
+from app.streaming import Generation, StreamBuffer, StreamEvent
+
+
+def _generation(replay_size: int) -> Generation:
+    # No merging: one put is one journal frame
+    buffer = StreamBuffer(maxsize=16, flush_interval=0, max_frame_chars=1000)
+    return Generation("g1", chat_id=1, buffer=buffer, replay_size=replay_size, detach_grace=60)
+
+
+async def _run(generation: Generation, steps: int, release: Optional[asyncio.Event] = None) -> None:
+    async def body():
+        for step in range(1, steps + 1):
+            if step == steps and release is not None:
+                await release.wait()
+            await generation.buffer.put(StreamEvent.status(step=step))
+        await generation.buffer.close()
+
+    generation.start(body())
+
+
+async def _read(generation: Generation, last_event_id=None):
+    frames = []
+    async for frame in generation.subscribe(last_event_id, keepalive=1):
+        frames.append(frame)
+    return frames
+
+
+async def _finished(generation: Generation) -> None:
+    await generation.task
+    await asyncio.wait_for(generation._pump_task, timeout=1)
+
+
+def test_replay_resumes_right_after_last_event_id():
+    async def scenario():
+        generation = _generation(replay_size=100)
+        await _run(generation, steps=5)
+        await _finished(generation)
+
+        # seq 1 is the generation id, steps 1..5 are seq 2..6
+        assert generation.last_seq == 6
+        frames = await _read(generation, last_event_id=3)
+        assert [frame.seq for frame in frames] == [4, 5, 6]
+        assert [json.loads(frame.body)["step"] for frame in frames] == [3, 4, 5]
+
+        everything = await _read(generation)
+        assert [frame.seq for frame in everything] == [1, 2, 3, 4, 5, 6]
+        assert json.loads(everything[0].body)["generation_id"] == "g1"
+        # Already up to date: nothing to send
+        assert await _read(generation, last_event_id=6) == []
+
+    asyncio.run(scenario())
+
+
+def test_replay_from_an_id_older_than_the_journal_reports_the_gap():
+    async def scenario():
+        generation = _generation(replay_size=3)
+        await _run(generation, steps=5)
+        await _finished(generation)
+
+        frames = await _read(generation, last_event_id=1)
+
+        notice, *rest = frames
+        assert notice.seq is None
+        assert json.loads(notice.body)["replay_gap"] == {"after": 1, "resumed_at": 4}
+        assert [frame.seq for frame in rest] == [4, 5, 6]
+
+    asyncio.run(scenario())
+
+
+def test_subscriber_attached_mid_stream_gets_every_frame_once():
+    async def scenario():
+        generation = _generation(replay_size=100)
+        release = asyncio.Event()
+        await _run(generation, steps=4, release=release)
+        await asyncio.sleep(0.01)
+
+        reader = asyncio.ensure_future(_read(generation, last_event_id=2))
+        await asyncio.sleep(0.01)
+        assert generation.subscribers == 1
+        release.set()
+        frames = await asyncio.wait_for(reader, timeout=1)
+
+        assert [frame.seq for frame in frames] == [3, 4, 5]
+        assert generation.finished and generation.subscribers == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+import asyncio
+
+from app.streaming import Generation, GenerationScheduler
+
+
+def _start(scheduler: GenerationScheduler, generation: Generation):
+    """Start ``generation`` in a scheduler slot, the way ``services.start_generation`` does."""
+    ticket = scheduler.admit()
+
+    async def body():
+        await generation.buffer.close()
+
+    async def run_generation():
+        await scheduler.run(ticket, body())
+
+    generation.start(run_generation(), on_done=ticket.release)
+    return ticket
+
+
+def test_cancel_before_first_step_releases_slot():
+    async def scenario():
+        scheduler = GenerationScheduler(slots=1, queue_size=10)
+        generation = Generation("g1", chat_id=1, replay_size=16, detach_grace=60)
+        ticket = _start(scheduler, generation)
+        assert scheduler.stats()["slots_in_use"] == 1
+
+        # Interrupt right after start: the task never runs its first step
+        assert generation.cancel()
+        await asyncio.gather(generation.task, return_exceptions=True)
+        await asyncio.sleep(0)
+
+        assert ticket.released
+        assert scheduler.stats()["slots_in_use"] == 0
+        assert scheduler.admit().granted
+        # The buffer is closed too, so the journal pump finishes
+        await asyncio.wait_for(generation._pump_task, timeout=1)
+        assert generation.finished
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_generation_does_not_block_queued_ones():
+    async def scenario():
+        scheduler = GenerationScheduler(slots=1, queue_size=10)
+        first = Generation("g1", chat_id=1, replay_size=16, detach_grace=60)
+        _start(scheduler, first)
+        waiting = scheduler.admit()
+        assert not waiting.granted
+
+        first.cancel()
+        await asyncio.gather(first.task, return_exceptions=True)
+        await asyncio.sleep(0)
+
+        assert waiting.granted
+        waiting.release()
+        assert scheduler.stats()["slots_in_use"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_finished_generation_releases_slot_once():
+    async def scenario():
+        scheduler = GenerationScheduler(slots=2, queue_size=10)
+        generation = Generation("g1", chat_id=1, replay_size=16, detach_grace=60)
+        _start(scheduler, generation)
+        other = scheduler.admit()
+        await generation.task
+        await asyncio.sleep(0)
+
+        # run() and the done-callback both release: the slot is given back only once
+        assert scheduler.stats()["slots_in_use"] == 1
+        other.release()
+        assert scheduler.stats()["slots_in_use"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_stats_count_waiting_tickets_until_released():
+    async def scenario():
+        scheduler = GenerationScheduler(slots=1, queue_size=10)
+        running = scheduler.admit()
+        queued = [scheduler.admit(), scheduler.admit()]
+        assert scheduler.stats()["waiting"] == 2
+
+        # A queued generation cancelled while waiting leaves the queue
+        queued[0].release()
+        assert scheduler.stats()["waiting"] == 1
+
+        running.release()
+        assert queued[1].granted
+        assert scheduler.stats()["waiting"] == 0
+        assert scheduler.stats()["slots_in_use"] == 1
+
+    asyncio.run(scenario())
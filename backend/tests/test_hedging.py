@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from app.llm.fakes import FakeProvider, FakeProviderError
+from app.llm.hedging import DEFAULT_HEDGE_AFTER, MIN_SAMPLES, PRIMARY, SECONDARY, Hedger
+
+
+async def _collect(hedger: Hedger, primary: FakeProvider, secondary: FakeProvider):
+    return [item async for item in hedger.stream(primary.stream, secondary.stream)]
+
+
+def test_fast_primary_is_not_hedged():
+    async def scenario():
+        hedger = Hedger(hedge_after_ms=200)
+        primary = FakeProvider("primary", chunks=["a", "b"], first_chunk_delay=0.01)
+        secondary = FakeProvider("secondary")
+
+        received = await _collect(hedger, primary, secondary)
+
+        assert received == [(PRIMARY, "a"), (PRIMARY, "b")]
+        assert primary.finished == 1
+        assert secondary.started == 0
+        assert hedger.hedged == 0
+
+    asyncio.run(scenario())
+
+
+def test_faster_secondary_wins_and_primary_is_cancelled():
+    async def scenario():
+        hedger = Hedger(hedge_after_ms=50)
+        primary = FakeProvider("primary", first_chunk_delay=1.0)
+        secondary = FakeProvider("secondary", chunks=["x", "y"], first_chunk_delay=0.01)
+
+        received = await _collect(hedger, primary, secondary)
+
+        assert received == [(SECONDARY, "x"), (SECONDARY, "y")]
+        assert primary.started == 1 and primary.cancelled == 1 and primary.finished == 0
+        assert secondary.finished == 1 and secondary.cancelled == 0
+        assert hedger.hedged == 1 and hedger.secondary_wins == 1
+
+    asyncio.run(scenario())
+
+
+def test_primary_first_after_hedge_cancels_secondary():
+    async def scenario():
+        hedger = Hedger(hedge_after_ms=50)
+        primary = FakeProvider("primary", first_chunk_delay=0.1)
+        secondary = FakeProvider("secondary", first_chunk_delay=1.0)
+
+        received = await _collect(hedger, primary, secondary)
+
+        assert received == [(PRIMARY, "answer from primary")]
+        assert secondary.started == 1 and secondary.cancelled == 1 and secondary.finished == 0
+        assert hedger.hedged == 1 and hedger.secondary_wins == 0
+
+    asyncio.run(scenario())
+
+
+def test_secondary_starts_only_after_hedge_delay():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        hedger = Hedger(hedge_after_ms=150)
+        primary = FakeProvider("primary", first_chunk_delay=1.0)
+        secondary = FakeProvider("secondary")
+        secondary_started_at = []
+
+        def start_secondary():
+            secondary_started_at.append(loop.time())
+            return secondary.stream()
+
+        started = loop.time()
+        received = [item async for item in hedger.stream(primary.stream, start_secondary)]
+
+        assert received == [(SECONDARY, "answer from secondary")]
+        assert len(secondary_started_at) == 1
+        assert secondary_started_at[0] - started >= 0.15
+
+    asyncio.run(scenario())
+
+
+def test_hedge_delay_follows_p95_of_first_chunk_latencies():
+    hedger = Hedger(hedge_after_ms=0)
+    assert hedger.hedge_after() == DEFAULT_HEDGE_AFTER
+
+    # 1.00s .. 2.00s: the p95 is the 95th of 100 samples
+    hedger._latencies.extend(1.0 + i / 100 for i in range(100))
+    assert len(hedger._latencies) >= MIN_SAMPLES
+    assert hedger.hedge_after() == pytest.approx(1.94)
+
+
+def test_failing_primary_fails_over_without_waiting():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        hedger = Hedger(hedge_after_ms=5000)
+        primary = FakeProvider("primary", fail_after=0.01)
+        secondary = FakeProvider("secondary", first_chunk_delay=0.01)
+
+        started = loop.time()
+        received = await _collect(hedger, primary, secondary)
+
+        assert received == [(SECONDARY, "answer from secondary")]
+        assert loop.time() - started < 1
+        assert hedger.failovers == 1 and hedger.hedged == 0
+
+    asyncio.run(scenario())
+
+
+def test_both_streams_failing_raises():
+    async def scenario():
+        hedger = Hedger(hedge_after_ms=200)
+        primary = FakeProvider("primary", fail_after=0.01)
+        secondary = FakeProvider("secondary", fail_after=0.01)
+
+        with pytest.raises(FakeProviderError):
+            await _collect(hedger, primary, secondary)
+        assert hedger.failures == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import message_writer as message_writer_module
+from app import models
+from app.database import Base
+from app.message_writer import COMPLETE, PARTIAL, MessageWriter
+
+
+class _RecordingCache:
+    """Stands in for ``prompt_context_cache``; records the thread of each invalidation."""
+
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate_message(self, chat_id, message_id):
+        self.invalidated.append((chat_id, message_id, threading.get_ident()))
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with factory() as db:
+        user = models.User(email="student@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        db.add_all([models.Chat(id=1, user_id=user.id), models.Chat(id=2, user_id=user.id)])
+        db.commit()
+    monkeypatch.setattr(message_writer_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = _RecordingCache()
+    monkeypatch.setattr(message_writer_module, "prompt_context_cache", cache)
+    return cache
+
+
+def _rows(factory, chat_id):
+    with factory() as db:
+        return [
+            (row.role, row.content, row.status)
+            for row in db.query(models.Message).filter(models.Message.chat_id == chat_id).order_by(models.Message.id)
+        ]
+
+
+def test_messages_of_a_chat_are_written_in_submission_order(session_factory, cache):
+    async def scenario():
+        writer = MessageWriter(batch_size=2, flush_ms=1)
+        submitted = []
+        for i in range(5):
+            submitted.append(writer.submit(1, "user" if i % 2 == 0 else "model", f"message {i}"))
+            submitted.append(writer.submit(2, "user", f"other chat {i}"))
+        ids = [await message.wait_id() for message in submitted]
+        await writer.close()
+
+        chat_1 = [message.id for message in submitted if message.chat_id == 1]
+        assert chat_1 == sorted(chat_1)
+        assert len(set(ids)) == 10
+        assert [content for _, content, _ in _rows(session_factory, 1)] == [f"message {i}" for i in range(5)]
+        assert writer.stats()["written"] == 10
+        assert writer.stats()["pending_chats"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_settled_waits_for_queued_messages(session_factory, cache):
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_ms=20)
+        first = writer.submit(1, "user", "question")
+        second = writer.submit(1, "model", "answer")
+        assert _rows(session_factory, 1) == []
+
+        # Only what was queued before ``second``
+        await writer.settled(1, before=second)
+        assert first.future.done()
+
+        await writer.settled(1)
+        assert second.future.done()
+        assert _rows(session_factory, 1) == [("user", "question", COMPLETE), ("model", "answer", COMPLETE)]
+        # Nothing queued: returns at once
+        await asyncio.wait_for(writer.settled(2), timeout=0.1)
+        await writer.close()
+
+    asyncio.run(scenario())
+
+
+def test_update_before_the_insert_is_written(session_factory, cache):
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_ms=20)
+        answer = writer.submit(1, "model", "Partial", status=PARTIAL)
+        writer.update(answer, "Partial answer", PARTIAL)
+        # Updates queued before the batch is written coalesce into one write of the latest text
+        writer.update(answer, "Partial answer, finished", COMPLETE)
+        await writer.settled(1)
+        await writer.close()
+
+        assert _rows(session_factory, 1) == [("model", "Partial answer, finished", COMPLETE)]
+        assert writer.stats()["written"] == 1
+        assert writer.stats()["updated"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_rewritten_messages_are_invalidated_on_the_event_loop(session_factory, cache):
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_ms=1)
+        answer = writer.submit(1, "model", "Partial", status=PARTIAL)
+        await answer.wait_id()
+        assert cache.invalidated == []
+
+        writer.update(answer, "Partial answer", COMPLETE)
+        await writer.settled(1)
+        await writer.close()
+
+        assert cache.invalidated == [(1, answer.id, threading.get_ident())]
+
+    asyncio.run(scenario())
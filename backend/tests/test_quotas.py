@@ -0,0 +1,133 @@
+import types
+
+import pytest
+
+from app.config import get_settings
+from app.streaming import quotas
+from app.streaming.quotas import QuotaExceededError, UserQuotas
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(quotas, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def _prompt(tokens: int) -> int:
+    """Prompt size whose reservation (prompt plus the completion allowance) is ``tokens``."""
+    return tokens - get_settings().user_quota_completion_tokens
+
+
+def _tokens(user_quotas: UserQuotas, user: str) -> float:
+    return user_quotas._users[user].bucket.tokens
+
+
+def test_short_wait_is_delayed_and_longer_one_rejected(clock):
+    # 1000 tokens per second
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=10, max_wait_seconds=10)
+
+    first = user_quotas.reserve("user:a", _prompt(60000))
+    assert first.delay == 0
+
+    # The bucket is empty: 5000 tokens refill in 5 s, within the allowed wait
+    second = user_quotas.reserve("user:a", _prompt(5000))
+    assert second.delay == pytest.approx(5.0)
+    # The delayed request put the bucket into debt; the next one waits behind it
+    with pytest.raises(QuotaExceededError) as rejected:
+        user_quotas.reserve("user:a", _prompt(6000))
+    assert rejected.value.retry_after == 11
+
+    clock.now += 11
+    assert user_quotas.reserve("user:a", _prompt(6000)).delay == pytest.approx(0.0)
+    assert user_quotas.stats()["delayed"] == 1
+    assert user_quotas.stats()["rejected_tokens"] == 1
+
+
+def test_request_larger_than_the_bucket_is_rejected(clock):
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=10, max_wait_seconds=10)
+
+    with pytest.raises(QuotaExceededError) as rejected:
+        user_quotas.reserve("user:a", _prompt(60001))
+    assert rejected.value.retry_after == 60
+    # Nothing was charged or held
+    assert _tokens(user_quotas, "user:a") == 60000
+    assert user_quotas.stats()["active_generations"] == 0
+
+
+def test_settle_refunds_unused_tokens_and_charges_extra(clock):
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=10, max_wait_seconds=10)
+
+    short = user_quotas.reserve("user:a", _prompt(10000))
+    assert _tokens(user_quotas, "user:a") == 50000
+    short.settle(4000)
+    assert _tokens(user_quotas, "user:a") == 56000
+    # Settling twice changes nothing
+    short.settle(0)
+    assert _tokens(user_quotas, "user:a") == 56000
+
+    long = user_quotas.reserve("user:a", _prompt(10000))
+    assert _tokens(user_quotas, "user:a") == 46000
+    long.settle(15000)
+    assert _tokens(user_quotas, "user:a") == 41000
+
+
+def test_release_is_idempotent(clock):
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=1, max_wait_seconds=10)
+
+    first = user_quotas.reserve("user:a", _prompt(1000))
+    with pytest.raises(QuotaExceededError):
+        user_quotas.reserve("user:a", _prompt(1000))
+    assert user_quotas.stats()["rejected_concurrency"] == 1
+
+    first.release()
+    second = user_quotas.reserve("user:a", _prompt(1000))
+    # A second release of the first reservation must not free the place held by the second
+    first.release()
+    assert user_quotas.stats()["active_generations"] == 1
+    with pytest.raises(QuotaExceededError):
+        user_quotas.reserve("user:a", _prompt(1000))
+
+    second.release()
+    second.release()
+    assert user_quotas.stats()["active_generations"] == 0
+
+
+def test_prune_keeps_users_with_active_generations(clock, monkeypatch):
+    monkeypatch.setattr(quotas, "PRUNE_THRESHOLD", 3)
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=1, max_wait_seconds=10)
+
+    active = user_quotas.reserve("user:active", _prompt(1000))
+    idle = user_quotas.reserve("user:idle", _prompt(1000))
+    idle.settle(0)
+    idle.release()
+    spent = user_quotas.reserve("user:spent", _prompt(1000))
+    spent.release()
+
+    user_quotas.reserve("user:new", _prompt(1000))
+
+    # Only the idle user with a full bucket is forgotten
+    assert set(user_quotas._users) == {"user:active", "user:spent", "user:new"}
+    with pytest.raises(QuotaExceededError):
+        user_quotas.reserve("user:active", _prompt(1000))
+    active.release()
+    assert user_quotas.reserve("user:active", _prompt(1000)).delay == 0
+
+
+def test_anonymous_reservation_is_not_limited(clock):
+    user_quotas = UserQuotas(tokens_per_minute=60000, max_active=1, max_wait_seconds=10)
+
+    for _ in range(3):
+        reservation = user_quotas.reserve(None, _prompt(60000))
+        assert reservation.delay == 0
+    reservation.settle(0)
+    reservation.release()
+    assert user_quotas.stats()["users"] == 0
@@ -0,0 +1,120 @@
+import asyncio
+
+from app.llm.singleflight import SingleFlight
+
+KEY = "same-question"
+
+
+async def _participate(single_flight: SingleFlight, run, received=None):
+    """One request, the way ``services._generate_single_flight`` uses a flight."""
+    flight, joined = single_flight.join(KEY, run)
+    events = received if received is not None else []
+    async for event in flight.follow():
+        events.append(event)
+    return joined, events, flight
+
+
+def _upstream(calls, release: asyncio.Event, fail: bool = False):
+    async def run(flight):
+        calls.append(flight.key)
+        await flight.put("first")
+        await release.wait()
+        if fail:
+            raise RuntimeError("upstream failed")
+        await flight.put("second")
+        return "answer"
+
+    return run
+
+
+def test_followers_get_the_leaders_result():
+    async def scenario():
+        single_flight = SingleFlight()
+        calls, release = [], asyncio.Event()
+        run = _upstream(calls, release)
+
+        participants = [asyncio.create_task(_participate(single_flight, run)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(*participants)
+
+        assert calls == [KEY]
+        assert [joined for joined, _, _ in results] == [False, True, True]
+        for _, events, flight in results:
+            assert events == ["first", "second"]
+            assert flight.response == "answer" and flight.error is None
+        assert single_flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 2}
+
+    asyncio.run(scenario())
+
+
+def test_followers_get_the_leaders_error():
+    async def scenario():
+        single_flight = SingleFlight()
+        calls, release = [], asyncio.Event()
+        run = _upstream(calls, release, fail=True)
+
+        participants = [asyncio.create_task(_participate(single_flight, run)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.wait_for(asyncio.gather(*participants), timeout=1)
+
+        assert calls == [KEY]
+        for _, events, flight in results:
+            assert events == ["first"]
+            assert flight.response is None
+            assert isinstance(flight.error, RuntimeError)
+        assert single_flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelling_the_leader_does_not_stop_followers():
+    async def scenario():
+        single_flight = SingleFlight()
+        calls, release = [], asyncio.Event()
+        run = _upstream(calls, release)
+
+        leader = asyncio.create_task(_participate(single_flight, run))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(_participate(single_flight, run))
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        release.set()
+        joined, events, flight = await asyncio.wait_for(follower, timeout=1)
+
+        assert joined
+        assert events == ["first", "second"]
+        assert flight.response == "answer"
+        assert not flight.task.cancelled()
+        assert single_flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_flight_is_cancelled_when_every_request_leaves():
+    async def scenario():
+        single_flight = SingleFlight()
+        calls, release = [], asyncio.Event()
+        run = _upstream(calls, release)
+
+        participants = [asyncio.create_task(_participate(single_flight, run)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        flight = single_flight._flights[KEY]
+        for participant in participants:
+            participant.cancel()
+        await asyncio.gather(*participants, return_exceptions=True)
+        await asyncio.gather(flight.task, return_exceptions=True)
+
+        assert flight.task.cancelled()
+        assert flight.finished and flight.response is None and flight.error is None
+        # The key is free again: the next identical question starts a new upstream call
+        assert single_flight.stats()["in_flight"] == 0
+        release.set()
+        joined, events, _ = await asyncio.wait_for(_participate(single_flight, run), timeout=1)
+        assert not joined and events == ["first", "second"]
+        assert calls == [KEY, KEY]
+
+    asyncio.run(scenario())
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app.streaming import STREAM_DONE, StreamBuffer, StreamEvent
+
+
+async def _drain(buffer: StreamBuffer):
+    frames = []
+    while True:
+        frame = await buffer.next_frame(timeout=1)
+        if frame == STREAM_DONE:
+            return frames
+        frames.append(frame)
+
+
+def test_coalescing_keeps_text_and_order():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=16, flush_interval=0.05, max_frame_chars=100)
+        for text in ["Gọi ", "A ", "là "]:
+            await buffer.put(StreamEvent.chunk(text))
+        await buffer.put(StreamEvent.tool_call("search", {"q": "A^T"}))
+        for text in ["ma ", "trận"]:
+            await buffer.put(StreamEvent.chunk(text))
+        await buffer.close()
+
+        frames = await _drain(buffer)
+
+        # Chunks merge up to the tool call, which passes through in place
+        assert [frame.type.value for frame in frames] == ["message_chunk", "tool_call", "message_chunk"]
+        assert frames[0].text == "Gọi A là "
+        assert frames[1].data["name"] == "search"
+        assert frames[2].text == "ma trận"
+
+    asyncio.run(scenario())
+
+
+def test_frames_are_split_at_max_frame_chars():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=64, flush_interval=0.05, max_frame_chars=8)
+        parts = [f"{i:03d}" for i in range(20)]
+        for text in parts:
+            await buffer.put(StreamEvent.chunk(text))
+        buffer.close_nowait()
+
+        frames = await _drain(buffer)
+
+        assert "".join(frame.text for frame in frames) == "".join(parts)
+        assert len(frames) > 1
+        assert all(len(frame.text) <= 8 + 3 for frame in frames)
+
+    asyncio.run(scenario())
+
+
+def test_put_waits_while_the_buffer_is_full():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=2, flush_interval=0, max_frame_chars=100)
+        await buffer.put(StreamEvent.status(step=1))
+        await buffer.put(StreamEvent.status(step=2))
+
+        blocked = asyncio.ensure_future(buffer.put(StreamEvent.status(step=3)))
+        await asyncio.sleep(0.02)
+        assert not blocked.done()
+
+        assert (await buffer.next_frame()).data["step"] == 1
+        await asyncio.wait_for(blocked, timeout=1)
+        assert buffer.qsize() == 2
+
+    asyncio.run(scenario())
+
+
+def test_close_nowait_wakes_a_waiting_reader():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=4, flush_interval=0.05, max_frame_chars=100)
+        reader = asyncio.ensure_future(buffer.next_frame())
+        await asyncio.sleep(0.01)
+        assert not reader.done()
+
+        buffer.close_nowait()
+        assert await asyncio.wait_for(reader, timeout=1) == STREAM_DONE
+
+    asyncio.run(scenario())
+
+
+def test_close_nowait_on_a_full_buffer_does_not_block_or_lose_events():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=2, flush_interval=0, max_frame_chars=100)
+        await buffer.put(StreamEvent.status(step=1))
+        await buffer.put(StreamEvent.status(step=2))
+
+        buffer.close_nowait()
+
+        frames = await _drain(buffer)
+        assert [frame.data["step"] for frame in frames] == [1, 2]
+        # Once drained, every further read ends the stream at once
+        assert await buffer.next_frame() == STREAM_DONE
+
+    asyncio.run(scenario())
+
+
+def test_next_frame_times_out_without_events():
+    async def scenario():
+        buffer = StreamBuffer(maxsize=2, flush_interval=0, max_frame_chars=100)
+        with pytest.raises(asyncio.TimeoutError):
+            await buffer.next_frame(timeout=0.01)
+
+    asyncio.run(scenario())